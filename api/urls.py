@@ -26,12 +26,14 @@ from django.conf.urls import include, url
 from django.views.generic.base import RedirectView
 
 from api.router import router
+from instance.api.webhook import GitHubWebhookView
 
 
 # URL Patterns ################################################################
 
 urlpatterns = [
     url(r'^$', RedirectView.as_view(url='v1/', permanent=False), name='index'),
+    url(r'^v1/webhooks/github/$', GitHubWebhookView.as_view(), name='github_webhook'),
     url(r'^v1/', include(router.urls)),
     url(r'^v1/auth/', include('rest_framework.urls', namespace='rest_framework')),
 ]
@@ -23,6 +23,7 @@ Admin for the instance app
 # Imports #####################################################################
 
 from django.contrib import admin
+from instance.models.image import ServerImage
 from instance.models.instance import OpenEdXInstance
 from instance.models.logging import InstanceLogEntry, ServerLogEntry
 from instance.models.server import OpenStackServer
@@ -42,10 +43,15 @@ class OpenEdXInstanceAdmin(admin.ModelAdmin): #pylint: disable=missing-docstring
     list_display = ('sub_domain', 'base_domain', 'name', 'created', 'modified')
 
 
+class ServerImageAdmin(admin.ModelAdmin): #pylint: disable=missing-docstring
+    list_display = ('openstack_image_id', 'status', 'configuration_version', 'created', 'last_used')
+
+
 class ServerLogEntryAdmin(admin.ModelAdmin): #pylint: disable=missing-docstring
     list_display = ('instance', 'server', 'created', 'level', 'text', 'modified')
 
 admin.site.register(InstanceLogEntry, InstanceLogEntryAdmin)
 admin.site.register(OpenStackServer, OpenStackServerAdmin)
 admin.site.register(OpenEdXInstance, OpenEdXInstanceAdmin)
+admin.site.register(ServerImage, ServerImageAdmin)
 admin.site.register(ServerLogEntry, ServerLogEntryAdmin)
@@ -22,14 +22,22 @@ Ansible - Helper functions
 
 # Imports #####################################################################
 
+import fcntl
+import hashlib
 import os
+import shlex
+import shutil
+import signal
 import subprocess
 import yaml
 
 from contextlib import contextmanager
-from tempfile import mkdtemp, mkstemp
+from tempfile import mkstemp
 
 from django.conf import settings
+from django.core.cache import cache
+
+from instance.utils import increment_counter
 
 
 # Logging #####################################################################
@@ -38,6 +46,17 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+# Constants ###################################################################
+
+# File created inside a cached venv once it has been fully built - each use of the venv holds a shared
+# `flock()` on it, released by the OS even when the worker dies, and the venv is only evicted once it can be
+# locked exclusively
+VENV_READY_MARKER = '.opencraft_venv_ready'
+
+VENV_CACHE_HITS_KEY = 'ansible_venv_cache_hits'
+VENV_CACHE_MISSES_KEY = 'ansible_venv_cache_misses'
+
+
 # Functions ###################################################################
 
 def yaml_merge(yaml_str1, yaml_str2):
@@ -81,26 +100,134 @@ def string_to_file_path(string):
     os.remove(file_path)
 
 
-@contextmanager
-def run_playbook(requirements_path, inventory_str, vars_str, playbook_path, playbook_name, username='root'):
+def get_venv_cache_key(requirements_path):
+    """
+    Key identifying a cached venv - hash of the ansible python interpreter & of the requirements
+    """
+    key_hash = hashlib.sha1()
+    key_hash.update(settings.ANSIBLE_PYTHON_PATH.encode('utf-8'))
+    with open(requirements_path, 'rb') as fp:
+        key_hash.update(fp.read())
+    return key_hash.hexdigest()
+
+
+def get_venv_cache_stats():
     """
-    Runs ansible-playbook in a dedicated venv
+    Returns the number of cache hits & misses of the venv cache, across all workers
+    """
+    return {
+        'hits': cache.get(VENV_CACHE_HITS_KEY, 0),
+        'misses': cache.get(VENV_CACHE_MISSES_KEY, 0),
+    }
+
 
-    Ansible only supports Python 2 - so we have to run it as a separate command, in its own venv
+def create_venv(venv_path, requirements_path):
+    """
+    Create a venv at `venv_path` and install `requirements_path` in it
     """
-    venv_path = mkdtemp()
     create_venv_cmd = 'virtualenv -p {python_path} {venv_path}'.format(
         python_path=settings.ANSIBLE_PYTHON_PATH,
         venv_path=venv_path,
     )
-
-    venv_python_path = os.path.join(venv_path, 'bin/python')
     install_requirements_cmd = '{python} -u {pip} install -r {requirements_path}'.format(
-        python=venv_python_path,
+        python=os.path.join(venv_path, 'bin/python'),
         pip=os.path.join(venv_path, 'bin/pip'),
         requirements_path=requirements_path,
     )
 
+    cmd = ' && '.join([create_venv_cmd, install_requirements_cmd])
+    logger.info('Running: %s', cmd)
+    output = subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=True)
+    logger.debug('Venv creation output:\n%s', output.decode('utf-8'))
+
+
+def evict_venvs(keep_venv_path=None):
+    """
+    Delete the least recently used venvs when there are more than `ANSIBLE_VENV_CACHE_SIZE` in the cache -
+    the venvs in use are skipped
+    """
+    cache_dir = settings.ANSIBLE_VENV_CACHE_DIR
+    venv_list = []
+    for venv_name in os.listdir(cache_dir):
+        venv_path = os.path.join(cache_dir, venv_name)
+        marker_path = os.path.join(venv_path, VENV_READY_MARKER)
+        if venv_path != keep_venv_path and os.path.exists(marker_path):
+            venv_list.append((os.path.getmtime(marker_path), venv_path))
+
+    # The venv in use counts towards the size limit
+    max_size = settings.ANSIBLE_VENV_CACHE_SIZE - (1 if keep_venv_path else 0)
+    venv_list.sort(reverse=True)
+    for _, venv_path in venv_list[max(max_size, 0):]:
+        with cache.lock('ansible_venv_{}'.format(os.path.basename(venv_path))):
+            try:
+                marker_file = open(os.path.join(venv_path, VENV_READY_MARKER))
+            except FileNotFoundError:
+                continue
+            with marker_file:
+                try:
+                    fcntl.flock(marker_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    logger.info('Ansible venv %s is in use, not evicting it', venv_path)
+                    continue
+                logger.info('Evicting ansible venv %s from the cache', venv_path)
+                shutil.rmtree(venv_path, ignore_errors=True)
+
+
+@contextmanager
+def get_venv(requirements_path):
+    """
+    Get the path to a venv with `requirements_path` installed, creating it if it isn't cached yet
+
+    Venvs are shared between runs and workers, identified by `get_venv_cache_key()`. They are
+    built under a lock, and only used once their build has completed.
+
+    Yields a tuple `(venv_path, cache_hit)` - the venv isn't evicted until the context exits, so
+    it must enclose all the uses of the venv
+    """
+    venv_key = get_venv_cache_key(requirements_path)
+    venv_path = os.path.join(settings.ANSIBLE_VENV_CACHE_DIR, venv_key)
+    marker_path = os.path.join(venv_path, VENV_READY_MARKER)
+
+    with cache.lock('ansible_venv_{}'.format(venv_key)):
+        cache_hit = os.path.exists(marker_path)
+        if cache_hit:
+            logger.info('Ansible venv cache hit: %s', venv_path)
+            increment_counter(VENV_CACHE_HITS_KEY)
+        else:
+            logger.info('Ansible venv cache miss, creating venv: %s', venv_path)
+            increment_counter(VENV_CACHE_MISSES_KEY)
+            # Remove any leftover of an interrupted build
+            shutil.rmtree(venv_path, ignore_errors=True)
+            os.makedirs(venv_path)
+            create_venv(venv_path, requirements_path)
+            open(marker_path, 'w').close()
+
+        # The marker modification time is used to find the least recently used venvs
+        os.utime(marker_path, None)
+        marker_file = open(marker_path)
+        fcntl.flock(marker_file, fcntl.LOCK_SH)
+
+    with marker_file:
+        if not cache_hit:
+            with cache.lock('ansible_venv_cache_eviction'):
+                evict_venvs(keep_venv_path=venv_path)
+        yield venv_path, cache_hit
+
+
+@contextmanager
+def run_playbook(venv_path, inventory_str, vars_str, playbook_path, playbook_name, username='root', tags=None,
+                 skip_tags=None):
+    """
+    Runs ansible-playbook in a dedicated venv - only the tasks matching `tags` (eg. 'install,migrate')
+    when they are specified, and none of the tasks matching `skip_tags`
+
+    Ansible only supports Python 2 - so we have to run it as a separate command, in its own venv,
+    obtained from `get_venv()`
+
+    The process is waited for when the context exits - and killed first when an exception is raised
+    """
+    venv_python_path = os.path.join(venv_path, 'bin/python')
+
     with string_to_file_path(inventory_str) as inventory_path:
         with string_to_file_path(vars_str) as vars_path:
             run_playbook_cmd = '{python} -u {ansible} -i {inventory_path} -e @{vars_path} -u {user} {playbook}'\
@@ -112,13 +239,30 @@ def run_playbook(requirements_path, inventory_str, vars_str, playbook_path, play
                     user=username,
                     playbook=playbook_name,
                 )
+            if tags:
+                run_playbook_cmd += ' --tags {}'.format(shlex.quote(tags))
+            if skip_tags:
+                run_playbook_cmd += ' --skip-tags {}'.format(shlex.quote(skip_tags))
 
-            cmd = ' && '.join([create_venv_cmd, install_requirements_cmd, run_playbook_cmd])
-            logger.info('Running: %s', cmd)
-            yield subprocess.Popen(
-                cmd,
+            logger.info('Running: %s', run_playbook_cmd)
+            process = subprocess.Popen(
+                run_playbook_cmd,
                 stdout=subprocess.PIPE,
                 bufsize=1, # Bufferize one line at a time
                 cwd=playbook_path,
                 shell=True,
+                start_new_session=True,
             )
+            try:
+                yield process
+            except BaseException:
+                # Don't leave ansible running when its output isn't read anymore - the whole process group is
+                # killed, as the shell doesn't forward signals to ansible-playbook & its ssh children
+                logger.warning('Killing ansible-playbook process group (pid=%s)', process.pid)
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                raise
+            finally:
+                process.wait()
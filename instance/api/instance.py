@@ -22,14 +22,80 @@ Instance views
 
 # Imports #####################################################################
 
+import itertools
+
+from datetime import datetime
+
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from rest_framework import viewsets, status
 from rest_framework.decorators import detail_route
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 
+from instance import scheduler
+from instance.github import RateLimitExceeded
 from instance.models.instance import OpenEdXInstance
 from instance.serializers import OpenEdXInstanceSerializer
-from instance.tasks import provision_instance
+from instance.tasks import provision_instance, redeploy_instance_task
+
+
+# Constants ###################################################################
+
+# Number of log entries sent in each chunk of a streamed log
+LOG_STREAM_CHUNK_SIZE = 100
+
+
+# Functions ###################################################################
+
+def parse_log_cursor(cursor_str):
+    """
+    Parse a log cursor, formatted as `<last_instance_entry_id>-<last_server_entry_id>`
+
+    Raises ValueError when the cursor is invalid
+    """
+    try:
+        instance_entry_id, server_entry_id = (int(entry_id) for entry_id in cursor_str.split('-'))
+    except ValueError:
+        raise ValueError('Invalid log cursor: {}'.format(cursor_str))
+    return instance_entry_id, server_entry_id
+
+
+def parse_since(since_str):
+    """
+    Parse an ISO 8601 datetime - naive datetimes are considered to be in UTC
+
+    Raises ValueError when the datetime is invalid
+    """
+    since = parse_datetime(since_str)
+    if since is None:
+        raise ValueError('Invalid datetime: {}'.format(since_str))
+    if timezone.is_naive(since):
+        since = timezone.make_aware(since, timezone.utc)
+    return since
+
+
+def parse_limit(limit_str):
+    """
+    Parse a maximum number of log entries, which must be positive
+
+    Raises ValueError when the number is invalid
+    """
+    if not limit_str.isdigit() or int(limit_str) == 0:
+        raise ValueError('Invalid limit: {}'.format(limit_str))
+    return int(limit_str)
+
+
+def stream_log_text(log_entry_iterator, chunk_size=LOG_STREAM_CHUNK_SIZE):
+    """
+    Iterate over the text of log entries, one entry per line, in chunks of `chunk_size` lines
+    """
+    while True:
+        chunk = ''.join('{}\n'.format(log_entry) for log_entry in itertools.islice(log_entry_iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
 
 
 # Views - API #################################################################
@@ -41,6 +107,19 @@ class OpenEdXInstanceViewSet(viewsets.ModelViewSet):
     queryset = OpenEdXInstance.objects.all()
     serializer_class = OpenEdXInstanceSerializer
 
+    @staticmethod
+    def update_commit(instance):
+        """
+        Set the instance to the tip of its branch - returns an error response when GitHub can't be queried
+        """
+        try:
+            instance.set_to_branch_tip()
+        except RateLimitExceeded as exc:
+            reset_time = datetime.fromtimestamp(exc.reset_time, timezone.utc)
+            return Response({'status': 'GitHub API rate limit exceeded, retry after {}'.format(reset_time.isoformat())},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return None
+
     @detail_route(methods=['post'], permission_classes=[IsAuthenticated])
     def provision(self, request, pk=None):
         """
@@ -51,7 +130,51 @@ class OpenEdXInstanceViewSet(viewsets.ModelViewSet):
             return Response({'status': 'Instance is not ready for reprovisioning'},
                             status=status.HTTP_403_FORBIDDEN)
 
-        instance.set_to_branch_tip()
-        provision_instance(pk)
+        error_response = self.update_commit(instance)
+        if error_response is not None:
+            return error_response
+        provision_instance(pk, priority=scheduler.PRIORITY_MANUAL)
+
+        return Response({'status': 'Instance provisioning queued'})
+
+    @detail_route(methods=['post'], permission_classes=[IsAuthenticated])
+    def redeploy(self, request, pk=None):
+        """
+        Deploy the tip of the instance branch on its ready server, without recreating it
+        """
+        instance = self.get_object()
+        if instance.redeployable_server is None:
+            return Response({'status': 'Instance is not ready for redeployment'},
+                            status=status.HTTP_403_FORBIDDEN)
+
+        error_response = self.update_commit(instance)
+        if error_response is not None:
+            return error_response
+        redeploy_instance_task(instance.pk)
+
+        return Response({'status': 'Instance redeployment queued'})
+
+    @detail_route(methods=['get'])
+    def logs(self, request, pk=None):
+        """
+        Stream the published log of the instance & all its servers, as text with one entry per line
+
+        Query parameters, all optional:
+        - `cursor`: only return the entries logged after a previous call, using the cursor it returned
+          in its `X-Log-Cursor` header - to tail the log
+        - `since`: only return the entries created after an ISO 8601 datetime
+        - `limit`: maximum number of entries to return - the `X-Log-Cursor` header then points to the next page
+        """
+        instance = self.get_object()
+        query_params = request.query_params
+        try:
+            cursor = parse_log_cursor(query_params['cursor']) if 'cursor' in query_params else None
+            since = parse_since(query_params['since']) if 'since' in query_params else None
+            limit = parse_limit(query_params['limit']) if 'limit' in query_params else None
+        except ValueError as exc:
+            return Response({'status': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
 
-        return Response({'status': 'Instance provisioning started'})
+        log_entry_iterator, next_cursor = instance.get_log_entries(cursor=cursor, since=since, limit=limit)
+        response = StreamingHttpResponse(stream_log_text(log_entry_iterator), content_type='text/plain; charset=utf-8')
+        response['X-Log-Cursor'] = '{}-{}'.format(*next_cursor)
+        return response
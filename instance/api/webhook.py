@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+#
+# OpenCraft -- tools to aid developing and hosting free software projects
+# Copyright (C) 2015 OpenCraft <xavier@opencraft.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Webhook views
+"""
+
+# Imports #####################################################################
+
+import json
+
+from django.conf import settings
+from rest_framework import status
+from rest_framework.permissions import AllowAny
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from instance import github
+from instance.tasks import handle_pr_event, handle_push_event
+
+
+# Logging #####################################################################
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Constants ###################################################################
+
+# PR actions which can change the sandbox of the PR
+PR_UPDATE_ACTIONS = ('opened', 'reopened', 'synchronize', 'edited')
+
+
+# Views #######################################################################
+
+class GitHubWebhookView(APIView):
+    """
+    Receives the `pull_request` & `push` events sent by GitHub webhooks, and queues the
+    corresponding sandbox updates
+
+    The events must be signed with `settings.GITHUB_WEBHOOK_SECRET`
+    """
+    # Requests are authenticated by their signature
+    authentication_classes = ()
+    permission_classes = (AllowAny,)
+
+    def post(self, request):
+        """
+        Handle a webhook event
+        """
+        if not github.is_valid_webhook_signature(request.body, request.META.get('HTTP_X_HUB_SIGNATURE')):
+            return Response({'status': 'Invalid signature'}, status=status.HTTP_403_FORBIDDEN)
+
+        try:
+            payload = json.loads(request.body.decode('utf-8'))
+        except ValueError:
+            return Response({'status': 'Invalid payload'}, status=status.HTTP_400_BAD_REQUEST)
+
+        event = request.META.get('HTTP_X_GITHUB_EVENT')
+        logger.info('Received GitHub webhook event: %s', event)
+        if event == 'pull_request':
+            return self.handle_pull_request(payload)
+        elif event == 'push':
+            return self.handle_push(payload)
+        elif event == 'ping':
+            return Response({'status': 'pong'})
+        return Response({'status': 'Ignored event'})
+
+    @staticmethod
+    def handle_pull_request(payload):
+        """
+        Queue the update of the sandbox of the PR
+        """
+        r_pr = payload['pull_request']
+        if payload['action'] not in PR_UPDATE_ACTIONS \
+                or r_pr['base']['repo']['full_name'] != settings.WATCH_FORK \
+                or r_pr['head']['repo'] is None:
+            return Response({'status': 'Ignored event'})
+
+        handle_pr_event(github.get_pr_from_dict(r_pr))
+        return Response({'status': 'PR update queued'}, status=status.HTTP_202_ACCEPTED)
+
+    @staticmethod
+    def handle_push(payload):
+        """
+        Queue the update of the instances following the branch
+        """
+        ref_prefix = 'refs/heads/'
+        if not payload['ref'].startswith(ref_prefix) or payload['deleted']:
+            return Response({'status': 'Ignored event'})
+
+        handle_push_event(
+            payload['repository']['full_name'],
+            payload['ref'][len(ref_prefix):],
+            payload['after'],
+        )
+        return Response({'status': 'Push update queued'}, status=status.HTTP_202_ACCEPTED)
@@ -22,10 +22,17 @@ Gandi DNS - Helper functions
 
 # Imports #####################################################################
 
+import json
+import uuid
 import xmlrpc.client
 
+from collections import OrderedDict
+
 from django.conf import settings
 from django.core.cache import cache
+from django_redis import get_redis_connection
+
+from instance.utils import increment_counter
 
 
 # Logging #####################################################################
@@ -34,6 +41,22 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+# Constants ###################################################################
+
+# Redis list of the DNS records waiting to be set, shared by all processes
+PENDING_RECORDS_KEY = 'gandi_pending_dns_records'
+
+# Time during which the records set by a queued DNS record change are remembered, in seconds
+APPLIED_RECORD_TIMEOUT = 3600
+
+# Snapshot of the records of the active zone version, shared by all processes
+ZONE_RECORDS_KEY = 'gandi_zone_records'
+ZONE_RECORDS_TIMEOUT = 300
+
+# Number of DNS record changes skipped because the record already had the requested value
+SKIPPED_WRITES_KEY = 'gandi_skipped_dns_writes'
+
+
 # Classes #####################################################################
 
 class GandiAPI():
@@ -92,17 +115,120 @@ class GandiAPI():
         """
         return self.client_zone.version.set(self.api_key, self.zone_id, zone_version_id)
 
-    def set_dns_record(self, **record):
+    def get_zone_records(self):
         """
-        Set a DNS record - Automatically create a new version, update with the change & activate
+        Get the list of records of the active zone version
+
+        The list is cached, and invalidated whenever we change the zone
         """
-        if 'ttl' not in record.keys():
-            record['ttl'] = 1200
+        record_list = cache.get(ZONE_RECORDS_KEY)
+        if record_list is None:
+            # Version 0 is the active version
+            record_list = self.client_zone.record.list(self.api_key, self.zone_id, 0)
+            cache.set(ZONE_RECORDS_KEY, record_list, ZONE_RECORDS_TIMEOUT)
+        return record_list
 
-        with cache.lock('gandi_set_dns_record'): # Only do one DNS update at a time
-            logger.info('Setting DNS record: %s', record)
-            new_zone_version = self.create_new_zone_version()
+    def find_dns_record(self, record):
+        """
+        Returns the record of the active zone version if it already matches `record`, with no other
+        record with the same name - None otherwise
+        """
+        same_name_record_list = [r for r in self.get_zone_records() if r['name'] == record['name']]
+        if len(same_name_record_list) != 1:
+            return None
+        current_record = same_name_record_list[0]
+        if all(current_record.get(key) == record[key] for key in ('type', 'value', 'ttl')):
+            return current_record
+        return None
+
+    def _set_dns_records(self, record_list):
+        """
+        Set DNS records in a single new zone version - Must be called while holding the DNS lock
+
+        Returns a dict of the added records, by name
+        """
+        logger.info('Setting DNS records: %s', record_list)
+        new_zone_version = self.create_new_zone_version()
+        added_record_dict = {}
+        for record in record_list:
             self.delete_dns_record(new_zone_version, record['name'])
-            returned_record = self.add_dns_record(new_zone_version, record)
-            self.set_zone_version(new_zone_version)
-        return returned_record
+            added_record_dict[record['name']] = self.add_dns_record(new_zone_version, record)
+        self.set_zone_version(new_zone_version)
+        cache.delete(ZONE_RECORDS_KEY)
+        return added_record_dict
+
+    def set_dns_record(self, **record):
+        """
+        Set a DNS record - see `set_dns_records()`
+
+        Returns the record, as set in the zone
+        """
+        return self.set_dns_records([record])[0]
+
+    def set_dns_records(self, record_list):
+        """
+        Set a list of DNS records - Automatically create a new version, update with the changes & activate
+
+        Only one DNS update is done at a time. Changes requested concurrently by other callers (from
+        any process) while waiting are queued, and applied together in a single zone version by the
+        next caller to get the lock. Returns once the records of `record_list` have been set.
+
+        Records which already have the requested value in the active zone are skipped.
+
+        Returns the list of the records of `record_list`, as set in the zone
+        """
+        for record in record_list:
+            if 'ttl' not in record.keys():
+                record['ttl'] = 1200
+
+        set_record_dict = {}
+        for record in record_list:
+            current_record = self.find_dns_record(record)
+            if current_record is not None:
+                logger.info('DNS record already set, skipping: %s', record)
+                increment_counter(SKIPPED_WRITES_KEY)
+                set_record_dict[record['name']] = current_record
+        changed_record_list = [record for record in record_list if record['name'] not in set_record_dict]
+        if changed_record_list:
+            set_record_dict.update(self._queue_dns_records(changed_record_list))
+        return [set_record_dict[record['name']] for record in record_list]
+
+    def _queue_dns_records(self, record_list):
+        """
+        Queue DNS records to set, and apply all the queued records once the DNS lock is acquired - unless
+        a concurrent caller already applied them (see `set_dns_records()`)
+
+        Returns a dict of the records of `record_list` as set in the zone, by name
+        """
+        token = uuid.uuid4().hex
+        redis = get_redis_connection('default')
+        redis.rpush(PENDING_RECORDS_KEY, json.dumps({'token': token, 'record_list': record_list}))
+
+        with cache.lock('gandi_set_dns_record'):
+            applied_record_dict = cache.get('gandi_applied_{}'.format(token))
+            if applied_record_dict is not None:
+                logger.info('DNS records already set by a concurrent update: %s', record_list)
+                return applied_record_dict
+
+            pipeline = redis.pipeline()
+            pipeline.lrange(PENDING_RECORDS_KEY, 0, -1)
+            pipeline.delete(PENDING_RECORDS_KEY)
+            pending_list = [json.loads(item.decode('utf-8')) for item in pipeline.execute()[0]]
+            if token not in (pending['token'] for pending in pending_list):
+                # Dequeued by a caller which failed to apply it
+                pending_list.append({'token': token, 'record_list': record_list})
+
+            # Later changes to the same record name take precedence
+            record_dict = OrderedDict()
+            for pending in pending_list:
+                for record in pending['record_list']:
+                    record_dict.pop(record['name'], None)
+                    record_dict[record['name']] = record
+            added_record_dict = self._set_dns_records(list(record_dict.values()))
+
+            cache.set_many({
+                'gandi_applied_{}'.format(pending['token']): {
+                    record['name']: added_record_dict[record['name']] for record in pending['record_list']
+                } for pending in pending_list
+            }, APPLIED_RECORD_TIMEOUT)
+        return {record['name']: added_record_dict[record['name']] for record in record_list}
@@ -22,10 +22,20 @@ GitHub Service API - Helper functions
 
 # Imports #####################################################################
 
+import hashlib
+import hmac
 import re
 import requests
+import threading
+import time
+
+from contextlib import contextmanager
+from urllib.parse import urlparse
 
 from django.conf import settings
+from django.core.cache import cache
+
+from instance.utils import increment_counter
 
 
 # Logging #####################################################################
@@ -41,18 +51,224 @@ GH_HEADERS = {
     'Time-Zone': 'UTC',
 }
 
+# Maximum number of connections to the GitHub API kept open by the shared session, for reuse
+# by the threads sending requests - extra connections are closed once their request is done
+GH_HTTP_POOL_SIZE = 8
+
+# Time during which responses are kept, to be revalidated with conditional requests, in seconds
+GH_RESPONSE_CACHE_TIMEOUT = 24 * 3600
+
+
+# Time during which team & membership lookups are used without being refreshed, in seconds
+GH_TEAM_CACHE_FRESH_TIMEOUT = 3600
+
+# Time during which stale team & membership lookups are still used while they are refreshed, in seconds
+GH_TEAM_CACHE_TIMEOUT = 7 * 24 * 3600
+
+# Maximum duration of a background refresh of a cached lookup, in seconds
+GH_TEAM_CACHE_REFRESH_LOCK_TIMEOUT = 60
+
+# Request priorities - background requests (eg. periodic polling) are only sent while there is enough
+# of the rate limit budget left, to keep the rest of it for interactive requests (eg. API calls)
+GH_PRIORITY_INTERACTIVE = 'interactive'
+GH_PRIORITY_BACKGROUND = 'background'
+
+# Share of the rate limit budget of each resource reserved for interactive requests
+GH_RATE_LIMIT_RESERVE = 0.2
+
+# API resources with separate rate limit budgets
+GH_RATE_LIMIT_RESOURCES = ('core', 'search')
+
+# Maximum time interactive requests wait for a temporary block (`Retry-After`) to end, in seconds
+GH_MAX_RETRY_AFTER = 10
+
+# Cache keys of the rate limit budget & metrics, shared by all processes
+GH_RATE_LIMIT_KEY = 'github_rate_limit_{}'
+GH_BLOCKED_UNTIL_KEY = 'github_rate_limit_blocked_until'
+GH_REQUESTS_KEY = 'github_requests'
+GH_NOT_MODIFIED_KEY = 'github_requests_not_modified'
+GH_DEFERRED_KEY = 'github_requests_deferred'
+
+
+# Exceptions ##################################################################
+
+class RateLimitExceeded(Exception):
+    """
+    Raised when a request can't be sent without exceeding the rate limit budget
+    """
+    def __init__(self, message, reset_time):
+        super().__init__(message)
+        self.reset_time = reset_time
+
+
+# Globals #####################################################################
+
+# Shared session, to reuse connections to the API between requests
+session = requests.Session()
+session.headers.update(GH_HEADERS)
+session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=GH_HTTP_POOL_SIZE))
+
+# Priority of the requests sent by the current thread
+_request_priority = threading.local()
+
 
 # Functions ###################################################################
 
+def get_request_priority():
+    """
+    Returns the priority of the requests sent by the current thread - interactive by default
+    """
+    return getattr(_request_priority, 'value', GH_PRIORITY_INTERACTIVE)
+
+
+@contextmanager
+def background_priority():
+    """
+    Send the requests made within the context with the background priority
+    """
+    previous_priority = get_request_priority()
+    _request_priority.value = GH_PRIORITY_BACKGROUND
+    try:
+        yield
+    finally:
+        _request_priority.value = previous_priority
+
+
+def get_rate_limit_stats():
+    """
+    Returns the last known rate limit budget of each API resource, along with the number of requests
+    sent, answered as unchanged (304) and deferred for lack of budget, across all workers
+    """
+    stats = {
+        'requests': cache.get(GH_REQUESTS_KEY, 0),
+        'not_modified': cache.get(GH_NOT_MODIFIED_KEY, 0),
+        'deferred': cache.get(GH_DEFERRED_KEY, 0),
+    }
+    for resource in GH_RATE_LIMIT_RESOURCES:
+        stats[resource] = cache.get(GH_RATE_LIMIT_KEY.format(resource))
+    return stats
+
+
+def check_rate_limit(resource):
+    """
+    Raise `RateLimitExceeded` if a request for `resource` can't be sent now, given the priority of
+    the current thread - interactive requests wait for short temporary blocks to end instead
+    """
+    now = time.time()
+    priority = get_request_priority()
+
+    blocked_until = cache.get(GH_BLOCKED_UNTIL_KEY)
+    if blocked_until is not None and blocked_until > now:
+        if priority == GH_PRIORITY_INTERACTIVE and blocked_until - now <= GH_MAX_RETRY_AFTER:
+            logger.warning('GitHub API temporarily blocked, waiting %.1fs', blocked_until - now)
+            time.sleep(blocked_until - now)
+        else:
+            increment_counter(GH_DEFERRED_KEY)
+            raise RateLimitExceeded('GitHub API temporarily blocked', blocked_until)
+
+    budget = cache.get(GH_RATE_LIMIT_KEY.format(resource))
+    if budget is None or budget['reset'] <= now:
+        return
+    reserve = int(budget['limit'] * GH_RATE_LIMIT_RESERVE) if priority == GH_PRIORITY_BACKGROUND else 0
+    if budget['remaining'] <= reserve:
+        increment_counter(GH_DEFERRED_KEY)
+        raise RateLimitExceeded('GitHub API rate limit budget exhausted for {} requests on {}'.format(
+            priority, resource), budget['reset'])
+
+
+def update_rate_limit(resource, response):
+    """
+    Record the rate limit budget & temporary blocks reported in an API response
+
+    Returns True if the request was rejected because of the rate limit
+    """
+    now = time.time()
+    headers = response.headers
+    if 'X-RateLimit-Remaining' in headers:
+        budget = {
+            'limit': int(headers['X-RateLimit-Limit']),
+            'remaining': int(headers['X-RateLimit-Remaining']),
+            'reset': int(headers['X-RateLimit-Reset']),
+        }
+        cache.set(GH_RATE_LIMIT_KEY.format(resource), budget, max(1, budget['reset'] - now))
+    else:
+        budget = None
+
+    if response.status_code not in (403, 429):
+        return False
+    if 'Retry-After' in headers:
+        retry_after = int(headers['Retry-After'])
+        logger.warning('GitHub API temporarily blocked for %ss', retry_after)
+        cache.set(GH_BLOCKED_UNTIL_KEY, now + retry_after, retry_after + 1)
+        return True
+    return budget is not None and budget['remaining'] == 0
+
+
+def send_request(url, headers):
+    """
+    Send a GET request to the API, within the rate limit budget of the resource it uses
+    """
+    resource = 'search' if urlparse(url).path.startswith('/search/') else 'core'
+    # The second attempt only happens for interactive requests, after a short temporary block
+    for _ in range(2):
+        check_rate_limit(resource)
+        r = session.get(url, headers=headers)
+        increment_counter(GH_REQUESTS_KEY)
+        if not update_rate_limit(resource, r):
+            return r
+
+    increment_counter(GH_DEFERRED_KEY)
+    raise RateLimitExceeded('GitHub API rate limit exceeded on {}'.format(resource),
+                            cache.get(GH_BLOCKED_UNTIL_KEY, time.time() + GH_MAX_RETRY_AFTER))
+
+
+def get_page_from_url(url):
+    """
+    Send the request to the provided URL, attaching custom headers, and returns a tuple with
+    the deserialized object from the returned JSON & the URL of the next page of results (or None)
+
+    Responses are cached along with their ETag, to use conditional requests on the following calls
+    for the same URL - unchanged responses (304) don't count against the API rate limit.
+    """
+    logger.info('GET URL %s', url)
+    cache_key = 'github_response_{}'.format(hashlib.sha1(url.encode('utf-8')).hexdigest())
+    cached_response = cache.get(cache_key)
+    headers = {}
+    if cached_response is not None:
+        headers['If-None-Match'] = cached_response['etag']
+
+    r = send_request(url, headers)
+    if r.status_code == 304 and cached_response is not None:
+        logger.debug('Unchanged response for URL %s', url)
+        increment_counter(GH_NOT_MODIFIED_KEY)
+        return cached_response['data'], cached_response['next_url']
+    r.raise_for_status()
+
+    data = r.json()
+    next_url = r.links.get('next', {}).get('url')
+    etag = r.headers.get('ETag')
+    if etag:
+        cache.set(cache_key, {'etag': etag, 'data': data, 'next_url': next_url}, GH_RESPONSE_CACHE_TIMEOUT)
+    return data, next_url
+
+
 def get_object_from_url(url):
     """
     Send the request to the provided URL, attaching custom headers, and returns
     the deserialized object from the returned JSON
     """
-    logger.info('GET URL %s', url)
-    r = requests.get(url, headers=GH_HEADERS)
-    r.raise_for_status()
-    return r.json()
+    return get_page_from_url(url)[0]
+
+
+def get_object_list_from_url(url):
+    """
+    Returns the concatenated list of objects from all the pages of results, starting from `url`
+    """
+    object_list = []
+    while url is not None:
+        page_object_list, url = get_page_from_url(url)
+        object_list += page_object_list
+    return object_list
 
 
 def fork_name2tuple(fork_name):
@@ -86,6 +302,21 @@ def get_settings_from_pr_body(pr_body):
         return ''
 
 
+def get_pr_from_dict(r_pr):
+    """
+    Returns a PR object based on a PR dict from the API response
+    """
+    return PR(
+        r_pr['number'],
+        r_pr['head']['repo']['full_name'],
+        r_pr['head']['ref'],
+        r_pr['title'],
+        r_pr['user']['login'],
+        body=r_pr['body'] or '',
+        head_sha=r_pr['head']['sha'],
+    )
+
+
 def get_pr_by_number(fork_name, pr_number):
     """
     Returns a PR object based on the reponse
@@ -94,52 +325,119 @@ def get_pr_by_number(fork_name, pr_number):
         fork_name=fork_name,
         pr_number=pr_number,
     ))
-    pr_fork_name = r_pr['head']['repo']['full_name']
-    pr_branch_name = r_pr['head']['ref']
-    pr = PR(
-        pr_number,
-        pr_fork_name,
-        pr_branch_name,
-        r_pr['title'],
-        r_pr['user']['login'],
-        body=r_pr['body'],
-    )
-    return pr
+    return get_pr_from_dict(r_pr)
 
 
-def get_pr_list_from_username(user_name, fork_name):
+def get_pr_list_from_fork(fork_name, username_list):
     """
-    Retrieve the current active PRs for a given user
+    Retrieve the current open PRs on a fork, opened by the users from `username_list`
+
+    PRs whose source repository has been deleted are ignored
     """
-    q = 'is:open is:pr author:{author} repo:{repo}'.format(author=user_name, repo=fork_name)
-    r_pr_list = get_object_from_url('https://api.github.com/search/issues?sort=created&q={}'.format(q))
-    logger.debug('List of PRs received for user %s: %s', user_name, r_pr_list)
+    url = 'https://api.github.com/repos/{fork_name}/pulls?state=open&per_page=100'.format(fork_name=fork_name)
+    username_set = set(username_list)
 
     pr_list = []
-    for pr_dict in r_pr_list['items']:
-        pr = get_pr_by_number(fork_name, pr_dict['number'])
-        pr_list.append(pr)
+    for r_pr in get_object_list_from_url(url):
+        if r_pr['user']['login'] not in username_set:
+            continue
+        if r_pr['head']['repo'] is None:
+            logger.info('Ignoring PR #%s, its source repository has been deleted', r_pr['number'])
+            continue
+        pr_list.append(get_pr_from_dict(r_pr))
     return pr_list
 
 
-def get_team_from_organization(organization_name, team_name='Owners'):
+def get_cached_value(cache_key, fetch_func, *args):
     """
-    Retrieve a team by organization & team name
+    Returns the value computed by `fetch_func(*args)`, caching it for `GH_TEAM_CACHE_TIMEOUT`
+
+    Once the cached value is older than `GH_TEAM_CACHE_FRESH_TIMEOUT`, it is still returned
+    immediately, while it gets refreshed in the background (stale-while-revalidate)
+    """
+    cached_value = cache.get(cache_key)
+    if cached_value is None:
+        return set_cached_value(cache_key, fetch_func, *args)
+
+    if cached_value['refresh_after'] <= time.time() \
+            and cache.add('{}_refreshing'.format(cache_key), True, GH_TEAM_CACHE_REFRESH_LOCK_TIMEOUT):
+        logger.debug('Refreshing stale cached value in the background: %s', cache_key)
+        threading.Thread(target=refresh_cached_value, args=(cache_key, fetch_func) + args, daemon=True).start()
+    return cached_value['value']
+
+
+def set_cached_value(cache_key, fetch_func, *args):
+    """
+    Compute the value with `fetch_func(*args)` and cache it - returns the value
+    """
+    value = fetch_func(*args)
+    cache.set(cache_key, {'value': value, 'refresh_after': time.time() + GH_TEAM_CACHE_FRESH_TIMEOUT},
+              GH_TEAM_CACHE_TIMEOUT)
+    return value
+
+
+def refresh_cached_value(cache_key, fetch_func, *args):
+    """
+    Refresh a stale cached value - on failure, the stale value is kept until the next attempt
+    """
+    try:
+        with background_priority():
+            set_cached_value(cache_key, fetch_func, *args)
+    except Exception: #pylint: disable=broad-except
+        logger.exception('Could not refresh cached value: %s', cache_key)
+    finally:
+        cache.delete('{}_refreshing'.format(cache_key))
+
+
+def fetch_team_from_organization(organization_name, team_name):
+    """
+    Retrieve a team by organization & team name from the API
     """
     url = 'https://api.github.com/orgs/{org}/teams'.format(org=organization_name)
-    for team_dict in get_object_from_url(url):
+    for team_dict in get_object_list_from_url(url):
         if team_dict['name'] == team_name:
-            return team_dict
+            return {'id': team_dict['id'], 'name': team_dict['name']}
     raise KeyError(team_name)
 
 
+def fetch_username_list_from_team(team_id):
+    """
+    Retrieve the usernames of a team's members from the API
+    """
+    url = 'https://api.github.com/teams/{team_id}/members'.format(team_id=team_id)
+    return [user_dict['login'] for user_dict in get_object_list_from_url(url)]
+
+
+def get_team_from_organization(organization_name, team_name='Owners'):
+    """
+    Retrieve a team by organization & team name (cached)
+    """
+    cache_key = 'github_team_{}_{}'.format(organization_name, team_name)
+    return get_cached_value(cache_key, fetch_team_from_organization, organization_name, team_name)
+
+
 def get_username_list_from_team(organization_name, team_name='Owners'):
     """
-    Retrieve the usernames of a given team's members
+    Retrieve the usernames of a given team's members (cached)
     """
     team = get_team_from_organization(organization_name, team_name)
-    url = 'https://api.github.com/teams/{team_id}/members'.format(team_id=team['id'])
-    return [user_dict['login'] for user_dict in get_object_from_url(url)]
+    cache_key = 'github_team_members_{}'.format(team['id'])
+    return get_cached_value(cache_key, fetch_username_list_from_team, team['id'])
+
+
+def is_valid_webhook_signature(payload, signature):
+    """
+    Check the signature sent by GitHub along with a webhook payload (`X-Hub-Signature` header),
+    using `settings.GITHUB_WEBHOOK_SECRET` as the key
+    """
+    if not settings.GITHUB_WEBHOOK_SECRET or not signature:
+        return False
+    algorithm, _, digest = signature.partition('=')
+    if algorithm not in ('sha1', 'sha256'):
+        return False
+    expected_digest = hmac.new(settings.GITHUB_WEBHOOK_SECRET.encode('utf-8'), payload,
+                               getattr(hashlib, algorithm)).hexdigest()
+    return hmac.compare_digest(expected_digest, digest)
 
 
 # Classes #####################################################################
@@ -148,13 +446,14 @@ class PR:
     """
     Representation of a GitHub Pull Request
     """
-    def __init__(self, number, fork_name, branch_name, title, username, body=''):
+    def __init__(self, number, fork_name, branch_name, title, username, body='', head_sha=None):
         self.number = number
         self.fork_name = fork_name
         self.branch_name = branch_name
         self.title = title
         self.username = username
         self.body = body
+        self.head_sha = head_sha
 
     @property
     def extra_settings(self):
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+import django_extensions.db.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instance', '0024_auto_20150911_2304'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ServerImage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, verbose_name='ID', serialize=False)),
+                ('created', django_extensions.db.fields.CreationDateTimeField(editable=False, blank=True, default=django.utils.timezone.now, verbose_name='created')),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(editable=False, blank=True, default=django.utils.timezone.now, verbose_name='modified')),
+                ('openstack_image_id', models.CharField(max_length=250, db_index=True)),
+                ('status', models.CharField(max_length=11, choices=[('saving', 'Saving - Snapshot requested, not usable yet'), ('available', 'Available - Servers can be booted from the image')], db_index=True, default='saving')),
+                ('last_used', models.DateTimeField(default=django.utils.timezone.now)),
+                ('ansible_source_repo_url', models.URLField(max_length=256)),
+                ('configuration_version', models.CharField(max_length=50)),
+                ('ansible_playbook_name', models.CharField(max_length=50)),
+                ('forum_version', models.CharField(max_length=50)),
+                ('notifier_version', models.CharField(max_length=50)),
+                ('xqueue_version', models.CharField(max_length=50)),
+                ('certs_version', models.CharField(max_length=50)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instance', '0025_serverimage'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='instancelogentry',
+            index_together=set([('instance', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='serverlogentry',
+            index_together=set([('server', 'id')]),
+        ),
+    ]
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+#
+# OpenCraft -- tools to aid developing and hosting free software projects
+# Copyright (C) 2015 OpenCraft <xavier@opencraft.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Instance app models - Server images
+"""
+
+# Imports #####################################################################
+
+import time
+
+import novaclient
+
+from django.db import models
+from django.utils import timezone
+from django_extensions.db.models import TimeStampedModel
+
+from instance import openstack
+from instance.models.utils import ValidateModelMixin
+
+
+# Logging #####################################################################
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Exceptions ##################################################################
+
+class ServerImageTimeout(Exception):
+    """
+    Raised when OpenStack doesn't save an image in time
+    """
+    pass
+
+
+# Models ######################################################################
+
+class ServerImageQuerySet(models.QuerySet):
+    """
+    Additional methods for server image querysets
+    Also used as the standard manager for the ServerImage model
+    """
+    def filter_configuration(self, instance):
+        """
+        Images built with the same ansible configuration & playbook as the instance
+        """
+        return self.filter(
+            ansible_source_repo_url=instance.ansible_source_repo_url,
+            configuration_version=instance.configuration_version,
+            ansible_playbook_name=instance.ansible_playbook_name,
+        )
+
+    def filter_versions(self, instance):
+        """
+        Images built with the same configuration & service versions as the instance
+        """
+        version_dict = {field_name: getattr(instance, field_name) for field_name in ServerImage.VERSION_FIELDS}
+        return self.filter_configuration(instance).filter(**version_dict)
+
+    def find_for_instance(self, instance):
+        """
+        Returns the available image best matching the instance, or None
+
+        The image must have been built with the same configuration - the images with the most
+        service versions in common with the instance are preferred, then the most recent ones
+        """
+        image_list = self.filter_configuration(instance).filter(status=ServerImage.AVAILABLE)
+        if not image_list:
+            return None
+        return max(image_list, key=lambda image: (image.count_matching_versions(instance), image.created))
+
+    def create_from_server(self, server):
+        """
+        Snapshot a server on which only the base stage of the playbook was run (see
+        `OpenEdXInstance.snapshot_base_stage()`), unless an image with the same versions already exists
+
+        Returns the new image, or None
+        """
+        instance = server.instance
+        if self.filter_versions(instance).exists():
+            return None
+
+        image_name = '{}-{}'.format(instance.sub_domain, timezone.now().strftime('%Y%m%d%H%M%S'))
+        instance.log('info', 'Creating image {} from server {}...'.format(image_name, server))
+        try:
+            openstack_image_id = openstack.create_server_image(server.nova, server.openstack_id, image_name)
+        except novaclient.exceptions.ClientException:
+            instance.log('exception', 'Could not create image {} from server {}'.format(image_name, server))
+            return None
+        return self.create(
+            openstack_image_id=openstack_image_id,
+            ansible_source_repo_url=instance.ansible_source_repo_url,
+            configuration_version=instance.configuration_version,
+            ansible_playbook_name=instance.ansible_playbook_name,
+            **{field_name: getattr(instance, field_name) for field_name in ServerImage.VERSION_FIELDS}
+        )
+
+    def delete_unused(self, nova, keep_count):
+        """
+        Delete the available images, except the `keep_count` most recently used ones
+        """
+        image_list = self.filter(status=ServerImage.AVAILABLE).order_by('-last_used')[keep_count:]
+        for image in image_list:
+            image.delete_image(nova)
+
+
+class ServerImage(ValidateModelMixin, TimeStampedModel):
+    """
+    Snapshot of a server provisioned with the base stage of the playbook only, without any setting or
+    secret of an instance, from which the servers of the instances using the same versions can be booted
+    """
+    SAVING = 'saving'
+    AVAILABLE = 'available'
+
+    STATUS_CHOICES = (
+        (SAVING, 'Saving - Snapshot requested, not usable yet'),
+        (AVAILABLE, 'Available - Servers can be booted from the image'),
+    )
+
+    # Time to wait for OpenStack to save an image (seconds), and interval between the checks
+    SAVE_TIMEOUT = 1800
+    SAVE_POLL_INTERVAL = 10
+
+    # Versions of the services installed on the image
+    VERSION_FIELDS = ('forum_version', 'notifier_version', 'xqueue_version', 'certs_version')
+
+    openstack_image_id = models.CharField(max_length=250, db_index=True)
+    status = models.CharField(max_length=11, default=SAVING, choices=STATUS_CHOICES, db_index=True)
+    last_used = models.DateTimeField(default=timezone.now)
+
+    ansible_source_repo_url = models.URLField(max_length=256)
+    configuration_version = models.CharField(max_length=50)
+    ansible_playbook_name = models.CharField(max_length=50)
+    forum_version = models.CharField(max_length=50)
+    notifier_version = models.CharField(max_length=50)
+    xqueue_version = models.CharField(max_length=50)
+    certs_version = models.CharField(max_length=50)
+
+    objects = ServerImageQuerySet.as_manager()
+
+    def __str__(self):
+        return '{0.openstack_image_id} ({0.configuration_version})'.format(self)
+
+    def count_matching_versions(self, instance):
+        """
+        Number of service versions of the image which are the same as the instance's
+        """
+        return sum(getattr(self, field_name) == getattr(instance, field_name) for field_name in self.VERSION_FIELDS)
+
+    def mark_used(self):
+        """
+        Record that a server is booted from the image - the least recently used images are deleted first
+        """
+        self.last_used = timezone.now()
+        self.save_fields('last_used')
+
+    def update_status(self, nova):
+        """
+        Make the image available once OpenStack has saved it - the images which failed to save are deleted
+        """
+        image_status = openstack.get_image_status(nova, self.openstack_image_id)
+        if image_status == 'ACTIVE':
+            logger.info('Image %s is available', self)
+            self.status = self.AVAILABLE
+            self.save_fields('status')
+        elif image_status not in ('QUEUED', 'SAVING'):
+            logger.error('Image %s failed to save (status=%s), deleting it', self, image_status)
+            self.delete_image(nova)
+
+    def sleep_until_saved(self, nova, deadline=None):
+        """
+        Sleep in a loop until OpenStack has saved the image - returns whether the image is available
+
+        Raises `ServerImageTimeout` when the image isn't saved after `SAVE_TIMEOUT` seconds, or after
+        the `deadline` timestamp
+        """
+        end_time = time.time() + self.SAVE_TIMEOUT
+        if deadline is not None:
+            end_time = min(end_time, deadline)
+
+        while True:
+            self.update_status(nova)
+            if self.pk is None:
+                # Failed to save, and deleted
+                return False
+            elif self.status == self.AVAILABLE:
+                return True
+            elif time.time() >= end_time:
+                raise ServerImageTimeout('Image {} was not saved in time'.format(self))
+            time.sleep(self.SAVE_POLL_INTERVAL)
+
+    def delete_image(self, nova):
+        """
+        Delete the image from OpenStack, and from the catalog
+        """
+        openstack.delete_image(nova, self.openstack_image_id)
+        self.delete()
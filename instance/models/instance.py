@@ -23,6 +23,10 @@ Instance app models - Instance
 # Imports #####################################################################
 
 import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 
 from django.conf import settings
 from django.core.validators import RegexValidator
@@ -36,8 +40,10 @@ from instance.gandi import GandiAPI
 from instance.github import fork_name2tuple, get_username_list_from_team
 from instance.log_exception import log_exception
 from instance.repo import open_repository
-from instance.models.logging_mixin import LoggerInstanceMixin
+from instance.models.image import ServerImage
+from instance.models.logging_mixin import LogEntryBuffer, LoggerInstanceMixin
 from instance.models.utils import ValidateModelMixin
+from instance.utils import read_lines
 
 
 # Constants ###################################################################
@@ -59,6 +65,13 @@ class InconsistentInstanceState(Exception):
     pass
 
 
+class InstanceNotReady(Exception):
+    """
+    Raised when an operation requires the instance to have a ready server
+    """
+    pass
+
+
 # Validators ##################################################################
 
 sha1_validator = RegexValidator(regex='^[0-9a-f]{40}$', message='Full SHA1 hash required')
@@ -121,18 +134,39 @@ class Instance(ValidateModelMixin, TimeStampedModel):
         """
         return self.server_set.exclude_terminated()
 
+    @property
+    def current_server(self):
+        """
+        Active server currently serving the instance (the oldest one), or None
+        """
+        return self.active_server_set.order_by('created', 'pk').first()
+
+    @property
+    def next_server(self):
+        """
+        Active server being provisioned to replace `current_server` (see `settings.BLUE_GREEN_PROVISIONING`),
+        or None
+        """
+        active_server_list = list(self.active_server_set.order_by('created', 'pk')[:2])
+        if len(active_server_list) < 2:
+            return None
+        return active_server_list[1]
+
     @property
     def status(self):
         """
         Instance status
+
+        While a next server is provisioned alongside the current one, this is the status of the next server -
+        `provision()` terminates the next server when it fails, which reverts to the status of the current server
         """
-        active_server_set = self.active_server_set
-        if not active_server_set:
+        active_server_list = list(self.active_server_set.order_by('created', 'pk')[:3])
+        if not active_server_list:
             return self.EMPTY
-        elif active_server_set.count() > 1:
-            raise InconsistentInstanceState('Multiple servers are active, which is unsupported')
+        elif len(active_server_list) > 2:
+            raise InconsistentInstanceState('More than two servers are active, which is unsupported')
         else:
-            return active_server_set[0].status
+            return active_server_list[-1].status
 
 
 # Git #########################################################################
@@ -276,10 +310,13 @@ class GitHubInstanceMixin(VersionControlInstanceMixin):
         else:
             return []
 
-    def set_to_branch_tip(self, branch_name=None, ref_type=None, commit=True):
+    def set_to_branch_tip(self, branch_name=None, ref_type=None, commit=True, commit_id=None):
         """
         Set the `commit_id` to the current tip of the branch
 
+        When the tip of the branch is already known (eg. from a webhook event), pass it as
+        `commit_id` to skip its retrieval from GitHub
+
         By default, save the instance object - pass `commit=False` to not save it
         """
         if branch_name is not None:
@@ -287,10 +324,13 @@ class GitHubInstanceMixin(VersionControlInstanceMixin):
         if ref_type is not None:
             self.ref_type = ref_type
         self.log('info', 'Setting instance {} to tip of branch {}'.format(self, self.branch_name))
-        new_commit_id = github.get_commit_id_from_ref(
-            self.fork_name,
-            self.branch_name,
-            ref_type=self.ref_type)
+        if commit_id is not None:
+            new_commit_id = commit_id
+        else:
+            new_commit_id = github.get_commit_id_from_ref(
+                self.fork_name,
+                self.branch_name,
+                ref_type=self.ref_type)
 
         if new_commit_id != self.commit_id:
             old_commit_short_id = self.commit_short_id
@@ -353,11 +393,17 @@ class AnsibleInstanceMixin(models.Model):
     @property
     def inventory_str(self):
         """
-        The ansible inventory (list of servers) as a string
+        The ansible inventory (list of servers) as a string - the servers being provisioned
         """
-        inventory = ['[app]']
         server_model = self.server_set.model
-        for server in self.server_set.filter(status=server_model.BOOTED).order_by('created'):
+        return self.get_inventory_str(self.server_set.filter(status=server_model.BOOTED).order_by('created'))
+
+    def get_inventory_str(self, server_list):
+        """
+        The ansible inventory of the servers from `server_list` as a string
+        """
+        inventory = ['[app]']
+        for server in server_list:
             inventory.append(server.public_ip)
         inventory_str = '\n'.join(inventory)
         self.log('debug', 'Inventory for instance {}:\n{}'.format(self, inventory_str))
@@ -376,34 +422,86 @@ class AnsibleInstanceMixin(models.Model):
         self.log('debug', 'Vars.yml for instance {}:\n{}'.format(self, vars_str))
         return vars_str
 
-    def run_playbook(self, playbook_name=None):
+    @property
+    def snapshot_vars_str(self):
+        """
+        The generic ansible vars of the base stage snapshotted for other instances - only the versions
+        the image is matched on, without any setting or secret of the instance
         """
-        Run a playbook against the instance active servers
+        template = loader.get_template('instance/ansible/snapshot_vars.yml')
+        return template.render({'instance': self})
+
+    @contextmanager
+    def prepare_configuration(self):
+        """
+        Check out the configuration repository, and prepare the ansible venv for its requirements
+
+        Yields a `(playbook_path, venv_path, cache_hit)` tuple, valid until the context is exited.
+        Doesn't access the database, so it can run in a separate thread while the servers boot.
         """
         with open_repository(self.ansible_source_repo_url,
                              ref=self.configuration_version) as configuration_repo:
             playbook_path = os.path.join(configuration_repo.working_dir, 'playbooks')
             requirements_path = os.path.join(configuration_repo.working_dir, 'requirements.txt')
-
-            self.log('info', 'Running playbook "{path}/{name}" for instance {instance}...'.format(
-                path=playbook_path,
-                name=playbook_name,
-                instance=self,
-            ))
-
-            log_lines = []
+            with ansible.get_venv(requirements_path) as (venv_path, cache_hit):
+                yield playbook_path, venv_path, cache_hit
+
+    def run_playbook(self, playbook_name=None, configuration=None, vars_str=None, tags=None, inventory_str=None,
+                     skip_tags=None):
+        """
+        Run a playbook against the instance servers being provisioned, or against the servers of
+        `inventory_str` - only the tasks matching `tags`, if specified, and none matching `skip_tags`
+
+        The configuration checkout (see `prepare_configuration()`) and the vars can be prepared
+        beforehand - otherwise they are prepared here
+        """
+        if configuration is None:
+            with self.prepare_configuration() as configuration:
+                return self.run_playbook(playbook_name, configuration=configuration, vars_str=vars_str, tags=tags,
+                                         inventory_str=inventory_str, skip_tags=skip_tags)
+        if vars_str is None:
+            vars_str = self.vars_str
+        if inventory_str is None:
+            inventory_str = self.inventory_str
+
+        playbook_path, venv_path, cache_hit = configuration
+        self.log('info', 'Running playbook "{path}/{name}" for instance {instance}...'.format(
+            path=playbook_path,
+            name=playbook_name,
+            instance=self,
+        ))
+        self.log('info', 'Using {cache_status} ansible venv {path} (cache hits={hits}, misses={misses})'.format(
+            cache_status='cached' if cache_hit else 'new',
+            path=venv_path,
+            **ansible.get_venv_cache_stats()
+        ))
+
+        # The output lines are saved in batches - the buffer is also flushed while ansible is silent
+        log_lines = []
+        line_iterator = None
+        try:
             with ansible.run_playbook(
-                requirements_path,
-                self.inventory_str,
-                self.vars_str,
+                venv_path,
+                inventory_str,
+                vars_str,
                 playbook_path,
                 self.ansible_playbook_filename,
                 username=settings.OPENSTACK_SANDBOX_SSH_USERNAME,
-            ) as processus:
-                for line in processus.stdout:
+                tags=tags,
+                skip_tags=skip_tags,
+            ) as processus, LogEntryBuffer(self) as log_buffer:
+                line_iterator = read_lines(processus.stdout, timeout=log_buffer.max_delay)
+                for line in line_iterator:
+                    if line is None:
+                        log_buffer.flush_if_due()
+                        continue
                     line = line.decode('utf-8').rstrip()
-                    self.log('info', line)
-                    log_lines.append([line.rstrip()])
+                    log_buffer.log('info', line)
+                    log_lines.append([line])
+        finally:
+            # On errors, the reader thread can only be joined once ansible has been killed, closing its output
+            if line_iterator is not None:
+                line_iterator.close()
 
         self.log('info', 'Playbook run completed for instance {}'.format(self))
         return log_lines
@@ -426,6 +524,10 @@ class OpenEdXInstance(AnsibleInstanceMixin, GitHubInstanceMixin, LoggerInstanceM
 
     ANSIBLE_SETTINGS = AnsibleInstanceMixin.ANSIBLE_SETTINGS + ['ansible_s3_settings']
 
+    # Maximum time spent waiting for the new server during a provisioning, in seconds - below the
+    # scheduler's `ADMITTED_TIMEOUT`, after which a provisioning is considered lost
+    PROVISIONING_TIMEOUT = 3 * 3600
+
     class Meta:
         verbose_name = 'Open edX Instance'
         ordering = ['-created']
@@ -476,41 +578,168 @@ class OpenEdXInstance(AnsibleInstanceMixin, GitHubInstanceMixin, LoggerInstanceM
         """
         return u'{0.protocol}://{0.studio_domain}/'.format(self)
 
+    def set_dns_records(self, server):
+        """
+        Point the LMS & Studio domains of the instance to the server
+        """
+        self.log('info', 'Updating DNS for instance {}: LMS at {}, Studio at {}...'.format(
+            self, self.domain, self.studio_domain))
+        gandi.set_dns_records([
+            dict(type='A', name=self.sub_domain, value=server.public_ip),
+            dict(type='CNAME', name=self.studio_sub_domain, value=self.sub_domain),
+        ])
+
     @log_exception
     def provision(self):
         """
         Run the provisioning sequence of the instance, recreating the servers from scratch
 
+        With `settings.BLUE_GREEN_PROVISIONING`, a ready current server is kept live until the new
+        server is ready, then the DNS records are switched to the new server and the old one is terminated
+
+        With `settings.OPENSTACK_SANDBOX_SNAPSHOTS`, the new server is booted from the best-matching
+        image when there is one, and only the deployment tasks of the playbook are run - otherwise, the
+        base stage of the playbook is run & snapshotted first, for the next instances using the same versions
+
         Returns: (server, ansible_log)
         """
         self.last_provisioning_started = timezone.now()
-        self.save()
+        self.save_fields('last_provisioning_started')
+        deadline = time.time() + self.PROVISIONING_TIMEOUT
 
         # Server
-        self.log('info', 'Terminate servers for instance {}...'.format(self))
-        self.server_set.terminate()
+        previous_server = self.current_server
+        if settings.BLUE_GREEN_PROVISIONING and previous_server is not None \
+                and previous_server.status in (previous_server.READY, previous_server.LIVE):
+            self.log('info', 'Keeping server {} live while the new server of instance {} is provisioned'.format(
+                previous_server, self))
+            self.server_set.exclude(pk=previous_server.pk).terminate()
+        else:
+            previous_server = None
+            self.log('info', 'Terminate servers for instance {}...'.format(self))
+            self.server_set.terminate()
+        image = None
+        if settings.OPENSTACK_SANDBOX_SNAPSHOTS:
+            image = ServerImage.objects.find_for_instance(self)
+        if image is not None:
+            image.mark_used()
         self.log('info', 'Start new server for instance {}...'.format(self))
         server = self.server_set.create()
-        server.start()
-
-        # DNS
-        self.log('info', 'Waiting for IP assignment on server {}...'.format(server))
-        server.sleep_until_status([server.ACTIVE, server.BOOTED])
-        self.log('info', 'Updating DNS for instance {}: LMS at {}...'.format(self, self.domain))
-        gandi.set_dns_record(type='A', name=self.sub_domain, value=server.public_ip)
-        self.log('info', 'Updating DNS for instance {}: Studio at {}...'.format(self, self.studio_domain))
-        gandi.set_dns_record(type='CNAME', name=self.studio_sub_domain, value=self.sub_domain)
-
-        # Provisioning (ansible)
-        self.log('info', 'Waiting for SSH to become available on server {}...'.format(server))
-        server.sleep_until_status(server.BOOTED)
-        ansible_log = self.run_playbook()
+        try:
+            ansible_log = self._provision_server(server, image, previous_server, deadline)
+        except Exception:
+            # A failed next server would otherwise become the status of the instance, while the
+            # previous server is still live
+            if previous_server is not None:
+                self.log('error', 'Provisioning of server {} failed, terminating it - server {} stays live'.format(
+                    server, previous_server))
+                server.terminate()
+            raise
+
+        # Switch from the previous server
+        if previous_server is not None:
+            self.set_dns_records(server)
+            self.log('info', 'Terminating previous server {} of instance {}...'.format(previous_server, self))
+            previous_server.terminate()
+
+        self.log('info', 'Provisioning completed for instance {}'.format(self))
+
+        return (server, ansible_log)
+
+    def _provision_server(self, server, image, previous_server, deadline):
+        """
+        Boot and provision the new `server` of the instance, until it is ready
+
+        The DNS records are only pointed to the server here when there is no `previous_server` kept live
+
+        Returns: ansible_log
+        """
+        server.start(image=image)
+
+        # The configuration checkout, the ansible venv and the vars don't depend on the server, so they
+        # are prepared while it boots. The checkout is removed once the stack exits, after the thread is done.
+        with ExitStack() as configuration_stack:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                configuration_future = executor.submit(configuration_stack.enter_context,
+                                                       self.prepare_configuration())
+                vars_str = self.vars_str
+
+                # DNS - when the previous server is kept live, it is only switched once the new server is ready
+                self.log('info', 'Waiting for IP assignment on server {}...'.format(server))
+                server.sleep_until_status([server.ACTIVE, server.BOOTED], deadline=deadline)
+                if previous_server is None:
+                    self.set_dns_records(server)
+
+                # Provisioning (ansible)
+                self.log('info', 'Waiting for SSH to become available on server {}...'.format(server))
+                server.sleep_until_status(server.BOOTED, deadline=deadline)
+                if not configuration_future.done():
+                    self.log('info', 'Waiting for the configuration checkout of instance {}...'.format(self))
+                configuration = configuration_future.result()
+                base_log = []
+                tags = None
+                if image is not None:
+                    tags = settings.ANSIBLE_SNAPSHOT_DEPLOY_TAGS
+                elif settings.OPENSTACK_SANDBOX_SNAPSHOTS and not ServerImage.objects.filter_versions(self).exists():
+                    base_log = self.snapshot_base_stage(server, configuration, deadline)
+                    tags = settings.ANSIBLE_SNAPSHOT_DEPLOY_TAGS
+                ansible_log = base_log + self.run_playbook(configuration=configuration, vars_str=vars_str, tags=tags)
         server.update_status(provisioned=True)
 
         # Reboot
         self.log('info', 'Rebooting server {}...'.format(server))
         server.reboot()
-        server.sleep_until_status(server.READY)
-        self.log('info', 'Provisioning completed for instance {}'.format(self))
+        server.sleep_until_status(server.READY, deadline=deadline)
+
+        return ansible_log
+
+    def snapshot_base_stage(self, server, configuration, deadline=None):
+        """
+        Run the base stage of the playbook on the new `server` - all the tasks but the deployment ones,
+        with the generic vars only - and snapshot it, before any setting or secret of the instance is applied
+
+        Returns: ansible_log
+        """
+        self.log('info', 'Running the base stage of the playbook on server {}, to snapshot it...'.format(server))
+        ansible_log = self.run_playbook(configuration=configuration, vars_str=self.snapshot_vars_str,
+                                        skip_tags=settings.ANSIBLE_SNAPSHOT_DEPLOY_TAGS)
+        image = ServerImage.objects.create_from_server(server)
+        if image is not None:
+            # The instance vars are only applied once the disk of the server has been captured
+            image.sleep_until_saved(server.nova, deadline=deadline)
+        return ansible_log
+
+    @property
+    def redeployable_server(self):
+        """
+        The server which can be redeployed (see `redeploy()`) - the current server, when it is ready
+        and not being replaced - or None
+        """
+        current_server = self.current_server
+        if current_server is None or self.next_server is not None \
+                or current_server.status not in (current_server.READY, current_server.LIVE):
+            return None
+        return current_server
+
+    @log_exception
+    def redeploy(self):
+        """
+        Deploy the current `commit_id` on the ready server of the instance, only running the playbook
+        tasks tagged with `settings.ANSIBLE_REDEPLOY_TAGS` - the server isn't recreated nor rebooted,
+        and the DNS records are left untouched
+
+        Returns: (server, ansible_log)
+        """
+        server = self.redeployable_server
+        if server is None:
+            raise InstanceNotReady('Instance {} has no ready server to redeploy'.format(self))
+
+        self.log('info', 'Redeploying commit {} on server {} of instance {}...'.format(
+            self.commit_short_id, server, self))
+        ansible_log = self.run_playbook(
+            tags=settings.ANSIBLE_REDEPLOY_TAGS,
+            inventory_str=self.get_inventory_str([server]),
+        )
+        self.log('info', 'Redeployment completed for instance {}'.format(self))
 
         return (server, ansible_log)
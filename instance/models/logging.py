@@ -22,11 +22,14 @@ Instance app models - Logging
 
 # Imports #####################################################################
 
+import heapq
 import logging
 
+from collections import OrderedDict
+
 from swampdragon.pubsub_providers.data_publisher import publish_data
 
-from django.db import models
+from django.db import connections, models
 from django.db.models import query
 from django_extensions.db.models import TimeStampedModel
 
@@ -48,6 +51,26 @@ LOG_LEVEL_CHOICES = (
 )
 
 
+# Number of log entries loaded with each query, when reading a merged log
+LOG_ENTRY_LOAD_BATCH_SIZE = 500
+
+# Published entries of an instance log & of the logs of all its servers - each log sorted by ids
+MERGED_LOG_SQL = (
+    'SELECT source, id, created FROM ('
+    'SELECT 0 AS source, entry.id AS id, entry.created AS created FROM {instance_log_table} AS entry '
+    'WHERE entry.instance_id = %s AND entry.id > %s AND entry.id <= %s '
+    'AND entry.level IN ({level_list}){since_condition} '
+    'ORDER BY entry.id{limit_clause}) AS instance_log '
+    'UNION ALL '
+    'SELECT source, id, created FROM ('
+    'SELECT 1 AS source, entry.id AS id, entry.created AS created FROM {server_log_table} AS entry '
+    'INNER JOIN {server_table} AS instance_server ON instance_server.id = entry.server_id '
+    'WHERE instance_server.instance_id = %s AND entry.id > %s AND entry.id <= %s '
+    'AND entry.level IN ({level_list}){since_condition} '
+    'ORDER BY entry.id{limit_clause}) AS server_log'
+)
+
+
 # Logging #####################################################################
 
 logger = logging.getLogger(__name__)
@@ -60,10 +83,26 @@ class LogEntryQuerySet(query.QuerySet):
     Additional methods for LogEntry querysets
     Also used as the standard manager for the model (`LogEntry.objects`)
     """
-    def create(self, publish=True, *args, **kwargs):
-        log_entry = super().create(*args, **kwargs)
+    def create(self, publish=True, **kwargs):
+        """
+        Augmented `create()` method - log entries are only created internally, so they aren't validated
+        """
+        log_entry = self.model(**kwargs)
+        log_entry.save(force_insert=True, using=self.db, validate=False)
         if publish:
             log_entry.publish()
+        return log_entry
+
+    def bulk_create(self, objs, publish=True, **kwargs): #pylint: disable=arguments-differ
+        """
+        Augmented `bulk_create()` method - publishes the entries with a single message per instance
+
+        Like with the standard `bulk_create()`, the entries aren't validated
+        """
+        log_entry_list = super().bulk_create(objs, **kwargs)
+        if publish:
+            self.model.publish_batch(log_entry_list)
+        return log_entry_list
 
 
 class LogEntry(ValidateModelMixin, TimeStampedModel):
@@ -108,6 +147,98 @@ class LogEntry(ValidateModelMixin, TimeStampedModel):
                 'log_entry': str(self),
             })
 
+    @staticmethod
+    def publish_batch(log_entry_list):
+        """
+        Publish log entries to the messaging system, with a single message per instance
+        """
+        instance_log_dict = OrderedDict()
+        for log_entry in log_entry_list:
+            logger.log(log_entry.level_integer, log_entry.text)
+            if log_entry.level in PUBLISHED_LOG_LEVEL_SET:
+                instance_log_dict.setdefault(log_entry.instance.pk, []).append(str(log_entry))
+
+        for instance_id, instance_log_entry_list in instance_log_dict.items():
+            publish_data('log', {
+                'type': 'instance_log_batch',
+                'instance_id': instance_id,
+                'log_entries': instance_log_entry_list,
+            })
+
+
+class InstanceLogEntryQuerySet(LogEntryQuerySet):
+    """
+    Additional methods for InstanceLogEntry querysets
+    Also used as the standard manager for the model (`InstanceLogEntry.objects`)
+    """
+    def get_merged_log(self, instance, cursor=None, since=None, limit=None):
+        """
+        Published entries of the instance log & of the logs of all its servers, including the terminated ones,
+        in chronological order - read with a single UNION query, each log in order of ids, and merged by date
+
+        Entries can be saved after more recent ones (see `LogEntryBuffer`), so the logs are paginated by
+        ids: a page always holds all the entries of each log up to the last one it includes.
+
+        Only the entries after `cursor`, as returned by a previous call, and created after the `since`
+        datetime are included - at most `limit` of them. The entries are loaded in batches while they
+        are iterated over.
+
+        Returns `(log_entry_iterator, next_cursor)`, where the cursor is a
+        `(last_instance_entry_id, last_server_entry_id)` tuple
+        """
+        instance_entry_id, server_entry_id = cursor or (0, 0)
+
+        # Entries logged while the log is being read are left for the next cursor
+        last_instance_entry_id = self.model.objects.filter(instance=instance)\
+            .aggregate(last_id=models.Max('pk'))['last_id'] or instance_entry_id
+        last_server_entry_id = ServerLogEntry.objects.filter(server__instance=instance)\
+            .aggregate(last_id=models.Max('pk'))['last_id'] or server_entry_id
+
+        connection = connections[self.db]
+        branch_params = list(PUBLISHED_LOG_LEVEL_SET)
+        if since is not None:
+            branch_params.append(connection.ops.value_to_db_datetime(since))
+        if limit is not None:
+            branch_params.append(limit)
+        params = [instance.pk, instance_entry_id, last_instance_entry_id] + branch_params
+        params += [instance.pk, server_entry_id, last_server_entry_id] + branch_params
+        #pylint: disable=protected-access
+        sql = MERGED_LOG_SQL.format(
+            instance_log_table=connection.ops.quote_name(self.model._meta.db_table),
+            server_log_table=connection.ops.quote_name(ServerLogEntry._meta.db_table),
+            server_table=connection.ops.quote_name(OpenStackServer._meta.db_table),
+            level_list=', '.join(['%s'] * len(PUBLISHED_LOG_LEVEL_SET)),
+            since_condition=' AND entry.created > %s' if since is not None else '',
+            limit_clause=' LIMIT %s' if limit is not None else '',
+        )
+        with connection.cursor() as db_cursor:
+            db_cursor.execute(sql, params)
+            source_row_list = [[], []]
+            for source, entry_id, created in db_cursor.fetchall():
+                source_row_list[source].append((created, source, entry_id))
+
+        # The merge keeps the order of ids within each log, so a full page ends on the last entry read from each
+        row_list = list(heapq.merge(*source_row_list))[:limit]
+        if limit is not None and len(row_list) == limit:
+            last_instance_entry_id = max([entry_id for _, source, entry_id in row_list if source == 0]
+                                         or [instance_entry_id])
+            last_server_entry_id = max([entry_id for _, source, entry_id in row_list if source == 1]
+                                       or [server_entry_id])
+        return self._iterate_log_entries(row_list), (last_instance_entry_id, last_server_entry_id)
+
+    def _iterate_log_entries(self, row_list):
+        """
+        Load the log entries of `(created, source, id)` rows from the merged log, in batches
+        """
+        for offset in range(0, len(row_list), LOG_ENTRY_LOAD_BATCH_SIZE):
+            batch_row_list = row_list[offset:offset + LOG_ENTRY_LOAD_BATCH_SIZE]
+            log_entry_dict_list = [
+                self.model.objects.in_bulk([entry_id for _, source, entry_id in batch_row_list if source == 0]),
+                ServerLogEntry.objects.in_bulk([entry_id for _, source, entry_id in batch_row_list if source == 1]),
+            ]
+            for _, source, entry_id in batch_row_list:
+                yield log_entry_dict_list[source][entry_id]
+
 
 class InstanceLogEntry(LogEntry):
     """
@@ -115,8 +246,11 @@ class InstanceLogEntry(LogEntry):
     """
     instance = models.ForeignKey(OpenEdXInstance, related_name='logentry_set')
 
+    objects = InstanceLogEntryQuerySet().as_manager()
+
     class Meta:
         verbose_name_plural = "Instance Log Entries"
+        index_together = (('instance', 'id'),)
 
 
 class ServerLogEntry(LogEntry):
@@ -127,6 +261,7 @@ class ServerLogEntry(LogEntry):
 
     class Meta:
         verbose_name_plural = "Server Log Entries"
+        index_together = (('server', 'id'),)
 
     @property
     def instance(self):
@@ -23,8 +23,7 @@ Instance app models - Logging - Mixins
 # Imports #####################################################################
 
 import logging
-
-from functools import partial
+import time
 
 from django.db import models
 
@@ -36,12 +35,82 @@ from instance.models.logging_utils import level_to_integer
 # TODO: Don't propagate exceptions & debug data to end users
 PUBLISHED_LOG_LEVEL_SET = ('info', 'warn', 'error', 'exception')
 
+# Maximum number of entries kept in a `LogEntryBuffer` before they are saved
+LOG_BUFFER_MAX_COUNT = 100
+
+# Maximum time during which entries are kept in a `LogEntryBuffer` before they are saved, in seconds
+LOG_BUFFER_MAX_DELAY = 0.5
+
 
 # Logging #####################################################################
 
 logger = logging.getLogger(__name__)
 
 
+# Classes #####################################################################
+
+class LogEntryBuffer:
+    """
+    Accumulates the log entries of a `LoggerMixin` object, to save them with a single `bulk_create()`
+    query & publish them with a single message - when `max_count` entries are buffered, or when the
+    oldest one has been buffered for `max_delay` seconds
+
+    Use it as a context manager, to save the remaining entries when the context exits, even on exceptions.
+    The time limit is only checked when an entry is added - call `flush_if_due()` while no entries are added.
+    """
+    def __init__(self, logger_object, max_count=LOG_BUFFER_MAX_COUNT, max_delay=LOG_BUFFER_MAX_DELAY):
+        self.logger_object = logger_object
+        self.max_count = max_count
+        self.max_delay = max_delay
+        self.log_entry_list = []
+        self.first_entry_time = None
+
+        # Foreign key from the log entries to the logger object
+        self.log_entry_model = logger_object.logentry_set.model
+        self.foreign_key_name = next(
+            field.name for field in self.log_entry_model._meta.fields #pylint: disable=protected-access
+            if isinstance(field, models.ForeignKey) and isinstance(logger_object, field.rel.to)
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def log(self, level, text):
+        """
+        Add an entry to the buffer, saving the buffered entries when a limit is reached
+        """
+        if not self.log_entry_list:
+            self.first_entry_time = time.time()
+        self.log_entry_list.append(self.log_entry_model(
+            level=level,
+            text=text.rstrip(),
+            **{self.foreign_key_name: self.logger_object}
+        ))
+        if len(self.log_entry_list) >= self.max_count:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        """
+        Save the buffered entries if the oldest one has been buffered for `max_delay` seconds
+        """
+        if self.log_entry_list and time.time() - self.first_entry_time >= self.max_delay:
+            self.flush()
+
+    def flush(self):
+        """
+        Save & publish the buffered entries
+        """
+        if not self.log_entry_list:
+            return
+        log_entry_list, self.log_entry_list = self.log_entry_list, []
+        self.log_entry_model.objects.bulk_create(log_entry_list)
+
+
 # Models ######################################################################
 
 class LoggerMixin(models.Model):
@@ -70,42 +139,20 @@ class LoggerInstanceMixin(LoggerMixin):
     class Meta:
         abstract = True
 
+    def get_log_entries(self, cursor=None, since=None, limit=None):
+        """
+        Published entries of the instance log & of the logs of all its servers, including the terminated ones,
+        in chronological order
+
+        Returns `(log_entry_iterator, next_cursor)` - see `InstanceLogEntryQuerySet.get_merged_log()`
+        """
+        return self.logentry_set.model.objects.get_merged_log(self, cursor=cursor, since=since, limit=limit)
+
     @property
     def log_text(self):
         """
-        Combines the instance and server log outputs in chronological order
-        Currently only supports one non-terminated server at a time
+        Combines the instance and servers log outputs in chronological order
         Returned as a text string
         """
-        current_server = self.active_server_set.get()
-        server_logentry_set = current_server.logentry_set.filter(level__in=PUBLISHED_LOG_LEVEL_SET)\
-                                                         .order_by('pk')\
-                                                         .iterator()
-        instance_logentry_set = self.logentry_set.filter(level__in=PUBLISHED_LOG_LEVEL_SET)\
-                                                 .order_by('pk')\
-                                                 .iterator()
-
-        next_server_logentry = partial(next, server_logentry_set, None)
-        next_instance_logentry = partial(next, instance_logentry_set, None)
-
-        log_text = ''
-        instance_logentry = next_instance_logentry()
-        server_logentry = next_server_logentry()
-
-        while instance_logentry is not None and server_logentry is not None:
-            if server_logentry.created < instance_logentry.created:
-                log_text += '{}\n'.format(server_logentry)
-                server_logentry = next_server_logentry()
-            else:
-                log_text += '{}\n'.format(instance_logentry)
-                instance_logentry = next_instance_logentry()
-
-        while instance_logentry is not None:
-            log_text += '{}\n'.format(instance_logentry)
-            instance_logentry = next_instance_logentry()
-
-        while server_logentry is not None:
-            log_text += '{}\n'.format(server_logentry)
-            server_logentry = next_server_logentry()
-
-        return log_text
+        log_entry_iterator, _ = self.get_log_entries()
+        return ''.join('{}\n'.format(logentry) for logentry in log_entry_iterator)
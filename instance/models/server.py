@@ -22,24 +22,33 @@ Instance app models - Server
 
 # Imports #####################################################################
 
+import logging
 import novaclient
 import time
 
+from datetime import timedelta
+
 from swampdragon.pubsub_providers.data_publisher import publish_data
 
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Q
 from django.db.models.signals import post_save
+from django.utils import timezone
 from django_extensions.db.models import TimeStampedModel
 
 from instance import openstack
-from instance.utils import is_port_open, to_json
+from instance.utils import SSH_BANNER, check_ports, is_port_open, to_json
 from instance.models.instance import OpenEdXInstance
 from instance.models.logging_mixin import LoggerMixin
 from instance.models.utils import ValidateModelMixin
 
 
+# Logging #####################################################################
+
+logger = logging.getLogger(__name__)
+
+
 # Exceptions ##################################################################
 
 class ServerNotReady(Exception):
@@ -49,6 +58,13 @@ class ServerNotReady(Exception):
     pass
 
 
+class ServerStatusTimeout(Exception):
+    """
+    Raised when a server doesn't reach the expected status in time
+    """
+    pass
+
+
 # Models ######################################################################
 
 class ServerQuerySet(models.QuerySet):
@@ -72,6 +88,111 @@ class ServerQuerySet(models.QuerySet):
         return self.filter(~Q(status=Server.TERMINATED))
 
 
+class OpenStackServerQuerySet(ServerQuerySet):
+    """
+    Additional methods for OpenStack server querysets
+    Also used as the standard manager for the OpenStackServer model (`OpenStackServer.objects`)
+    """
+    def update_status(self):
+        """
+        Reconcile the status of the servers of the queryset with their state on the OpenStack side
+
+        Lists all servers with paged nova API calls and checks SSH availability concurrently, then
+        applies all status changes in a single transaction. Servers which have been deleted from
+        OpenStack outside of our control are marked as terminated.
+
+        Servers waiting in `sleep_until_status()` pick up the new status from the database
+        Returns the list of servers whose status has changed
+        """
+        server_list = list(self.exclude(status__in=(Server.NEW, Server.TERMINATED)).exclude(openstack_id=''))
+        if not server_list:
+            return []
+
+        os_server_dict, deleted_openstack_id_set = self._get_os_servers(openstack.get_nova_client(), server_list)
+
+        # Check SSH availability for the servers waiting for it, concurrently
+        reboot_grace_limit = timezone.now() - timedelta(seconds=Server.REBOOT_GRACE_PERIOD)
+        probe_server_list = [
+            server for server in server_list
+            if server.openstack_id in os_server_dict and (
+                server.status == Server.ACTIVE
+                or (server.status == Server.REBOOTING and server.modified < reboot_grace_limit)
+            )
+        ]
+        #pylint: disable=protected-access
+        probe_address_dict = {
+            server.pk: (server._get_public_ip(os_server_dict[server.openstack_id]), 22)
+            for server in probe_server_list
+        }
+        port_open_result = check_ports(set(probe_address_dict.values()), expected_banner=SSH_BANNER)
+        port_open_dict = {pk: port_open_result[address] for pk, address in probe_address_dict.items()}
+
+        transition_dict = {}
+        for server in server_list:
+            os_server = os_server_dict.get(server.openstack_id)
+            if os_server is None:
+                if server.openstack_id not in deleted_openstack_id_set:
+                    continue
+                new_status = Server.TERMINATED
+            elif server.status == Server.STARTED and os_server.status == 'ACTIVE':
+                new_status = Server.ACTIVE
+            elif server.status == Server.ACTIVE and port_open_dict.get(server.pk):
+                new_status = Server.BOOTED
+            elif server.status == Server.REBOOTING and port_open_dict.get(server.pk):
+                new_status = Server.READY
+            else:
+                continue
+            transition_dict.setdefault((server.status, new_status), []).append(server.pk)
+
+        return self._apply_status_transitions(transition_dict)
+
+    @staticmethod
+    def _get_os_servers(nova, server_list):
+        """
+        Fetch the OpenStack servers of `server_list`
+
+        Listings can be incomplete (eg. eventually consistent), so each server missing from the listing
+        is fetched individually, and only considered deleted when nova doesn't find it
+
+        Returns `(os_server_dict, deleted_openstack_id_set)`, with `os_server_dict` indexed by OpenStack id
+        """
+        os_server_dict = {os_server.id: os_server for os_server in openstack.list_servers(nova)}
+        deleted_openstack_id_set = set()
+        for openstack_id in {server.openstack_id for server in server_list} - set(os_server_dict):
+            try:
+                os_server_dict[openstack_id] = nova.servers.get(openstack_id)
+            except novaclient.exceptions.NotFound:
+                deleted_openstack_id_set.add(openstack_id)
+            except novaclient.exceptions.ClientException:
+                logger.exception('Could not check whether OpenStack server %s still exists', openstack_id)
+        return os_server_dict, deleted_openstack_id_set
+
+    def _apply_status_transitions(self, transition_dict):
+        """
+        Apply the status changes from `transition_dict`, a dict of `(old_status, new_status): [server_pk, ...]`
+
+        Servers whose status has been changed by another process in the meantime are skipped
+        """
+        changed_server_list = []
+        with transaction.atomic():
+            for (old_status, new_status), pk_list in transition_dict.items():
+                locked_qs = self.model.objects.select_for_update().filter(pk__in=pk_list, status=old_status)
+                locked_server_list = list(locked_qs)
+                self.model.objects.filter(pk__in=[server.pk for server in locked_server_list])\
+                                  .update(status=new_status, modified=timezone.now())
+                for server in locked_server_list:
+                    server.status = new_status
+                    changed_server_list.append(server)
+
+        for server in changed_server_list:
+            if server.status == Server.TERMINATED:
+                server.log('warn', 'Server {} was not found on OpenStack, it has been terminated'.format(server))
+            else:
+                server.log('info', 'Changed status for {}: {}'.format(server, server.status))
+            Server.on_post_save(self.model, server, created=False)
+        return changed_server_list
+
+
 class Server(ValidateModelMixin, TimeStampedModel, LoggerMixin):
     """
     A single server VM
@@ -104,6 +225,23 @@ class Server(ValidateModelMixin, TimeStampedModel, LoggerMixin):
         (TERMINATED, 'Terminated - Stopped forever'),
     )
 
+    # Time during which SSH can still be available after a reboot has been requested, in seconds
+    REBOOT_GRACE_PERIOD = 30
+
+    # Delay between two status checks while waiting for a status, in seconds
+    # It increases exponentially from the min to the max value as the wait goes on
+    STATUS_POLL_INTERVAL_MIN = 1
+    STATUS_POLL_INTERVAL_MAX = 10
+    STATUS_POLL_BACKOFF_FACTOR = 1.5
+
+    # Maximum time to wait for a server to reach a status, in seconds
+    STATUS_TIMEOUT_DEFAULT = 1800
+    STATUS_TIMEOUTS = {
+        ACTIVE: 600,
+        BOOTED: 900,
+        READY: 900,
+    }
+
     instance = models.ForeignKey(OpenEdXInstance, related_name='server_set')
     status = models.CharField(max_length=11, default=NEW, choices=STATUS_CHOICES, db_index=True)
 
@@ -121,21 +259,50 @@ class Server(ValidateModelMixin, TimeStampedModel, LoggerMixin):
 
         self.status = status
         self.log('info', 'Changed status for {}: {}'.format(self, self.status))
-        self.save()
+        self.save_fields('status')
         return self.status
 
-    def sleep_until_status(self, target_status):
+    def get_status_timeout(self, target_status_list):
+        """
+        Maximum time to wait for the server to reach one of the statuses of `target_status_list`
+        """
+        return max(self.STATUS_TIMEOUTS.get(status, self.STATUS_TIMEOUT_DEFAULT) for status in target_status_list)
+
+    def sleep_until_status(self, target_status, timeout=None, deadline=None):
         """
         Sleep in a loop until the server reaches one of the specified status
+
+        The status is checked with an exponential backoff. With `settings.SERVER_STATUS_RECONCILER`,
+        the status is only reloaded from the database, where the periodic reconciliation of all
+        servers saves it (see `OpenStackServerQuerySet.update_status()`) - otherwise, each check
+        queries OpenStack for the server.
+
+        Raises `ServerStatusTimeout` when the status isn't reached after `timeout` seconds (by default
+        depending on the target status, see `STATUS_TIMEOUTS`) or after the `deadline` timestamp
         """
         target_status_list = [target_status] if isinstance(target_status, str) else target_status
         self.log('info', 'Waiting for server {} to reach status {}...'.format(self, target_status_list))
 
+        if timeout is None:
+            timeout = self.get_status_timeout(target_status_list)
+        end_time = time.time() + timeout
+        if deadline is not None:
+            end_time = min(end_time, deadline)
+
+        interval = self.STATUS_POLL_INTERVAL_MIN
         while True:
-            self.update_status()
-            if self.status in target_status:
+            if settings.SERVER_STATUS_RECONCILER:
+                self.refresh_from_db(fields=['status'])
+            else:
+                self.update_status()
+            if self.status in target_status_list:
                 break
-            time.sleep(1)
+            if time.time() >= end_time:
+                raise ServerStatusTimeout('Server {} did not reach status {} in time (current: {})'.format(
+                    self, target_status_list, self.status))
+
+            time.sleep(interval)
+            interval = min(interval * self.STATUS_POLL_BACKOFF_FACTOR, self.STATUS_POLL_INTERVAL_MAX)
         return self.status
 
     @staticmethod
@@ -161,9 +328,11 @@ class OpenStackServer(Server):
     """
     openstack_id = models.CharField(max_length=250, db_index=True, blank=True)
 
+    objects = OpenStackServerQuerySet().as_manager()
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.nova = openstack.get_nova_client()
+        self._nova = None
 
     def __str__(self):
         if self.openstack_id:
@@ -171,6 +340,22 @@ class OpenStackServer(Server):
         else:
             return 'New OpenStack Server'
 
+    @property
+    def nova(self):
+        """
+        Nova client - shared with the other servers of the current thread, unless explicitly set
+        """
+        if self._nova is not None:
+            return self._nova
+        return openstack.get_nova_client()
+
+    @nova.setter
+    def nova(self, nova):
+        """
+        Use a specific nova client for this server
+        """
+        self._nova = nova
+
     @property
     def os_server(self):
         """
@@ -188,29 +373,43 @@ class OpenStackServer(Server):
         """
         if not self.openstack_id:
             return None
+        return self._get_public_ip(self.os_server)
 
-        public_addr = openstack.get_server_public_address(self.os_server)
+    @staticmethod
+    def _get_public_ip(os_server):
+        """
+        Return one of the public address(es) of a nova server
+        """
+        public_addr = openstack.get_server_public_address(os_server)
         if not public_addr:
             return None
 
         return public_addr['addr']
 
-    def update_status(self, provisioned=False, rebooting=False):
+    def _is_ssh_available(self, os_server):
+        """
+        Check if the SSH server of a nova server is answering
+        """
+        return is_port_open(self._get_public_ip(os_server), 22, expected_banner=SSH_BANNER)
+
+    def update_status(self, provisioned=False, rebooting=False, os_server=None): #pylint: disable=arguments-differ
         """
         Refresh the status by querying the openstack server via nova
+
+        `os_server` can be passed when it has already been fetched from nova, to avoid another API call
         """
         # TODO: Check when server is stopped or terminated
-        os_server = self.os_server
-        self.log('debug', 'Updating status for {} from nova (currently {}):\n{}'.format(
-            self, self.status, to_json(os_server)))
+        if os_server is None:
+            os_server = self.os_server
+        # Not stored as a log entry, as it is called repeatedly while waiting for a status
+        logger.debug('Updating status for %s from nova (currently %s):\n%s', self, self.status, to_json(os_server))
 
         if self.status == self.STARTED:
-            self.log('debug', 'Server {}: loaded="{}" status="{}"'.format(
-                self, os_server._loaded, os_server.status))
+            logger.debug('Server %s: loaded="%s" status="%s"', self, os_server._loaded, os_server.status)
             if os_server._loaded and os_server.status == 'ACTIVE':
                 self._set_status(self.ACTIVE)
 
-        elif self.status == self.ACTIVE and is_port_open(self.public_ip, 22):
+        elif self.status == self.ACTIVE and self._is_ssh_available(os_server):
             self._set_status(self.BOOTED)
 
         elif self.status == self.BOOTED and provisioned:
@@ -219,28 +418,36 @@ class OpenStackServer(Server):
         elif self.status in (self.PROVISIONED, self.READY) and rebooting:
             self._set_status(self.REBOOTING)
 
-        elif self.status == self.REBOOTING and not rebooting and is_port_open(self.public_ip, 22):
+        elif self.status == self.REBOOTING and not rebooting and self._is_ssh_available(os_server):
             self._set_status(self.READY)
 
         return self.status
 
-    def start(self):
+    def start(self, image=None):
         """
-        Get a server instance started and an openstack_id assigned
+        Get a server instance started and an openstack_id assigned - booted from `image` (a `ServerImage`)
+        when specified, otherwise from the base image
+
+        Quota limitations are handled upstream, by the provisioning scheduler (see `instance.scheduler`)
 
-        TODO: Add handling of quota limitations & waiting list
         TODO: Create the key dynamically
         """
         self.log('info', 'Starting server {} (status={})...'.format(self, self.status))
         if self.status == self.NEW:
+            if image is None:
+                image_selector = settings.OPENSTACK_SANDBOX_BASE_IMAGE
+            else:
+                self.log('info', 'Booting server {} from image {}'.format(self, image))
+                image_selector = {'id': image.openstack_image_id}
             os_server = openstack.create_server(
                 self.nova,
                 self.instance.sub_domain,
                 settings.OPENSTACK_SANDBOX_FLAVOR,
-                settings.OPENSTACK_SANDBOX_BASE_IMAGE,
+                image_selector,
                 key_name=settings.OPENSTACK_SANDBOX_SSH_KEYNAME,
             )
             self.openstack_id = os_server.id
+            self.save_fields('openstack_id')
             self.log('info', 'Server {} got assigned OpenStack id {}'.format(self, self.openstack_id))
             self._set_status(self.STARTED)
         else:
@@ -261,7 +468,7 @@ class OpenStackServer(Server):
         # TODO: Find a better way to wait for the server shutdown and reboot
         # Currently, without sleeping here, the status would immediately switch back to ready,
         # as SSH is still available until the reboot terminates the SSHD process
-        time.sleep(30)
+        time.sleep(self.REBOOT_GRACE_PERIOD)
 
     def terminate(self):
         """
@@ -40,7 +40,25 @@ class ValidateModelMixin(object):
 
     https://gist.github.com/glarrain/5448253
     """
-    def save(self, *args, **kwargs):
-        """Call :meth:`full_clean` before saving."""
-        self.full_clean()
+    def save(self, *args, validate=True, **kwargs):
+        """Call :meth:`full_clean` before saving, unless `validate=False` is passed."""
+        if validate:
+            self.full_clean()
         super(ValidateModelMixin, self).save(*args, **kwargs)
+
+    def save_fields(self, *field_names):
+        """
+        Fast path for trusted internal updates: only write `field_names` (and the modification
+        time), without calling :meth:`full_clean` - which queries the database to check the
+        foreign keys & the unique constraints.
+
+        Only use it for values set by the application itself - user/API-originated writes must
+        go through :meth:`save`. Objects which haven't been saved yet are always validated.
+        """
+        if self.pk is None:
+            self.save()
+            return
+        update_fields = set(field_names)
+        if any(field.name == 'modified' for field in self._meta.fields):
+            update_fields.add('modified')
+        self.save(update_fields=update_fields, validate=False)
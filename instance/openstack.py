@@ -22,11 +22,16 @@ OpenStack - Helper functions
 
 # Imports #####################################################################
 
+import hashlib
+import json
 import requests
+import threading
 
+from novaclient.exceptions import BadRequest, NotFound
 from novaclient.v2.client import Client as NovaClient
 
 from django.conf import settings
+from django.core.cache import cache
 
 from instance.utils import get_requests_retry
 
@@ -37,9 +42,35 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+# Constants ###################################################################
+
+# Number of servers requested per page when listing servers - the API also caps the page size on its side
+SERVER_LIST_PAGE_SIZE = 500
+
+
+# Globals #####################################################################
+
+# Nova clients are reused between calls, one per thread, as the client objects aren't thread-safe
+_nova_client_local = threading.local()
+
+
 # Functions ###################################################################
 
 def get_nova_client():
+    """
+    Returns the nova client of the current thread, creating it on first use
+
+    The client keeps its authentication token between calls, and re-authenticates automatically
+    when the token expires. Creating it doesn't make any request to the OpenStack API.
+    """
+    nova = getattr(_nova_client_local, 'nova', None)
+    if nova is None:
+        nova = create_nova_client()
+        _nova_client_local.nova = nova
+    return nova
+
+
+def create_nova_client():
     """
     Instanciate a python novaclient.Client() object with proper credentials
     """
@@ -62,15 +93,123 @@ def get_nova_client():
     return nova
 
 
+def get_catalog_cache_key(resource_type, selector):
+    """
+    Cache key of the ID of the catalog resource (eg. 'flavor') matching `selector`
+    """
+    selector_hash = hashlib.sha1(json.dumps(selector, sort_keys=True).encode('utf-8')).hexdigest()
+    return 'openstack_{}_id_{}'.format(resource_type, selector_hash)
+
+
+def find_catalog_resource_id(resource_type, manager, selector):
+    """
+    Get the ID of the first resource from `manager` (eg. `nova.flavors`) matching `selector`
+
+    The ID is cached, to avoid listing the whole catalog each time
+    """
+    cache_key = get_catalog_cache_key(resource_type, selector)
+    resource_id = cache.get(cache_key)
+    if resource_id is None:
+        resource_id = manager.find(**selector).id
+        cache.set(cache_key, resource_id, settings.OPENSTACK_CATALOG_CACHE_TIMEOUT)
+    return resource_id
+
+
 def create_server(nova, server_name, flavor_selector, image_selector, key_name=None):
     """
     Create a VM via nova
+
+    When the creation fails because the cached flavor or image doesn't exist anymore, they
+    are looked up again and the creation is retried
+    """
+    flavor_id = find_catalog_resource_id('flavor', nova.flavors, flavor_selector)
+    image_id = find_catalog_resource_id('image', nova.images, image_selector)
+
+    logger.info('Creating OpenStack server: name=%s image=%s flavor=%s', server_name, image_id, flavor_id)
+    try:
+        return nova.servers.create(server_name, image_id, flavor_id, key_name=key_name)
+    except (BadRequest, NotFound):
+        cache.delete_many([
+            get_catalog_cache_key('flavor', flavor_selector),
+            get_catalog_cache_key('image', image_selector),
+        ])
+        new_flavor_id = find_catalog_resource_id('flavor', nova.flavors, flavor_selector)
+        new_image_id = find_catalog_resource_id('image', nova.images, image_selector)
+        if (new_flavor_id, new_image_id) == (flavor_id, image_id):
+            raise
+
+        logger.info('Retrying OpenStack server creation with updated catalog: image=%s flavor=%s',
+                    new_image_id, new_flavor_id)
+        return nova.servers.create(server_name, new_image_id, new_flavor_id, key_name=key_name)
+
+
+def get_available_capacity(nova):
     """
-    flavor = nova.flavors.find(**flavor_selector)
-    image = nova.images.find(**image_selector)
+    Returns the number of instances, cores & RAM (in MB) still available in the tenant quota
 
-    logger.info('Creating OpenStack server: name=%s image=%s flavor=%s', server_name, image, flavor)
-    return nova.servers.create(server_name, image, flavor, key_name=key_name)
+    Unlimited resources are set to None
+    """
+    limits = {limit.name: limit.value for limit in nova.limits.get().absolute}
+    capacity = {}
+    for resource, max_name, used_name in (('instances', 'maxTotalInstances', 'totalInstancesUsed'),
+                                          ('cores', 'maxTotalCores', 'totalCoresUsed'),
+                                          ('ram', 'maxTotalRAMSize', 'totalRAMUsed')):
+        max_value = limits.get(max_name, -1)
+        capacity[resource] = None if max_value < 0 else max_value - limits.get(used_name, 0)
+    return capacity
+
+
+def get_flavor_requirements(nova, flavor_selector):
+    """
+    Returns the quota resources used by a server of the flavor matching `flavor_selector`
+    """
+    flavor = nova.flavors.get(find_catalog_resource_id('flavor', nova.flavors, flavor_selector))
+    return {'instances': 1, 'cores': flavor.vcpus, 'ram': flavor.ram}
+
+
+def create_server_image(nova, openstack_id, image_name):
+    """
+    Request a snapshot of the server with `openstack_id` - returns the ID of the new image,
+    which is saved asynchronously by OpenStack
+    """
+    logger.info('Creating OpenStack image %s from server %s', image_name, openstack_id)
+    return nova.servers.create_image(openstack_id, image_name)
+
+
+def get_image_status(nova, image_id):
+    """
+    Returns the status of an image (eg. 'SAVING', 'ACTIVE', 'ERROR'), or None if it doesn't exist
+    """
+    try:
+        return nova.images.get(image_id).status
+    except NotFound:
+        return None
+
+
+def delete_image(nova, image_id):
+    """
+    Delete an image - images which don't exist anymore are ignored
+    """
+    logger.info('Deleting OpenStack image %s', image_id)
+    try:
+        nova.images.delete(image_id)
+    except NotFound:
+        logger.warning('OpenStack image %s was already deleted', image_id)
+
+
+def list_servers(nova, page_size=SERVER_LIST_PAGE_SIZE):
+    """
+    Returns the detailed list of all the servers of the tenant, requested page by page until an empty
+    page - a single listing is truncated to the maximum page size of the API
+    """
+    server_list = []
+    marker = None
+    while True:
+        page = nova.servers.list(detailed=True, marker=marker, limit=page_size)
+        if not page or page[-1].id == marker:
+            return server_list
+        server_list += page
+        marker = page[-1].id
 
 
 def delete_servers_by_name(nova, server_name):
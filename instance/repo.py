@@ -23,11 +23,16 @@ Git repository - Helper functions
 # Imports #####################################################################
 
 import git
+import hashlib
+import os
 import tempfile
 import shutil
 
 from contextlib import contextmanager
 
+from django.conf import settings
+from django.core.cache import cache
+
 
 # Logging #####################################################################
 
@@ -37,18 +42,52 @@ logger = logging.getLogger(__name__)
 
 # Functions ###################################################################
 
+def get_mirror_path(repo_url):
+    """
+    Path of the local bare mirror of the repository at `repo_url`
+    """
+    url_hash = hashlib.sha1(repo_url.encode('utf-8')).hexdigest()
+    return os.path.join(settings.REPO_MIRROR_DIR, url_hash)
+
+
+def update_mirror(repo_url):
+    """
+    Create or update the local bare mirror of the repository at `repo_url`
+
+    Must be called while holding the lock of the mirror
+    Returns the path of the mirror
+    """
+    mirror_path = get_mirror_path(repo_url)
+    if os.path.exists(os.path.join(mirror_path, 'HEAD')):
+        logger.info('Fetching repository %s in mirror %s...', repo_url, mirror_path)
+        git.Git(mirror_path).fetch('--prune', 'origin')
+    else:
+        logger.info('Creating mirror of repository %s in %s...', repo_url, mirror_path)
+        # Remove any leftover of an interrupted clone
+        shutil.rmtree(mirror_path, ignore_errors=True)
+        git.repo.base.Repo.clone_from(repo_url, mirror_path, mirror=True)
+        # Checkouts share the mirror objects, which must never be garbage collected from under them
+        git.Git(mirror_path).config('gc.auto', '0')
+    return mirror_path
+
+
 @contextmanager
 def open_repository(repo_url, ref='master'):
     """
     Get a `Git` object for a repository URL and switch it to the branch `ref`
 
-    Note that this clones the repository locally
+    Note that this clones the repository locally, from a local mirror of the repository which
+    is kept between calls and only fetched to get the latest changes
     """
     repo_dir_path = tempfile.mkdtemp()
-    logger.info('Cloning repository %s (ref=%s) in %s...', repo_url, ref, repo_dir_path)
+    try:
+        with cache.lock('repo_mirror_{}'.format(get_mirror_path(repo_url))):
+            mirror_path = update_mirror(repo_url)
+            logger.info('Cloning repository %s (ref=%s) in %s...', repo_url, ref, repo_dir_path)
+            git.repo.base.Repo.clone_from(mirror_path, repo_dir_path, shared=True, no_checkout=True)
 
-    git.repo.base.Repo.clone_from(repo_url, repo_dir_path)
-    g = git.Git(repo_dir_path)
-    g.checkout(ref)
-    yield g
-    shutil.rmtree(repo_dir_path)
+        g = git.Git(repo_dir_path)
+        g.checkout(ref)
+        yield g
+    finally:
+        shutil.rmtree(repo_dir_path)
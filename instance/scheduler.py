@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+#
+# OpenCraft -- tools to aid developing and hosting free software projects
+# Copyright (C) 2015 OpenCraft <xavier@opencraft.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Provisioning scheduler - waiting list of the instances to provision, started only when the
+OpenStack quota has enough capacity left for their servers
+"""
+
+# Imports #####################################################################
+
+import time
+import uuid
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from instance import openstack
+from instance.models.server import OpenStackServer
+
+
+# Logging #####################################################################
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Constants ###################################################################
+
+# Provisioning priorities, from the most urgent
+PRIORITY_MANUAL = 0
+PRIORITY_NEW = 1
+PRIORITY_REFRESH = 2
+
+# Sorted set of the queued instance pks, by priority then by time of request
+QUEUE_KEY = 'provisioning_queue'
+
+# Hash of the admission tokens, to the `<instance_pk>:<timestamp>:<server_count>` of the admitted provisionings, with
+# the number of servers they reserve (see `get_required_server_count()`) - each admission gets its own token, so an
+# instance admitted again while a previous admission is running keeps both reservations
+ADMITTED_KEY = 'provisioning_admitted'
+
+# Time after which an admitted provisioning is considered lost (eg. if the worker died), in seconds
+ADMITTED_TIMEOUT = 4 * 3600
+
+# Average duration of a provisioning, used to estimate the time at which queued provisionings start
+DURATION_KEY = 'provisioning_duration'
+DURATION_DEFAULT = 3600
+
+# Weight of the last provisioning in the average duration
+DURATION_SMOOTHING = 0.3
+
+# Lock held while the queue is being modified
+SCHEDULER_LOCK_KEY = 'provisioning_scheduler'
+
+# Score offset between two priorities - larger than any timestamp
+PRIORITY_SCORE_STEP = 10 ** 10
+
+
+# Classes #####################################################################
+
+# Provisioning admitted from the waiting list - the token identifies its capacity reservation, see `release()`
+Admission = namedtuple('Admission', ['instance_pk', 'token', 'priority'])
+
+
+# Functions ###################################################################
+
+def enqueue(instance_pk, priority=PRIORITY_REFRESH):
+    """
+    Add an instance to the provisioning waiting list - an instance which is already queued
+    keeps its place, unless the new request has a higher priority
+
+    Returns True if the instance wasn't queued yet
+    """
+    redis = get_redis_connection('default')
+    with cache.lock(SCHEDULER_LOCK_KEY):
+        current_score = redis.zscore(QUEUE_KEY, instance_pk)
+        if current_score is not None and current_score // PRIORITY_SCORE_STEP <= priority:
+            return False
+        redis.zadd(QUEUE_KEY, priority * PRIORITY_SCORE_STEP + time.time(), instance_pk)
+    logger.info('Queued provisioning of instance pk=%s with priority %s', instance_pk, priority)
+    return current_score is None
+
+
+def get_queue():
+    """
+    Returns the queued instance pks, in the order in which they will be provisioned
+    """
+    redis = get_redis_connection('default')
+    return [int(pk) for pk in redis.zrange(QUEUE_KEY, 0, -1)]
+
+
+def get_queue_position(instance_pk):
+    """
+    Returns the position of the instance in the waiting list, starting at 0 - None if not queued
+    """
+    redis = get_redis_connection('default')
+    return redis.zrank(QUEUE_KEY, instance_pk)
+
+
+def get_queue_eta(instance_pk):
+    """
+    Estimated time at which the provisioning of a queued instance will start - None if not queued
+
+    Assumes the instances ahead in the queue are provisioned as many at a time as are currently
+    running, each taking the average provisioning duration
+    """
+    position = get_queue_position(instance_pk)
+    if position is None:
+        return None
+    redis = get_redis_connection('default')
+    parallelism = max(1, redis.hlen(ADMITTED_KEY))
+    duration = cache.get(DURATION_KEY, DURATION_DEFAULT)
+    return timezone.now() + timedelta(seconds=(position // parallelism + 1) * duration)
+
+
+def get_admitted_list():
+    """
+    Returns the `(token, instance_pk, admitted_at, server_count)` tuples of the admitted provisionings, with
+    `admitted_at` as a timestamp
+    """
+    redis = get_redis_connection('default')
+    admitted_list = []
+    for token, admission_str in redis.hgetall(ADMITTED_KEY).items():
+        instance_pk, admitted_at, server_count = admission_str.split(b':')
+        admitted_list.append((token.decode(), int(instance_pk), float(admitted_at), int(server_count)))
+    return admitted_list
+
+
+def get_required_server_count(instance_pk):
+    """
+    Returns the number of servers the provisioning of an instance adds to the quota usage - without
+    `settings.BLUE_GREEN_PROVISIONING`, the started server of an instance is terminated before its new
+    server is created, so reprovisioning it requires no extra capacity
+    """
+    if settings.BLUE_GREEN_PROVISIONING:
+        return 1
+    started_server_set = OpenStackServer.objects.filter(instance_id=instance_pk).exclude_terminated()\
+                                                .exclude(status=OpenStackServer.NEW)
+    return 0 if started_server_set.exists() else 1
+
+
+def get_reserved_count():
+    """
+    Returns the number of servers reserved by the admitted provisionings which haven't created their new
+    server yet, and thus aren't accounted for in the quota usage
+    """
+    redis = get_redis_connection('default')
+    reserved_count = 0
+    for token, instance_pk, admitted_at, server_count in get_admitted_list():
+        if admitted_at + ADMITTED_TIMEOUT < time.time():
+            logger.warning('Provisioning of instance pk=%s admitted too long ago, releasing it', instance_pk)
+            redis.hdel(ADMITTED_KEY, token)
+            continue
+        admitted_at = datetime.fromtimestamp(admitted_at, timezone.utc)
+        if not OpenStackServer.objects.filter(instance_id=instance_pk, created__gte=admitted_at)\
+                                      .exclude(status=OpenStackServer.NEW).exists():
+            reserved_count += server_count
+    return reserved_count
+
+
+def admit(nova):
+    """
+    Remove the instances from the head of the waiting list for which there is enough capacity in the
+    OpenStack quota, and return their `Admission` - the caller is responsible for provisioning them,
+    and for releasing each admission with its token once done
+
+    Instances are admitted in order - a lower priority instance never overtakes a queued one
+    """
+    redis = get_redis_connection('default')
+    with cache.lock(SCHEDULER_LOCK_KEY):
+        queue = redis.zrange(QUEUE_KEY, 0, -1, withscores=True)
+        if not queue:
+            return []
+
+        capacity = openstack.get_available_capacity(nova)
+        requirements = openstack.get_flavor_requirements(nova, settings.OPENSTACK_SANDBOX_FLAVOR)
+        reserved_count = get_reserved_count()
+        for resource, required in requirements.items():
+            if capacity[resource] is not None:
+                capacity[resource] -= required * reserved_count
+
+        admitted_list = []
+        for instance_pk, score in queue:
+            server_count = get_required_server_count(int(instance_pk))
+            if any(capacity[resource] is not None and capacity[resource] < required * server_count
+                   for resource, required in requirements.items()):
+                logger.info('Not enough OpenStack capacity left (%s), %d instance(s) waiting',
+                            capacity, len(queue) - len(admitted_list))
+                break
+            for resource, required in requirements.items():
+                if capacity[resource] is not None:
+                    capacity[resource] -= required * server_count
+            admission = Admission(int(instance_pk), uuid.uuid4().hex, int(score // PRIORITY_SCORE_STEP))
+            redis.zrem(QUEUE_KEY, instance_pk)
+            redis.hset(ADMITTED_KEY, admission.token,
+                       '{}:{}:{}'.format(admission.instance_pk, time.time(), server_count))
+            admitted_list.append(admission)
+    return admitted_list
+
+
+def release(token, duration=None):
+    """
+    Mark an admitted provisioning as finished, using the token of its admission, and record
+    its duration (in seconds)
+    """
+    redis = get_redis_connection('default')
+    redis.hdel(ADMITTED_KEY, token)
+    if duration is not None:
+        average_duration = cache.get(DURATION_KEY, DURATION_DEFAULT)
+        cache.set(DURATION_KEY, (1 - DURATION_SMOOTHING) * average_duration + DURATION_SMOOTHING * duration, None)
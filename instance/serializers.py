@@ -24,6 +24,7 @@ Instance serializers (API representation)
 
 from rest_framework import serializers
 
+from instance import scheduler
 from instance.models.instance import OpenEdXInstance
 from instance.models.server import OpenStackServer
 
@@ -56,6 +57,8 @@ class OpenEdXInstanceSerializer(serializers.ModelSerializer):
     """
     api_url = serializers.HyperlinkedIdentityField(view_name='api:openedxinstance-detail')
     active_server_set = OpenStackServerSerializer(many=True, read_only=True)
+    provisioning_queue_position = serializers.SerializerMethodField()
+    provisioning_eta = serializers.SerializerMethodField()
 
     class Meta:
         model = OpenEdXInstance
@@ -73,11 +76,12 @@ class OpenEdXInstanceSerializer(serializers.ModelSerializer):
             'github_branch_url',
             'github_pr_number',
             'github_pr_url',
-            'log_text',
             'github_organization_name',
             'modified',
             'name',
             'protocol',
+            'provisioning_eta',
+            'provisioning_queue_position',
             'repository_url',
             'status',
             'studio_url',
@@ -86,3 +90,15 @@ class OpenEdXInstanceSerializer(serializers.ModelSerializer):
             'updates_feed',
             'vars_str',
         )
+
+    def get_provisioning_queue_position(self, obj): #pylint: disable=no-self-use
+        """
+        Position of the instance in the provisioning waiting list, starting at 0 - None if not queued
+        """
+        return scheduler.get_queue_position(obj.pk)
+
+    def get_provisioning_eta(self, obj): #pylint: disable=no-self-use
+        """
+        Estimated time at which the queued provisioning of the instance will start
+        """
+        return scheduler.get_queue_eta(obj.pk)
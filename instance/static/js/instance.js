@@ -83,11 +83,39 @@ function updateInstanceList($scope, OpenCraftAPI) {
     });
 }
 
+function updateInstanceLog($scope, $http) {
+    // Fetch the log entries of the selected instance added since the last update
+    var log = $scope.instanceLog;
+    if(log.loading) {
+        log.pending = true;
+        return;
+    }
+    log.loading = true;
+    log.pending = false;
+
+    $http.get('/api/v1/openedxinstance/' + log.instance_id + '/logs/', {
+        params: log.cursor ? {cursor: log.cursor} : {},
+        transformResponse: function(data) { return data; }
+    }).then(function(response) {
+        if($scope.instanceLog === log) {
+            log.text += response.data;
+            log.cursor = response.headers('X-Log-Cursor');
+        }
+    }, function(response) {
+        console.log('Error from server: ', response);
+    }).finally(function () {
+        log.loading = false;
+        if(log.pending && $scope.instanceLog === log) {
+            updateInstanceLog($scope, $http);
+        }
+    });
+}
+
 
 // Controllers ////////////////////////////////////////////////////////////////
 
-app.controller("Index", ['$scope', 'Restangular', 'OpenCraftAPI', '$q',
-    function ($scope, Restangular, OpenCraftAPI, $q) {
+app.controller("Index", ['$scope', 'Restangular', 'OpenCraftAPI', '$q', '$http',
+    function ($scope, Restangular, OpenCraftAPI, $q, $http) {
         // Display loading message
         $scope.loading = true;
 
@@ -96,6 +124,11 @@ app.controller("Index", ['$scope', 'Restangular', 'OpenCraftAPI', '$q',
         $scope.select = function(selection_type, value) {
             $scope.selected[selection_type] = value;
             console.log('Selected ' + selection_type + ':', value);
+
+            if(selection_type === 'instance') {
+                $scope.instanceLog = {instance_id: value.id, text: '', cursor: null, loading: false, pending: false};
+                updateInstanceLog($scope, $http);
+            }
         };
 
         // Reprovisioning
@@ -119,10 +152,11 @@ app.controller("Index", ['$scope', 'Restangular', 'OpenCraftAPI', '$q',
 
             if(message.data.type === 'server_update') {
                 updateInstanceList($scope, OpenCraftAPI);
-            } else if(message.data.type === 'instance_log') {
-                if($scope.selected.instance && $scope.selected.instance.id === message.data.instance_id) {
+            } else if(message.data.type === 'instance_log' || message.data.type === 'instance_log_batch') {
+                // Fetch the new entries from the log cursor, to get them in order & only once
+                if($scope.instanceLog && $scope.instanceLog.instance_id === message.data.instance_id) {
                     $scope.$apply(function(){
-                        $scope.selected.instance.log_text += message.data.log_entry + '\n';
+                        updateInstanceLog($scope, $http);
                     });
                 }
             }
@@ -22,13 +22,24 @@ Worker tasks for instance hosting & management
 
 # Imports #####################################################################
 
+import time
+
 from huey.djhuey import crontab, periodic_task, task
 
 from django.conf import settings
+from django.core.cache import cache
 from django.template.defaultfilters import truncatewords
 
-from instance.github import get_username_list_from_team, get_pr_list_from_username
+from instance.github import (
+    RateLimitExceeded, background_priority, fork_name2tuple, get_pr_list_from_fork, get_rate_limit_stats,
+    get_username_list_from_team
+)
+from instance import scheduler
+from instance.models.image import ServerImage
 from instance.models.instance import OpenEdXInstance
+from instance.models.server import OpenStackServer
+from instance.openstack import get_nova_client
+from instance.utils import minute_interval
 
 
 # Logging #####################################################################
@@ -37,44 +48,250 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+# Constants ###################################################################
+
+# Per-instance mutex, held while the instance is being provisioned
+PROVISION_LOCK_KEY = 'provision_instance_lock_{}'
+
+# Maximum duration of a provisioning, after which the mutex expires (eg. if the worker died), in seconds
+PROVISION_LOCK_TIMEOUT = 4 * 3600
+
+# Delay before retrying a redeployment, while the instance is being provisioned or redeployed, in seconds
+REDEPLOY_RETRY_DELAY = 60
+
+
 # Tasks #######################################################################
 
-@task()
-def provision_instance(instance_pk):
+def provision_instance(instance_pk, priority=scheduler.PRIORITY_REFRESH):
+    """
+    Add an existing instance to the provisioning waiting list, unless it is already waiting in it,
+    and start the queued provisionings which fit in the OpenStack quota
+    """
+    if not scheduler.enqueue(instance_pk, priority):
+        logger.info('Provisioning of instance pk=%s is already queued', instance_pk)
+    schedule_provisioning()
+
+
+def start_admitted_provisionings():
     """
-    Run provisioning on an existing instance
+    Start the provisioning of the instances admitted from the waiting list
     """
-    logger.info('Retreiving instance: pk=%s', instance_pk)
-    instance = OpenEdXInstance.objects.get(pk=instance_pk)
+    for admission in scheduler.admit(get_nova_client()):
+        logger.info('Starting queued provisioning of instance pk=%s', admission.instance_pk)
+        provision_instance_task(admission.instance_pk, admission.token, admission.priority)
 
-    logger.info('Running provisioning on %s', instance)
-    instance.provision()
+
+@task()
+def schedule_provisioning():
+    """
+    Start the queued provisionings which fit in the OpenStack quota
+    """
+    start_admitted_provisionings()
 
 
 @periodic_task(crontab(minute='*/1'))
+def watch_provisioning_queue():
+    """
+    Start the queued provisionings once capacity is freed in the OpenStack quota
+    """
+    start_admitted_provisionings()
+
+
+@task()
+def provision_instance_task(instance_pk, admission_token, priority=scheduler.PRIORITY_REFRESH):
+    """
+    Run provisioning on an existing instance, admitted from the waiting list with `admission_token`
+
+    Provisionings of the same instance are serialized by a per-instance mutex. A provisioning admitted
+    while another one is running doesn't wait for it, which would hold a worker: its admission is
+    released, and the instance is queued again with the same priority.
+    """
+    lock = cache.lock(PROVISION_LOCK_KEY.format(instance_pk), timeout=PROVISION_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        logger.info('Instance pk=%s is already being provisioned, queuing it again', instance_pk)
+        scheduler.release(admission_token)
+        scheduler.enqueue(instance_pk, priority)
+        return
+
+    duration = None
+    try:
+        logger.info('Retreiving instance: pk=%s', instance_pk)
+        instance = OpenEdXInstance.objects.get(pk=instance_pk)
+
+        logger.info('Running provisioning on %s', instance)
+        start_time = time.time()
+        instance.provision()
+        duration = time.time() - start_time
+    finally:
+        lock.release()
+        scheduler.release(admission_token, duration)
+
+
+@task()
+def redeploy_instance_task(instance_pk):
+    """
+    Deploy the current commit of an instance on its ready server, without recreating it - the instances
+    without a ready server are provisioned instead
+
+    Shares the per-instance mutex of the provisionings - while it is held, the redeployment doesn't wait for
+    it, which would hold a worker, but is retried after `REDEPLOY_RETRY_DELAY` seconds
+    """
+    lock = cache.lock(PROVISION_LOCK_KEY.format(instance_pk), timeout=PROVISION_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        logger.info('Instance pk=%s is already being provisioned, retrying its redeployment later', instance_pk)
+        redeploy_instance_task.schedule(args=(instance_pk,), delay=REDEPLOY_RETRY_DELAY)
+        return
+
+    try:
+        logger.info('Retreiving instance: pk=%s', instance_pk)
+        instance = OpenEdXInstance.objects.get(pk=instance_pk)
+        if instance.redeployable_server is not None:
+            logger.info('Running redeployment on %s', instance)
+            instance.redeploy()
+            return
+    finally:
+        lock.release()
+
+    logger.info('No ready server to redeploy, provisioning %s', instance)
+    provision_instance(instance_pk)
+
+
+def reprovision_instance(instance):
+    """
+    Update an instance after its commit changed - the instances without a server are provisioned from
+    scratch, the others are redeployed (see `redeploy_instance_task()`)
+
+    An instance already being provisioned is still redeployed, as its provisioning uses the previous commit.
+    The redeployment waits for the per-instance mutex, and falls back to a provisioning without a ready server.
+    """
+    if instance.status == instance.EMPTY:
+        logger.info('New commit %s, reprovisioning: %s', instance.commit_short_id, instance)
+        provision_instance(instance.pk)
+    else:
+        logger.info('New commit %s, redeploying: %s', instance.commit_short_id, instance)
+        redeploy_instance_task(instance.pk)
+
+
+def update_pr_instance(pr):
+    """
+    Create or update the sandbox instance of a PR - start its provisioning when it is new, and
+    redeploy it when the head commit of the PR changes
+
+    The instance isn't saved when nothing changed, and only its changed fields are updated otherwise
+    """
+    pr_sub_domain = 'pr{number}.sandbox'.format(number=pr.number)
+
+    defaults = {'commit_id': pr.head_sha} if pr.head_sha else {}
+    instance, created = OpenEdXInstance.objects.get_or_create(
+        sub_domain=pr_sub_domain,
+        fork_name=pr.fork_name,
+        branch_name=pr.branch_name,
+        defaults=defaults,
+    )
+    commit_changed = not created and pr.head_sha is not None and pr.head_sha != instance.commit_id
+    if commit_changed:
+        instance.set_to_branch_tip(commit_id=pr.head_sha, commit=False)
+
+    truncated_title = truncatewords(pr.title, 4)
+    pr_fields = {
+        'name': 'PR#{pr.number}: {truncated_title} ({pr.username}) - {i.reference_name}'.format(
+            pr=pr, i=instance, truncated_title=truncated_title),
+        'github_pr_number': pr.number,
+        'ansible_extra_settings': pr.extra_settings,
+    }
+    changed_field_names = [name for name, value in pr_fields.items() if getattr(instance, name) != value]
+    if commit_changed:
+        # `set_to_branch_tip()` also updates the commit hash in the name
+        changed_field_names += ['commit_id', 'name']
+    if not created and not changed_field_names:
+        return
+
+    for name, value in pr_fields.items():
+        setattr(instance, name, value)
+    if created:
+        instance.save()
+    else:
+        instance.save_fields(*changed_field_names)
+
+    if created:
+        logger.info('New PR found, creating sandbox: %s', pr)
+        provision_instance(instance.pk, priority=scheduler.PRIORITY_NEW)
+    elif commit_changed:
+        reprovision_instance(instance)
+
+
+@periodic_task(minute_interval(settings.WATCH_PR_INTERVAL))
 def watch_pr():
     """
     Automatically create/update sandboxes for PRs opened by members of the watched
     organization on the watched repository
+
+    When the GitHub webhooks are enabled, this only catches up with the events which were missed
+    """
+    try:
+        with background_priority():
+            team_username_list = get_username_list_from_team(settings.WATCH_ORGANIZATION)
+            pr_list = get_pr_list_from_fork(settings.WATCH_FORK, team_username_list)
+    except RateLimitExceeded as exc:
+        logger.warning('Skipping PR check, not enough GitHub API budget left: %s', exc)
+        return
+    finally:
+        logger.info('GitHub API budget: %s', get_rate_limit_stats())
+
+    for pr in pr_list:
+        update_pr_instance(pr)
+
+
+@task()
+def handle_pr_event(pr):
+    """
+    Create/update the sandbox of a PR opened or updated on the watched repository, as notified
+    by a GitHub webhook
     """
     team_username_list = get_username_list_from_team(settings.WATCH_ORGANIZATION)
+    if pr.username not in team_username_list:
+        logger.info('Ignoring PR #%s, %s is not a member of %s', pr.number, pr.username, settings.WATCH_ORGANIZATION)
+        return
+    update_pr_instance(pr)
+
+
+@task()
+def handle_push_event(fork_name, branch_name, commit_id):
+    """
+    Update the instances following a branch when new commits are pushed to it, as notified
+    by a GitHub webhook, and reprovision them
+    """
+    fork_org, fork_repo = fork_name2tuple(fork_name)
+    instance_list = OpenEdXInstance.objects.filter(
+        github_organization_name__iexact=fork_org,
+        github_repository_name__iexact=fork_repo,
+        branch_name=branch_name,
+        ref_type='heads',
+    )
+    for instance in instance_list:
+        if instance.commit_id == commit_id:
+            continue
+        instance.set_to_branch_tip(commit_id=commit_id)
+        reprovision_instance(instance)
 
-    for username in team_username_list:
-        for pr in get_pr_list_from_username(username, settings.WATCH_FORK):
-            pr_sub_domain = 'pr{number}.sandbox'.format(number=pr.number)
-
-            instance, created = OpenEdXInstance.objects.get_or_create(
-                sub_domain=pr_sub_domain,
-                fork_name=pr.fork_name,
-                branch_name=pr.branch_name,
-            )
-            truncated_title = truncatewords(pr.title, 4)
-            instance.name = 'PR#{pr.number}: {truncated_title} ({pr.username}) - {i.reference_name}'\
-                            .format(pr=pr, i=instance, truncated_title=truncated_title)
-            instance.github_pr_number = pr.number
-            instance.ansible_extra_settings = pr.extra_settings
-            instance.save()
-
-            if created:
-                logger.info('New PR found, creating sandbox: %s', pr)
-                provision_instance(instance.pk)
+
+@periodic_task(crontab(minute='*/1'))
+def update_server_status():
+    """
+    Reconcile the status of all the active servers with their state on OpenStack
+    """
+    if not settings.SERVER_STATUS_RECONCILER:
+        return
+    changed_server_list = OpenStackServer.objects.exclude_terminated().update_status()
+    logger.info('Updated status of %d server(s)', len(changed_server_list))
+
+
+@periodic_task(crontab(minute='*/5'))
+def update_server_images():
+    """
+    Make the server images available once saved, and delete the least recently used ones
+    """
+    nova = get_nova_client()
+    for image in ServerImage.objects.filter(status=ServerImage.SAVING):
+        image.update_status(nova)
+    ServerImage.objects.delete_unused(nova, settings.OPENSTACK_SANDBOX_SNAPSHOT_COUNT)
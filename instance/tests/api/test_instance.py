@@ -22,11 +22,16 @@ Views - Tests
 
 # Imports #####################################################################
 
+from freezegun import freeze_time
 from mock import call, patch
 
+from django_redis import get_redis_connection
 from rest_framework import status
 
+from instance import scheduler
+from instance.github import RateLimitExceeded
 from instance.models.instance import OpenEdXInstance
+from instance.models.logging_mixin import LogEntryBuffer
 from instance.models.server import OpenStackServer
 from instance.tests.api.base import APITestCase
 from instance.tests.models.factories.instance import OpenEdXInstanceFactory
@@ -66,6 +71,7 @@ class InstanceAPITestCase(APITestCase):
                       response.data[0].items())
         self.assertIn(('status', 'empty'), response.data[0].items())
         self.assertIn(('base_domain', 'example.com'), response.data[0].items())
+        self.assertNotIn('log_text', response.data[0])
 
     def test_get_domain(self):
         """
@@ -79,6 +85,25 @@ class InstanceAPITestCase(APITestCase):
         self.assertIn(('url', 'http://domain.api.example.com/'), response.data[0].items())
         self.assertIn(('studio_url', 'http://studio.domain.api.example.com/'), response.data[0].items())
 
+    def test_get_provisioning_queue(self):
+        """
+        GET - Position & ETA in the provisioning waiting list
+        """
+        redis = get_redis_connection('default')
+        redis.delete(scheduler.QUEUE_KEY)
+        self.addCleanup(redis.delete, scheduler.QUEUE_KEY)
+        self.api_client.login(username='user1', password='pass')
+        instance = OpenEdXInstanceFactory()
+
+        response = self.api_client.get('/api/v1/openedxinstance/{pk}/'.format(pk=instance.pk))
+        self.assertIn(('provisioning_queue_position', None), response.data.items())
+        self.assertIn(('provisioning_eta', None), response.data.items())
+
+        scheduler.enqueue(instance.pk)
+        response = self.api_client.get('/api/v1/openedxinstance/{pk}/'.format(pk=instance.pk))
+        self.assertIn(('provisioning_queue_position', 0), response.data.items())
+        self.assertIsNotNone(response.data['provisioning_eta'])
+
     def test_provision_not_ready(self):
         """
         POST /:id/provision - Status not ready
@@ -102,9 +127,141 @@ class InstanceAPITestCase(APITestCase):
 
         response = self.api_client.post('/api/v1/openedxinstance/{pk}/provision/'.format(pk=instance.pk))
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response.data, {'status': 'Instance provisioning started'})
-        self.assertEqual(mock_provision_instance.call_count, 1)
+        self.assertEqual(response.data, {'status': 'Instance provisioning queued'})
+        mock_provision_instance.assert_called_once_with(str(instance.pk), priority=scheduler.PRIORITY_MANUAL)
         self.assertEqual(OpenEdXInstance.objects.get(pk=instance.pk).commit_id, '1' * 40)
         self.assertEqual(mock_get_commit_id_from_ref.mock_calls, [
             call('api/repo', 'api-branch', ref_type='heads'),
         ])
+
+    @patch('instance.github.get_commit_id_from_ref')
+    @patch('instance.api.instance.provision_instance')
+    def test_provision_rate_limit_exceeded(self, mock_provision_instance, mock_get_commit_id_from_ref):
+        """
+        POST /:id/provision - GitHub API rate limit exceeded
+        """
+        self.api_client.login(username='user1', password='pass')
+        instance = OpenEdXInstanceFactory()
+        OpenStackServerFactory(instance=instance, status=OpenStackServer.READY)
+        mock_get_commit_id_from_ref.side_effect = RateLimitExceeded('Budget exhausted', 1438800000)
+
+        response = self.api_client.post('/api/v1/openedxinstance/{pk}/provision/'.format(pk=instance.pk))
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response.data, {
+            'status': 'GitHub API rate limit exceeded, retry after 2015-08-05T18:40:00+00:00'})
+        self.assertEqual(mock_provision_instance.call_count, 0)
+
+    def test_redeploy_not_ready(self):
+        """
+        POST /:id/redeploy - No ready server
+        """
+        self.api_client.login(username='user1', password='pass')
+        instance = OpenEdXInstanceFactory()
+        OpenStackServerFactory(instance=instance, status=OpenStackServer.BOOTED)
+        response = self.api_client.post('/api/v1/openedxinstance/{pk}/redeploy/'.format(pk=instance.pk))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(response.data, {'status': 'Instance is not ready for redeployment'})
+
+    @patch('instance.github.get_commit_id_from_ref')
+    @patch('instance.api.instance.redeploy_instance_task')
+    def test_redeploy(self, mock_redeploy_instance_task, mock_get_commit_id_from_ref):
+        """
+        POST /:id/redeploy
+        """
+        self.api_client.login(username='user1', password='pass')
+        instance = OpenEdXInstanceFactory(commit_id='0' * 40, branch_name='api-branch', fork_name='api/repo')
+        OpenStackServerFactory(instance=instance, status=OpenStackServer.READY)
+        mock_get_commit_id_from_ref.return_value = '1' * 40
+
+        response = self.api_client.post('/api/v1/openedxinstance/{pk}/redeploy/'.format(pk=instance.pk))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'status': 'Instance redeployment queued'})
+        mock_redeploy_instance_task.assert_called_once_with(instance.pk)
+        self.assertEqual(OpenEdXInstance.objects.get(pk=instance.pk).commit_id, '1' * 40)
+
+    def test_logs(self):
+        """
+        GET /:id/logs - Streamed log text, then tail from the cursor
+        """
+        self.api_client.login(username='user1', password='pass')
+        instance = OpenEdXInstanceFactory()
+        server = OpenStackServerFactory(instance=instance)
+        with freeze_time('2015-08-05 18:07:00'):
+            instance.log('info', 'Line #1, on instance')
+            server.log('info', 'Line #2, on server')
+
+        response = self.api_client.get('/api/v1/openedxinstance/{pk}/logs/'.format(pk=instance.pk))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(b''.join(response.streaming_content).decode('utf-8'), (
+            '2015-08-05 18:07:00 [info] Line #1, on instance\n'
+            '2015-08-05 18:07:00 [info] Line #2, on server\n'))
+
+        with freeze_time('2015-08-05 18:07:01'):
+            server.log('info', 'Line #3, on server')
+        response = self.api_client.get('/api/v1/openedxinstance/{pk}/logs/'.format(pk=instance.pk),
+                                       {'cursor': response['X-Log-Cursor']})
+        self.assertEqual(b''.join(response.streaming_content).decode('utf-8'),
+                         '2015-08-05 18:07:01 [info] Line #3, on server\n')
+
+    def test_logs_limit_since(self):
+        """
+        GET /:id/logs - Pages & entries created after a given time
+        """
+        self.api_client.login(username='user1', password='pass')
+        instance = OpenEdXInstanceFactory()
+        for minute in range(3):
+            with freeze_time('2015-08-05 18:0{}:00'.format(minute)):
+                instance.log('info', 'Line #{}'.format(minute))
+
+        response = self.api_client.get('/api/v1/openedxinstance/{pk}/logs/'.format(pk=instance.pk),
+                                       {'since': '2015-08-05T18:00:00', 'limit': 1})
+        self.assertEqual(b''.join(response.streaming_content).decode('utf-8'),
+                         '2015-08-05 18:01:00 [info] Line #1\n')
+        response = self.api_client.get('/api/v1/openedxinstance/{pk}/logs/'.format(pk=instance.pk),
+                                       {'cursor': response['X-Log-Cursor']})
+        self.assertEqual(b''.join(response.streaming_content).decode('utf-8'),
+                         '2015-08-05 18:02:00 [info] Line #2\n')
+
+    def test_logs_pages(self):
+        """
+        GET /:id/logs - Paging through the whole log returns each entry exactly once, including the entries
+        saved by log buffers after more recent ones
+        """
+        self.api_client.login(username='user1', password='pass')
+        instance = OpenEdXInstanceFactory()
+        server = OpenStackServerFactory(instance=instance)
+        instance_log_buffer = LogEntryBuffer(instance, max_count=100, max_delay=3600)
+        server_log_buffer = LogEntryBuffer(server, max_count=100, max_delay=3600)
+        line_list = []
+        for second in range(6):
+            with freeze_time('2015-08-05 18:07:0{}'.format(second)):
+                for logger_object, log_buffer in ((instance, instance_log_buffer), (server, server_log_buffer)):
+                    line_list.append('Line #{}, buffered on {}'.format(len(line_list), logger_object))
+                    log_buffer.log('info', line_list[-1])
+                    line_list.append('Line #{}, on {}'.format(len(line_list), logger_object))
+                    logger_object.log('info', line_list[-1])
+            if second % 2:
+                instance_log_buffer.flush()
+                server_log_buffer.flush()
+
+        text_list = []
+        params = {'limit': 3}
+        while True:
+            response = self.api_client.get('/api/v1/openedxinstance/{pk}/logs/'.format(pk=instance.pk), params)
+            page_text_list = b''.join(response.streaming_content).decode('utf-8').splitlines()
+            if not page_text_list:
+                break
+            text_list += page_text_list
+            params['cursor'] = response['X-Log-Cursor']
+        self.assertEqual(sorted(text.split('] ', 1)[1] for text in text_list), sorted(line_list))
+
+    def test_logs_invalid_parameters(self):
+        """
+        GET /:id/logs - Invalid cursor, datetime or limit
+        """
+        self.api_client.login(username='user1', password='pass')
+        instance = OpenEdXInstanceFactory()
+        for params in ({'cursor': '12'}, {'cursor': '1-a'}, {'since': 'yesterday'}, {'limit': '0'}):
+            response = self.api_client.get('/api/v1/openedxinstance/{pk}/logs/'.format(pk=instance.pk), params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
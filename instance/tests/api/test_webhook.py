@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+#
+# OpenCraft -- tools to aid developing and hosting free software projects
+# Copyright (C) 2015 OpenCraft <xavier@opencraft.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Webhook views - Tests
+"""
+
+# Imports #####################################################################
+
+import hashlib
+import hmac
+import json
+
+from mock import patch
+
+from django.test.utils import override_settings
+from rest_framework import status
+
+from instance.tests.api.base import APITestCase
+from instance.tests.base import get_raw_fixture
+
+
+# Tests #######################################################################
+
+@override_settings(GITHUB_WEBHOOK_SECRET='test-secret', WATCH_FORK='edx/edx-platform')
+class GitHubWebhookAPITestCase(APITestCase):
+    """
+    Test cases for the GitHub webhook endpoint
+    """
+    # To avoid errors with `response.data` from REST framework's API client
+    #pylint: disable=no-member
+
+    def post_event(self, event, payload, secret='test-secret'):
+        """
+        Send a webhook event, signed with `secret`
+        """
+        body = json.dumps(payload).encode('utf-8')
+        signature = 'sha1={}'.format(hmac.new(secret.encode('utf-8'), body, hashlib.sha1).hexdigest())
+        return self.api_client.post('/api/v1/webhooks/github/', body, content_type='application/json',
+                                    HTTP_X_GITHUB_EVENT=event, HTTP_X_HUB_SIGNATURE=signature)
+
+    def get_pr_payload(self, action='opened'):
+        """
+        Payload of a `pull_request` event
+        """
+        r_pr = json.loads(get_raw_fixture('github/api_pr.json'))
+        r_pr['base'] = {'repo': {'full_name': 'edx/edx-platform'}}
+        return {'action': action, 'number': r_pr['number'], 'pull_request': r_pr}
+
+    @patch('instance.api.webhook.handle_pr_event')
+    def test_invalid_signature(self, mock_handle_pr_event):
+        """
+        Events which aren't signed with the webhook secret are rejected
+        """
+        response = self.post_event('pull_request', self.get_pr_payload(), secret='wrong-secret')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(response.data, {'status': 'Invalid signature'})
+        self.assertEqual(mock_handle_pr_event.call_count, 0)
+
+    @override_settings(GITHUB_WEBHOOK_SECRET='')
+    @patch('instance.api.webhook.handle_pr_event')
+    def test_disabled(self, mock_handle_pr_event):
+        """
+        The webhook rejects all events when no secret is configured
+        """
+        response = self.post_event('pull_request', self.get_pr_payload(), secret='')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(mock_handle_pr_event.call_count, 0)
+
+    def test_ping(self):
+        """
+        Ping event, sent when the webhook is created
+        """
+        response = self.post_event('ping', {'zen': 'Keep it logically awesome.'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'status': 'pong'})
+
+    @patch('instance.api.webhook.handle_pr_event')
+    def test_pull_request(self, mock_handle_pr_event):
+        """
+        Opened PR on the watched fork
+        """
+        response = self.post_event('pull_request', self.get_pr_payload())
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(mock_handle_pr_event.call_count, 1)
+        pr = mock_handle_pr_event.mock_calls[0][1][0]
+        self.assertEqual(pr.number, 8474)
+        self.assertEqual(pr.fork_name, 'open-craft/edx-platform')
+        self.assertEqual(pr.branch_name, 'smarnach/hide-discussion-tab')
+        self.assertEqual(pr.username, 'smarnach')
+
+    @patch('instance.api.webhook.handle_pr_event')
+    def test_pull_request_ignored(self, mock_handle_pr_event):
+        """
+        Closed PRs, and PRs on other repositories, are ignored
+        """
+        response = self.post_event('pull_request', self.get_pr_payload(action='closed'))
+        self.assertEqual(response.data, {'status': 'Ignored event'})
+
+        payload = self.get_pr_payload()
+        payload['pull_request']['base']['repo']['full_name'] = 'other/edx-platform'
+        response = self.post_event('pull_request', payload)
+        self.assertEqual(response.data, {'status': 'Ignored event'})
+        self.assertEqual(mock_handle_pr_event.call_count, 0)
+
+    @patch('instance.api.webhook.handle_push_event')
+    def test_push(self, mock_handle_push_event):
+        """
+        Commits pushed to a branch
+        """
+        response = self.post_event('push', {
+            'ref': 'refs/heads/smarnach/hide-discussion-tab',
+            'after': '1' * 40,
+            'deleted': False,
+            'repository': {'full_name': 'open-craft/edx-platform'},
+        })
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        mock_handle_push_event.assert_called_once_with(
+            'open-craft/edx-platform', 'smarnach/hide-discussion-tab', '1' * 40)
+
+    @patch('instance.api.webhook.handle_push_event')
+    def test_push_ignored(self, mock_handle_push_event):
+        """
+        Tags and deleted branches are ignored
+        """
+        response = self.post_event('push', {
+            'ref': 'refs/tags/v1.0',
+            'after': '1' * 40,
+            'deleted': False,
+            'repository': {'full_name': 'open-craft/edx-platform'},
+        })
+        self.assertEqual(response.data, {'status': 'Ignored event'})
+        response = self.post_event('push', {
+            'ref': 'refs/heads/deleted-branch',
+            'after': '0' * 40,
+            'deleted': True,
+            'repository': {'full_name': 'open-craft/edx-platform'},
+        })
+        self.assertEqual(response.data, {'status': 'Ignored event'})
+        self.assertEqual(mock_handle_push_event.call_count, 0)
@@ -27,6 +27,7 @@ import os.path
 import re
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.test import Client, TestCase as DjangoTestCase
 
 
@@ -84,11 +85,17 @@ class AnyStringMatching(str):
 class TestCase(DjangoTestCase):
     """
     Base class for instance tests
+
+    The cache is cleared before each test, to isolate the tests from each other and from previous runs -
+    it also holds the Redis data of the scheduler, the GitHub API caches & the rate limit budget. The
+    tests are thus expected to use a dedicated Redis database (see `REDIS_URL` in `.env.test`).
     """
-    pass
+    def setUp(self):
+        super().setUp()
+        cache.clear()
 
 
-class WithUserTestCase(DjangoTestCase):
+class WithUserTestCase(TestCase):
     """
     Base class for instance tests
     """
@@ -35,6 +35,7 @@ class IntegrationTestCase(TestCase):
     Base class for API tests
     """
     def setUp(self):
+        super().setUp()
         # Override the environment setting - always run task in the same process
         djhuey.HUEY.always_eager = True
 
@@ -24,6 +24,8 @@ Instance - Integration Tests
 
 import uuid
 
+from django.test.utils import override_settings
+
 from instance.models.instance import OpenEdXInstance
 from instance.tests.integration.base import IntegrationTestCase
 from instance.tasks import provision_instance
@@ -35,9 +37,10 @@ class InstanceIntegrationTestCase(IntegrationTestCase):
     """
     Integration test cases for instance high-level tasks
     """
+    @override_settings(SERVER_STATUS_RECONCILER=False)
     def test_provision_instance(self):
         """
-        Provision an instance
+        Provision an instance - the periodic tasks don't run, so the servers query their own status
         """
         uid = str(uuid.uuid4())[:8]
         instance = OpenEdXInstance.objects.create(
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+#
+# OpenCraft -- tools to aid developing and hosting free software projects
+# Copyright (C) 2015 OpenCraft <xavier@opencraft.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+ServerImage model - Factories
+"""
+
+# Imports #####################################################################
+
+import factory
+from factory.django import DjangoModelFactory
+
+from instance.models.image import ServerImage
+
+
+# Classes #####################################################################
+
+class ServerImageFactory(DjangoModelFactory):
+    """
+    Factory for an available ServerImage, matching the default versions of `OpenEdXInstanceFactory`
+    """
+    class Meta: #pylint: disable=missing-docstring
+        model = ServerImage
+
+    openstack_image_id = factory.Sequence('image-id{}'.format)
+    status = ServerImage.AVAILABLE
+    ansible_source_repo_url = 'https://github.com/edx/configuration.git'
+    configuration_version = 'master'
+    ansible_playbook_name = 'edx_sandbox'
+    forum_version = 'master'
+    notifier_version = 'master'
+    xqueue_version = 'master'
+    certs_version = 'master'
@@ -129,3 +129,11 @@ class BootedOpenStackServerFactory(OpenStackServerFactory):
     """
     status = OpenStackServer.BOOTED
     openstack_id = factory.Sequence('booted-server-id{}'.format)
+
+
+class ReadyOpenStackServerFactory(OpenStackServerFactory):
+    """
+    Factory for a server with a 'ready' status
+    """
+    status = OpenStackServer.READY
+    openstack_id = factory.Sequence('ready-server-id{}'.format)
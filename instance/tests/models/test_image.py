@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+#
+# OpenCraft -- tools to aid developing and hosting free software projects
+# Copyright (C) 2015 OpenCraft <xavier@opencraft.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+ServerImage model - Tests
+"""
+
+# Imports #####################################################################
+
+from freezegun import freeze_time
+from mock import Mock, patch
+from novaclient.exceptions import Forbidden
+
+from instance.models.image import ServerImage, ServerImageTimeout
+from instance.tests.base import TestCase
+from instance.tests.models.factories.image import ServerImageFactory
+from instance.tests.models.factories.instance import OpenEdXInstanceFactory
+from instance.tests.models.factories.server import ReadyOpenStackServerFactory
+
+
+# Tests #######################################################################
+
+# Factory boy doesn't properly support pylint+django
+#pylint: disable=no-member
+
+class ServerImageTestCase(TestCase):
+    """
+    Test cases for ServerImage models
+    """
+    def test_find_for_instance(self):
+        """
+        The available image with the same configuration & the most versions in common is used
+        """
+        instance = OpenEdXInstanceFactory(forum_version='forum-1', xqueue_version='xqueue-1')
+        self.assertIsNone(ServerImage.objects.find_for_instance(instance))
+
+        ServerImageFactory(configuration_version='other-configuration', forum_version='forum-1',
+                           xqueue_version='xqueue-1')
+        ServerImageFactory(forum_version='forum-1', xqueue_version='xqueue-1', status=ServerImage.SAVING)
+        self.assertIsNone(ServerImage.objects.find_for_instance(instance))
+
+        with freeze_time('2015-08-05 18:00:00'):
+            best_image = ServerImageFactory(forum_version='forum-1')
+        with freeze_time('2015-08-05 19:00:00'):
+            ServerImageFactory(forum_version='forum-2')
+        self.assertEqual(ServerImage.objects.find_for_instance(instance), best_image)
+
+        with freeze_time('2015-08-05 20:00:00'):
+            best_image = ServerImageFactory(forum_version='forum-1', xqueue_version='xqueue-2')
+        self.assertEqual(ServerImage.objects.find_for_instance(instance), best_image)
+
+    @patch('instance.models.image.openstack.create_server_image')
+    def test_create_from_server(self, mock_create_server_image):
+        """
+        Snapshot a server, unless an image with the same versions already exists
+        """
+        mock_create_server_image.return_value = 'new-image-id'
+        instance = OpenEdXInstanceFactory(sub_domain='snapshot', forum_version='forum-1')
+        server = ReadyOpenStackServerFactory(instance=instance)
+        ServerImageFactory(forum_version='forum-2')
+
+        with freeze_time('2015-08-05 18:00:00'):
+            image = ServerImage.objects.create_from_server(server)
+        mock_create_server_image.assert_called_once_with(server.nova, server.openstack_id, 'snapshot-20150805180000')
+        self.assertEqual(image.openstack_image_id, 'new-image-id')
+        self.assertEqual(image.status, ServerImage.SAVING)
+        self.assertEqual(image.forum_version, 'forum-1')
+        self.assertEqual(image.configuration_version, instance.configuration_version)
+
+        self.assertIsNone(ServerImage.objects.create_from_server(server))
+        self.assertEqual(mock_create_server_image.call_count, 1)
+
+    @patch('instance.models.image.openstack.create_server_image')
+    def test_create_from_server_error(self, mock_create_server_image):
+        """
+        Failing to snapshot a server doesn't interrupt the provisioning
+        """
+        mock_create_server_image.side_effect = Forbidden(403)
+        server = ReadyOpenStackServerFactory()
+        self.assertIsNone(ServerImage.objects.create_from_server(server))
+        self.assertEqual(ServerImage.objects.count(), 0)
+
+    @patch('instance.models.image.openstack.delete_image')
+    @patch('instance.models.image.openstack.get_image_status')
+    def test_update_status(self, mock_get_image_status, mock_delete_image):
+        """
+        Images become available once saved, and are deleted when they fail to save
+        """
+        nova = Mock()
+        image = ServerImageFactory(status=ServerImage.SAVING)
+        mock_get_image_status.return_value = 'SAVING'
+        image.update_status(nova)
+        self.assertEqual(ServerImage.objects.get(pk=image.pk).status, ServerImage.SAVING)
+
+        mock_get_image_status.return_value = 'ACTIVE'
+        image.update_status(nova)
+        self.assertEqual(ServerImage.objects.get(pk=image.pk).status, ServerImage.AVAILABLE)
+
+        failed_image = ServerImageFactory(status=ServerImage.SAVING)
+        mock_get_image_status.return_value = 'ERROR'
+        failed_image.update_status(nova)
+        mock_delete_image.assert_called_once_with(nova, failed_image.openstack_image_id)
+        self.assertFalse(ServerImage.objects.filter(pk=failed_image.pk).exists())
+
+    @patch('instance.models.image.time.sleep')
+    @patch('instance.models.image.openstack.delete_image')
+    @patch('instance.models.image.openstack.get_image_status')
+    def test_sleep_until_saved(self, mock_get_image_status, mock_delete_image, mock_sleep):
+        """
+        Wait until OpenStack has saved the image
+        """
+        nova = Mock()
+        image = ServerImageFactory(status=ServerImage.SAVING)
+        mock_get_image_status.side_effect = ['QUEUED', 'SAVING', 'ACTIVE']
+        self.assertTrue(image.sleep_until_saved(nova))
+        self.assertEqual(mock_sleep.call_count, 2)
+
+        failed_image = ServerImageFactory(status=ServerImage.SAVING)
+        mock_get_image_status.side_effect = ['SAVING', 'ERROR']
+        self.assertFalse(failed_image.sleep_until_saved(nova))
+        self.assertEqual(mock_delete_image.call_count, 1)
+
+    @patch('instance.models.image.openstack.get_image_status')
+    @patch('instance.models.image.time.time')
+    @patch('instance.models.image.time.sleep')
+    def test_sleep_until_saved_timeout(self, mock_sleep, mock_time, mock_get_image_status):
+        """
+        Waiting for an image which is never saved
+        """
+        image = ServerImageFactory(status=ServerImage.SAVING)
+        mock_get_image_status.return_value = 'SAVING'
+        mock_time.return_value = 1000
+        mock_sleep.side_effect = lambda interval: setattr(mock_time, 'return_value', mock_time.return_value + 600)
+
+        with self.assertRaises(ServerImageTimeout):
+            image.sleep_until_saved(Mock())
+        self.assertEqual(mock_sleep.call_count, 3)
+
+        mock_sleep.reset_mock()
+        with self.assertRaises(ServerImageTimeout):
+            image.sleep_until_saved(Mock(), deadline=mock_time.return_value + 300)
+        self.assertEqual(mock_sleep.call_count, 1)
+
+    @patch('instance.models.image.openstack.delete_image')
+    def test_delete_unused(self, mock_delete_image):
+        """
+        Only the most recently used available images are kept
+        """
+        nova = Mock()
+        image_list = []
+        for day in range(1, 5):
+            with freeze_time('2015-08-0{} 18:00:00'.format(day)):
+                image_list.append(ServerImageFactory())
+        with freeze_time('2015-08-06 18:00:00'):
+            image_list[0].mark_used()
+        saving_image = ServerImageFactory(status=ServerImage.SAVING)
+
+        ServerImage.objects.delete_unused(nova, 2)
+        self.assertEqual(set(ServerImage.objects.all()), {image_list[0], image_list[3], saving_image})
+        self.assertEqual(mock_delete_image.call_count, 2)
@@ -23,14 +23,22 @@ OpenEdXInstance model - Tests
 # Imports #####################################################################
 
 import re
-from mock import call, patch
-
-from instance.models.server import OpenStackServer
-from instance.models.instance import InconsistentInstanceState, OpenEdXInstance
+import threading
+from datetime import datetime
+from freezegun import freeze_time
+from mock import ANY, call, patch
+
+from django.conf import settings
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from instance.models.server import OpenStackServer, ServerStatusTimeout
+from instance.models.image import ServerImage
+from instance.models.instance import InconsistentInstanceState, InstanceNotReady, OpenEdXInstance
 from instance.tests.base import TestCase
 from instance.tests.models.factories.instance import OpenEdXInstanceFactory
 from instance.tests.models.factories.server import (
-    StartedOpenStackServerFactory, BootedOpenStackServerFactory, patch_os_server)
+    StartedOpenStackServerFactory, BootedOpenStackServerFactory, ReadyOpenStackServerFactory, patch_os_server)
 
 
 # Tests #######################################################################
@@ -94,12 +102,28 @@ class InstanceTestCase(TestCase):
         server.save()
         self.assertEqual(instance.status, instance.EMPTY)
 
+    def test_status_next_server(self):
+        """
+        While a next server is provisioned alongside the current one, the instance status is the next server's
+        """
+        instance = OpenEdXInstanceFactory()
+        current_server = ReadyOpenStackServerFactory(instance=instance)
+        self.assertEqual(instance.status, instance.READY)
+        self.assertEqual(instance.current_server, current_server)
+        self.assertIsNone(instance.next_server)
+
+        next_server = BootedOpenStackServerFactory(instance=instance)
+        self.assertEqual(instance.status, instance.BOOTED)
+        self.assertEqual(instance.current_server, current_server)
+        self.assertEqual(instance.next_server, next_server)
+
     def test_status_multiple_servers(self):
         """
-        Instance status should not allow multiple active servers
+        Instance status should not allow more than two active servers
         """
         instance = OpenEdXInstanceFactory()
         StartedOpenStackServerFactory(instance=instance)
+        StartedOpenStackServerFactory(instance=instance)
         self.assertEqual(instance.status, instance.STARTED)
         StartedOpenStackServerFactory(instance=instance)
         with self.assertRaises(InconsistentInstanceState):
@@ -315,19 +339,25 @@ class AnsibleInstanceTestCase(TestCase):
 
     @patch('instance.models.instance.OpenEdXInstance.vars_str')
     @patch('instance.models.instance.OpenEdXInstance.inventory_str')
+    @patch('instance.models.instance.ansible.get_venv_cache_stats')
+    @patch('instance.models.instance.ansible.get_venv')
     @patch('instance.models.instance.ansible.run_playbook')
     @patch('instance.models.instance.open_repository')
-    def test_run_playbook(self, mock_open_repo, mock_run_playbook, mock_inventory, mock_vars):
+    def test_run_playbook(self, mock_open_repo, mock_run_playbook, mock_get_venv, mock_get_venv_cache_stats,
+                          mock_inventory, mock_vars):
         """
         Run the default playbook
         """
         instance = OpenEdXInstanceFactory()
         BootedOpenStackServerFactory(instance=instance)
         mock_open_repo.return_value.__enter__.return_value.working_dir = '/cloned/configuration-repo/path'
+        mock_get_venv.return_value.__enter__.return_value = ('/cached/venv', True)
+        mock_get_venv_cache_stats.return_value = {'hits': 3, 'misses': 1}
 
         instance.run_playbook()
+        mock_get_venv.assert_called_once_with('/cloned/configuration-repo/path/requirements.txt')
         self.assertIn(call(
-            '/cloned/configuration-repo/path/requirements.txt',
+            '/cached/venv',
             mock_inventory,
             mock_vars,
             '/cloned/configuration-repo/path/playbooks',
@@ -335,6 +365,30 @@ class AnsibleInstanceTestCase(TestCase):
             username='ubuntu',
         ), mock_run_playbook.mock_calls)
 
+    @patch('instance.models.instance.OpenEdXInstance.inventory_str')
+    @patch('instance.models.instance.ansible.get_venv_cache_stats')
+    @patch('instance.models.instance.ansible.run_playbook')
+    @patch('instance.models.instance.open_repository')
+    def test_run_playbook_prepared(self, mock_open_repo, mock_run_playbook, mock_get_venv_cache_stats,
+                                   mock_inventory):
+        """
+        Run the default playbook with a configuration & vars prepared beforehand
+        """
+        instance = OpenEdXInstanceFactory()
+        BootedOpenStackServerFactory(instance=instance)
+        mock_get_venv_cache_stats.return_value = {'hits': 3, 'misses': 1}
+
+        instance.run_playbook(configuration=('/prepared/playbooks', '/prepared/venv', False), vars_str='VARS: 1')
+        self.assertEqual(mock_open_repo.call_count, 0)
+        self.assertIn(call(
+            '/prepared/venv',
+            mock_inventory,
+            'VARS: 1',
+            '/prepared/playbooks',
+            'edx_sandbox.yml',
+            username='ubuntu',
+        ), mock_run_playbook.mock_calls)
+
 
 class OpenEdXInstanceTestCase(TestCase):
     """
@@ -387,33 +441,238 @@ class OpenEdXInstanceTestCase(TestCase):
     @patch('instance.models.server.OpenStackServer.update_status')
     @patch('instance.models.server.OpenStackServer.sleep_until_status')
     @patch('instance.models.server.OpenStackServer.reboot')
-    @patch('instance.models.instance.gandi.set_dns_record')
+    @patch('instance.models.instance.gandi.set_dns_records')
     @patch('instance.models.instance.OpenEdXInstance.run_playbook')
-    def test_provision(self, os_server_manager, mock_run_playbook, mock_set_dns_record, mock_server_reboot,
-                       mock_sleep_until_status, mock_update_status, mock_openstack_create_server):
+    @patch('instance.models.instance.OpenEdXInstance.prepare_configuration')
+    def test_provision(self, os_server_manager, mock_prepare_configuration, mock_run_playbook, mock_set_dns_record,
+                       mock_server_reboot, mock_sleep_until_status, mock_update_status,
+                       mock_openstack_create_server):
         """
         Run provisioning sequence
         """
         mock_openstack_create_server.return_value.id = 'test-run-provisioning-server'
         os_server_manager.add_fixture('test-run-provisioning-server', 'openstack/api_server_2_active.json')
+        configuration = ('/cloned/configuration-repo/path/playbooks', '/cached/venv', True)
+        mock_prepare_configuration.return_value.__enter__.return_value = configuration
 
         instance = OpenEdXInstanceFactory(sub_domain='run.provisioning')
-        instance.provision()
-        self.assertEqual(mock_set_dns_record.mock_calls, [
-            call(name='run.provisioning', type='A', value='192.168.100.200'),
-            call(name='studio.run.provisioning', type='CNAME', value='run.provisioning'),
+        with freeze_time('2015-08-05 18:00:00'):
+            instance.provision()
+        self.assertEqual(mock_set_dns_record.mock_calls, [call([
+            dict(name='run.provisioning', type='A', value='192.168.100.200'),
+            dict(name='studio.run.provisioning', type='CNAME', value='run.provisioning'),
+        ])])
+        deadline = datetime(2015, 8, 5, 18, 0, tzinfo=timezone.utc).timestamp() + instance.PROVISIONING_TIMEOUT
+        self.assertEqual(mock_sleep_until_status.mock_calls, [
+            call([OpenStackServer.ACTIVE, OpenStackServer.BOOTED], deadline=deadline),
+            call(OpenStackServer.BOOTED, deadline=deadline),
+            call(OpenStackServer.READY, deadline=deadline),
         ])
-        self.assertEqual(mock_run_playbook.call_count, 1)
+        mock_run_playbook.assert_called_once_with(configuration=configuration, vars_str=instance.vars_str, tags=None)
+        self.assertEqual(mock_prepare_configuration.return_value.__exit__.call_count, 1)
         self.assertEqual(mock_server_reboot.call_count, 1)
 
+    @patch_os_server
+    @patch('instance.models.server.openstack.create_server')
+    @patch('instance.models.server.OpenStackServer.update_status')
+    @patch('instance.models.server.OpenStackServer.sleep_until_status')
+    @patch('instance.models.server.OpenStackServer.reboot')
+    @patch('instance.models.instance.gandi.set_dns_records')
+    @patch('instance.models.instance.OpenEdXInstance.run_playbook')
+    @patch('instance.models.instance.OpenEdXInstance.prepare_configuration')
+    def test_provision_blue_green(self, os_server_manager, mock_prepare_configuration, mock_run_playbook,
+                                  mock_set_dns_record, mock_server_reboot, mock_sleep_until_status,
+                                  mock_update_status, mock_openstack_create_server):
+        """
+        The ready server of the instance stays live until the new server is ready
+        """
+        mock_openstack_create_server.return_value.id = 'test-run-provisioning-server'
+        os_server_manager.add_fixture('test-run-provisioning-server', 'openstack/api_server_2_active.json')
+        instance = OpenEdXInstanceFactory(sub_domain='run.provisioning.bluegreen')
+        previous_server = ReadyOpenStackServerFactory(instance=instance)
+        failed_server = BootedOpenStackServerFactory(instance=instance)
+
+        def sleep_until_status(target_status, deadline=None): #pylint: disable=unused-argument
+            """
+            The previous server is only terminated, and the DNS switched, once the new server is ready
+            """
+            previous_server.refresh_from_db()
+            self.assertEqual(previous_server.status, OpenStackServer.READY)
+            if target_status != OpenStackServer.READY:
+                self.assertEqual(mock_set_dns_record.call_count, 0)
+        mock_sleep_until_status.side_effect = sleep_until_status
+
+        with override_settings(BLUE_GREEN_PROVISIONING=True):
+            server, _ = instance.provision()
+        self.assertEqual(mock_set_dns_record.mock_calls, [call([
+            dict(name='run.provisioning.bluegreen', type='A', value='192.168.100.200'),
+            dict(name='studio.run.provisioning.bluegreen', type='CNAME', value='run.provisioning.bluegreen'),
+        ])])
+        self.assertEqual(list(instance.active_server_set), [server])
+        failed_server.refresh_from_db()
+        self.assertEqual(failed_server.status, OpenStackServer.TERMINATED)
+
+    @patch_os_server
+    @patch('instance.models.server.openstack.create_server')
+    @patch('instance.models.server.OpenStackServer.update_status')
+    @patch('instance.models.server.OpenStackServer.sleep_until_status')
+    @patch('instance.models.instance.gandi.set_dns_records')
+    @patch('instance.models.instance.OpenEdXInstance.run_playbook')
+    @patch('instance.models.instance.OpenEdXInstance.prepare_configuration')
+    def test_provision_blue_green_failed(self, os_server_manager, mock_prepare_configuration, mock_run_playbook,
+                                         mock_set_dns_record, mock_sleep_until_status, mock_update_status,
+                                         mock_openstack_create_server):
+        """
+        When the new server fails to provision, it is terminated and the ready server stays live
+        """
+        mock_openstack_create_server.return_value.id = 'test-run-provisioning-server'
+        os_server_manager.add_fixture('test-run-provisioning-server', 'openstack/api_server_2_active.json')
+        instance = OpenEdXInstanceFactory(sub_domain='run.provisioning.bluegreen.failed')
+        previous_server = ReadyOpenStackServerFactory(instance=instance)
+        mock_run_playbook.side_effect = RuntimeError('Playbook failed')
+
+        with override_settings(BLUE_GREEN_PROVISIONING=True), self.assertRaises(RuntimeError):
+            instance.provision()
+        self.assertEqual(mock_set_dns_record.call_count, 0)
+        self.assertEqual(list(instance.active_server_set), [previous_server])
+        self.assertEqual(instance.server_set.get(openstack_id='test-run-provisioning-server').status,
+                         OpenStackServer.TERMINATED)
+        self.assertEqual(instance.status, instance.READY)
+
+    @override_settings(ANSIBLE_REDEPLOY_TAGS='install:code,migrate')
+    @patch('instance.models.server.OpenStackServer.public_ip', '192.168.100.200')
+    @patch('instance.models.instance.gandi.set_dns_records')
+    @patch('instance.models.instance.OpenEdXInstance.run_playbook')
+    def test_redeploy(self, mock_run_playbook, mock_set_dns_record):
+        """
+        The code is deployed on the ready server, without recreating it
+        """
+        instance = OpenEdXInstanceFactory(sub_domain='run.redeploy')
+        server = ReadyOpenStackServerFactory(instance=instance)
+        mock_run_playbook.return_value = [['Playbook log']]
+
+        self.assertEqual(instance.redeploy(), (server, [['Playbook log']]))
+        mock_run_playbook.assert_called_once_with(tags='install:code,migrate', inventory_str='[app]\n192.168.100.200')
+        self.assertEqual(mock_set_dns_record.call_count, 0)
+        self.assertEqual(list(instance.active_server_set), [server])
+        self.assertEqual(instance.status, instance.READY)
+
+    @patch('instance.models.instance.OpenEdXInstance.run_playbook')
+    def test_redeploy_not_ready(self, mock_run_playbook):
+        """
+        Instances are only redeployed when their current server is ready, and isn't being replaced
+        """
+        instance = OpenEdXInstanceFactory()
+        with self.assertRaises(InstanceNotReady):
+            instance.redeploy()
+
+        ReadyOpenStackServerFactory(instance=instance)
+        BootedOpenStackServerFactory(instance=instance)
+        with self.assertRaises(InstanceNotReady):
+            instance.redeploy()
+        self.assertEqual(mock_run_playbook.call_count, 0)
+
+    @override_settings(OPENSTACK_SANDBOX_SNAPSHOTS=True, ANSIBLE_SNAPSHOT_DEPLOY_TAGS='install:code')
+    @patch_os_server
+    @patch('instance.models.image.openstack.get_image_status')
+    @patch('instance.models.image.openstack.create_server_image')
+    @patch('instance.models.server.openstack.create_server')
+    @patch('instance.models.server.OpenStackServer.update_status')
+    @patch('instance.models.server.OpenStackServer.sleep_until_status')
+    @patch('instance.models.server.OpenStackServer.reboot')
+    @patch('instance.models.instance.gandi.set_dns_records')
+    @patch('instance.models.instance.OpenEdXInstance.run_playbook')
+    @patch('instance.models.instance.OpenEdXInstance.prepare_configuration')
+    def test_provision_snapshot(self, os_server_manager, mock_prepare_configuration, mock_run_playbook,
+                                mock_set_dns_record, mock_server_reboot, mock_sleep_until_status,
+                                mock_update_status, mock_openstack_create_server, mock_create_server_image,
+                                mock_get_image_status):
+        """
+        The base stage of the first server provisioned with a set of versions is snapshotted, before the
+        instance vars are applied, and the next servers are booted from the snapshot, only running the
+        deployment tasks
+        """
+        mock_openstack_create_server.return_value.id = 'test-run-provisioning-server'
+        os_server_manager.add_fixture('test-run-provisioning-server', 'openstack/api_server_2_active.json')
+        configuration = ('/cloned/configuration-repo/path/playbooks', '/cached/venv', True)
+        mock_prepare_configuration.return_value.__enter__.return_value = configuration
+        mock_run_playbook.return_value = [['Playbook log']]
+
+        def create_server_image(nova, openstack_id, image_name): #pylint: disable=unused-argument
+            """
+            The server is snapshotted once the base stage has run, before the instance vars are applied
+            """
+            self.assertEqual(mock_run_playbook.call_count, 1)
+            mock_get_image_status.return_value = 'ACTIVE'
+            return 'test-image-id'
+        mock_create_server_image.side_effect = create_server_image
+
+        instance = OpenEdXInstanceFactory(sub_domain='run.provisioning.snapshot', s3_access_key='s3-key',
+                                          s3_secret_access_key='s3cr3t', s3_bucket_name='s3-bucket')
+        server, ansible_log = instance.provision()
+        self.assertEqual(mock_openstack_create_server.mock_calls[0][1][3], settings.OPENSTACK_SANDBOX_BASE_IMAGE)
+        self.assertEqual(mock_run_playbook.mock_calls, [
+            call(configuration=configuration, vars_str=instance.snapshot_vars_str, skip_tags='install:code'),
+            call(configuration=configuration, vars_str=instance.vars_str, tags='install:code'),
+        ])
+        self.assertIn('s3cr3t', instance.vars_str)
+        self.assertNotIn('s3cr3t', instance.snapshot_vars_str)
+        self.assertNotIn(instance.domain, instance.snapshot_vars_str)
+        self.assertEqual(ansible_log, [['Playbook log'], ['Playbook log']])
+        mock_create_server_image.assert_called_once_with(server.nova, server.openstack_id, ANY)
+        image = ServerImage.objects.get()
+        self.assertEqual(image.openstack_image_id, 'test-image-id')
+        self.assertEqual(image.status, ServerImage.AVAILABLE)
+
+        mock_run_playbook.reset_mock()
+        other_instance = OpenEdXInstanceFactory(sub_domain='run.provisioning.snapshot2')
+        other_instance.provision()
+        self.assertEqual(mock_openstack_create_server.mock_calls[-1][1][3], {'id': 'test-image-id'})
+        mock_run_playbook.assert_called_once_with(configuration=configuration, vars_str=other_instance.vars_str,
+                                                  tags='install:code')
+        self.assertEqual(mock_create_server_image.call_count, 1)
+        self.assertGreater(ServerImage.objects.get().last_used, image.last_used)
+
+    @patch_os_server
+    @patch('instance.models.server.openstack.create_server')
+    @patch('instance.models.server.OpenStackServer.sleep_until_status')
+    @patch('instance.models.instance.gandi.set_dns_records')
+    @patch('instance.models.instance.OpenEdXInstance.run_playbook')
+    @patch('instance.models.instance.OpenEdXInstance.prepare_configuration')
+    def test_provision_pipelined(self, os_server_manager, mock_prepare_configuration, mock_run_playbook,
+                                 mock_set_dns_record, mock_sleep_until_status, mock_openstack_create_server):
+        """
+        The configuration is prepared while the server boots, and cleaned up if the provisioning fails
+        """
+        mock_openstack_create_server.return_value.id = 'test-run-provisioning-server'
+        os_server_manager.add_fixture('test-run-provisioning-server', 'openstack/api_server_2_active.json')
+        configuration_ready = threading.Event()
+        mock_prepare_configuration.return_value.__enter__.side_effect = lambda: configuration_ready.set()
+
+        def sleep_until_status(target_status, deadline=None): #pylint: disable=unused-argument
+            """
+            The server boots while the configuration is being prepared, then fails to become reachable
+            """
+            self.assertTrue(configuration_ready.wait(5))
+            if target_status == OpenStackServer.BOOTED:
+                raise ServerStatusTimeout('Timeout')
+        mock_sleep_until_status.side_effect = sleep_until_status
+
+        instance = OpenEdXInstanceFactory(sub_domain='run.provisioning.pipelined')
+        with self.assertRaises(ServerStatusTimeout):
+            instance.provision()
+        self.assertEqual(mock_run_playbook.call_count, 0)
+        self.assertEqual(mock_prepare_configuration.return_value.__exit__.call_count, 1)
+
     @patch_os_server
     @patch('instance.models.server.OpenStackServer.update_status', autospec=True)
     @patch('instance.models.server.time.sleep')
     @patch('instance.models.server.OpenStackServer.reboot')
-    @patch('instance.models.instance.gandi.set_dns_record')
+    @patch('instance.models.instance.gandi.set_dns_records')
     @patch('instance.models.instance.OpenEdXInstance.run_playbook')
-    def test_provision_no_active(self, os_server_manager, mock_run_playbook, mock_set_dns_record,
-                                 mock_server_reboot, mock_sleep, mock_update_status):
+    @patch('instance.models.instance.OpenEdXInstance.prepare_configuration')
+    def test_provision_no_active(self, os_server_manager, mock_prepare_configuration, mock_run_playbook,
+                                 mock_set_dns_record, mock_server_reboot, mock_sleep, mock_update_status):
         """
         Run provisioning sequence, with status jumping from 'started' to 'booted' (no 'active')
         """
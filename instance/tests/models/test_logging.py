@@ -23,10 +23,14 @@ Logger models & mixins - Tests
 # Imports #####################################################################
 
 from freezegun import freeze_time
+from mock import patch
 
+from instance.models.logging import InstanceLogEntry, ServerLogEntry
+from instance.models.logging_mixin import LogEntryBuffer
+from instance.models.server import OpenStackServer
 from instance.tests.base import TestCase
 from instance.tests.models.factories.instance import OpenEdXInstanceFactory
-from instance.tests.models.factories.server import OpenStackServerFactory
+from instance.tests.models.factories.server import OpenStackServerFactory, ReadyOpenStackServerFactory
 
 
 # Tests #######################################################################
@@ -73,3 +77,204 @@ class LoggerInstanceMixinTestCase(TestCase):
             "2015-08-05 18:07:04 [warn] Line #5, on instance (warn)\n"
             "2015-08-05 18:07:05 [info] Line #6, on server\n"
             "2015-08-05 18:07:06 [exception] Line #7, on server (exception)\n"))
+
+    def test_log_text_next_server(self):
+        """
+        Check `log_text` output while a next server is provisioned alongside the current one
+        """
+        instance = OpenEdXInstanceFactory()
+        with freeze_time("2015-08-05 18:07:00"):
+            current_server = ReadyOpenStackServerFactory(instance=instance)
+            current_server.log('info', 'Line #1, on current server')
+            instance.log('info', 'Line #2, on instance')
+
+        with freeze_time("2015-08-05 18:07:01"):
+            next_server = OpenStackServerFactory(instance=instance)
+            next_server.log('info', 'Line #3, on next server')
+
+        with freeze_time("2015-08-05 18:07:02"):
+            current_server.log('info', 'Line #4, on current server')
+
+        with freeze_time("2015-08-05 18:07:03"):
+            next_server.log('info', 'Line #5, on next server')
+
+        self.assertEqual(instance.log_text, (
+            "2015-08-05 18:07:00 [info] Line #2, on instance\n"
+            "2015-08-05 18:07:00 [info] Line #1, on current server\n"
+            "2015-08-05 18:07:01 [info] Line #3, on next server\n"
+            "2015-08-05 18:07:02 [info] Line #4, on current server\n"
+            "2015-08-05 18:07:03 [info] Line #5, on next server\n"))
+
+    def test_log_text_no_server(self):
+        """
+        Check `log_text` output for an instance without active servers
+        """
+        instance = OpenEdXInstanceFactory()
+        with freeze_time("2015-08-05 18:07:00"):
+            instance.log('info', 'Line #1, on instance')
+        self.assertEqual(instance.log_text, "2015-08-05 18:07:00 [info] Line #1, on instance\n")
+
+    def test_log_text_terminated_server(self):
+        """
+        Check `log_text` output includes the logs of the servers of previous provisionings
+        """
+        instance = OpenEdXInstanceFactory()
+        with freeze_time("2015-08-05 18:07:00"):
+            old_server = OpenStackServerFactory(instance=instance, status=OpenStackServer.TERMINATED)
+            old_server.log('info', 'Line #1, on old server')
+
+        with freeze_time("2015-08-05 18:07:01"):
+            server = OpenStackServerFactory(instance=instance)
+            server.log('info', 'Line #2, on server')
+
+        self.assertEqual(instance.log_text, (
+            "2015-08-05 18:07:00 [info] Line #1, on old server\n"
+            "2015-08-05 18:07:01 [info] Line #2, on server\n"))
+
+    def test_get_log_entries_query_count(self):
+        """
+        The merged log is read with a constant number of queries
+        """
+        instance = OpenEdXInstanceFactory()
+        server_list = [OpenStackServerFactory(instance=instance) for _ in range(3)]
+        for entry_index in range(10):
+            instance.log('info', 'Entry #{}, on instance'.format(entry_index))
+            for server in server_list:
+                server.log('info', 'Entry #{}, on server {}'.format(entry_index, server.pk))
+
+        # Last entry ids, merged log query, & instance/server log entries
+        with self.assertNumQueries(5):
+            log_entry_iterator, _ = instance.get_log_entries()
+            self.assertEqual(len(list(log_entry_iterator)), 40)
+
+    def test_get_log_entries_pages(self):
+        """
+        Read the log page by page, then tail it with the cursor
+        """
+        instance = OpenEdXInstanceFactory()
+        server = OpenStackServerFactory(instance=instance)
+        with freeze_time("2015-08-05 18:07:00"):
+            instance.log('info', 'Line #1, on instance')
+            server.log('info', 'Line #2, on server')
+            server.log('debug', 'Line #3, on server (debug, not published)')
+        with freeze_time("2015-08-05 18:07:01"):
+            instance.log('info', 'Line #4, on instance')
+            server.log('info', 'Line #5, on server')
+
+        log_entry_iterator, cursor = instance.get_log_entries(limit=2)
+        self.assertEqual([log_entry.text for log_entry in log_entry_iterator],
+                         ['Line #1, on instance', 'Line #2, on server'])
+        log_entry_iterator, cursor = instance.get_log_entries(cursor=cursor, limit=2)
+        self.assertEqual([log_entry.text for log_entry in log_entry_iterator],
+                         ['Line #4, on instance', 'Line #5, on server'])
+        log_entry_iterator, cursor = instance.get_log_entries(cursor=cursor, limit=2)
+        self.assertEqual(list(log_entry_iterator), [])
+
+        with freeze_time("2015-08-05 18:07:02"):
+            server.log('info', 'Line #6, on server')
+        log_entry_iterator, next_cursor = instance.get_log_entries(cursor=cursor)
+        self.assertEqual([log_entry.text for log_entry in log_entry_iterator], ['Line #6, on server'])
+        self.assertEqual(next_cursor, (cursor[0], server.logentry_set.get(text='Line #6, on server').pk))
+
+    def test_get_log_entries_pages_buffered(self):
+        """
+        Entries saved after more recent ones, by a log buffer, aren't skipped across pages
+        """
+        instance = OpenEdXInstanceFactory()
+        server = OpenStackServerFactory(instance=instance)
+        log_buffer = LogEntryBuffer(instance, max_count=10, max_delay=60)
+        with freeze_time("2015-08-05 18:07:00"):
+            log_buffer.log('info', 'Line #1, buffered on instance')
+            log_buffer.log('info', 'Line #2, buffered on instance')
+            server.log('info', 'Line #3, on server')
+        with freeze_time("2015-08-05 18:07:01"):
+            instance.log('info', 'Line #4, on instance')
+        with freeze_time("2015-08-05 18:07:02"):
+            server.log('info', 'Line #5, on server')
+            log_buffer.flush()
+
+        page_list = []
+        cursor = None
+        while not page_list or page_list[-1]:
+            log_entry_iterator, cursor = instance.get_log_entries(cursor=cursor, limit=2)
+            page_list.append([log_entry.text for log_entry in log_entry_iterator])
+        self.assertEqual(page_list, [
+            ['Line #3, on server', 'Line #4, on instance'],
+            ['Line #1, buffered on instance', 'Line #2, buffered on instance'],
+            ['Line #5, on server'],
+            [],
+        ])
+
+    def test_get_log_entries_since(self):
+        """
+        Only read the entries created after a given time
+        """
+        instance = OpenEdXInstanceFactory()
+        server = OpenStackServerFactory(instance=instance)
+        with freeze_time("2015-08-05 18:07:00"):
+            instance.log('info', 'Line #1, on instance')
+        with freeze_time("2015-08-05 18:07:01"):
+            server.log('info', 'Line #2, on server')
+
+        log_entry_iterator, _ = instance.get_log_entries(since=server.logentry_set.get().created)
+        self.assertEqual(list(log_entry_iterator), [])
+        log_entry_iterator, _ = instance.get_log_entries(since=instance.logentry_set.get().created)
+        self.assertEqual([log_entry.text for log_entry in log_entry_iterator], ['Line #2, on server'])
+
+
+@patch('instance.models.logging.publish_data')
+class LogEntryBufferTestCase(TestCase):
+    """
+    Test cases for LogEntryBuffer
+    """
+    def test_flush_max_count(self, mock_publish_data):
+        """
+        Entries are saved & published in a single batch once the buffer is full
+        """
+        instance = OpenEdXInstanceFactory()
+        log_buffer = LogEntryBuffer(instance, max_count=3, max_delay=60)
+        log_buffer.log('info', 'Line #1')
+        log_buffer.log('debug', 'Line #2 (debug, not published)')
+        self.assertEqual(InstanceLogEntry.objects.count(), 0)
+
+        with freeze_time("2015-08-05 18:07:00"):
+            log_buffer.log('info', 'Line #3\n')
+        self.assertEqual([log_entry.text for log_entry in instance.logentry_set.order_by('pk')],
+                         ['Line #1', 'Line #2 (debug, not published)', 'Line #3'])
+        self.assertEqual(mock_publish_data.call_count, 1)
+        message = mock_publish_data.mock_calls[0][1][1]
+        self.assertEqual(message['type'], 'instance_log_batch')
+        self.assertEqual(message['instance_id'], instance.pk)
+        self.assertEqual(len(message['log_entries']), 2)
+        self.assertEqual(message['log_entries'][1], '2015-08-05 18:07:00 [info] Line #3')
+
+    def test_flush_max_delay(self, mock_publish_data):
+        """
+        Entries are saved once the oldest one has been buffered for too long
+        """
+        server = OpenStackServerFactory()
+        log_buffer = LogEntryBuffer(server, max_count=100, max_delay=1)
+        with freeze_time("2015-08-05 18:07:00"):
+            log_buffer.log('info', 'Line #1')
+            log_buffer.flush_if_due()
+        with freeze_time("2015-08-05 18:07:00.5"):
+            log_buffer.log('info', 'Line #2')
+        self.assertEqual(ServerLogEntry.objects.count(), 0)
+
+        with freeze_time("2015-08-05 18:07:01"):
+            log_buffer.flush_if_due()
+        self.assertEqual(server.logentry_set.count(), 2)
+        self.assertEqual(mock_publish_data.call_count, 1)
+        self.assertEqual(mock_publish_data.mock_calls[0][1][1]['instance_id'], server.instance.pk)
+
+    def test_flush_on_exception(self, mock_publish_data):
+        """
+        The buffered entries are saved when the context exits on an exception
+        """
+        instance = OpenEdXInstanceFactory()
+        with self.assertRaises(ValueError):
+            with LogEntryBuffer(instance) as log_buffer:
+                log_buffer.log('info', 'Line #1')
+                raise ValueError('Playbook failed')
+        self.assertEqual(instance.logentry_set.get().text, 'Line #1')
+        self.assertEqual(mock_publish_data.call_count, 1)
@@ -23,10 +23,13 @@ OpenStackServer model - Tests
 # Imports #####################################################################
 
 import novaclient
+from freezegun import freeze_time
 from mock import Mock, call, patch
 
-from instance.models.server import OpenStackServer, ServerNotReady
-from instance.tests.base import AnyStringMatching, TestCase
+from django.test.utils import override_settings
+
+from instance.models.server import OpenStackServer, ServerNotReady, ServerStatusTimeout
+from instance.tests.base import AnyStringMatching, TestCase, add_fixture_to_object
 from instance.tests.models.factories.server import OpenStackServerFactory, StartedOpenStackServerFactory
 
 
@@ -49,6 +52,18 @@ class OpenStackServerTestCase(TestCase):
         self.assertEqual(str(server), 'New OpenStack Server')
         self.assertEqual(server.status, server.NEW)
 
+    @patch('instance.models.server.openstack.get_nova_client')
+    def test_nova_client(self, mock_get_nova_client):
+        """
+        Loading servers doesn't create nova clients - the shared client is only retrieved when used
+        """
+        OpenStackServerFactory()
+        server = OpenStackServer.objects.get()
+        self.assertFalse(mock_get_nova_client.called)
+        self.assertEqual(server.nova, mock_get_nova_client.return_value)
+        server.nova = 'specific-client'
+        self.assertEqual(server.nova, 'specific-client')
+
     @patch('instance.models.server.openstack.create_server')
     def test_start_server(self, mock_create_server):
         """
@@ -126,6 +141,7 @@ class OpenStackServerTestCase(TestCase):
         mock_is_port_open.return_value = True
         self.assertEqual(server.update_status(), server.BOOTED)
         self.assertEqual(server.status, server.BOOTED)
+        mock_is_port_open.assert_called_with('192.168.100.200', 22, expected_banner=b'SSH-')
 
     def test_update_status_booted_to_provisioned(self):
         """
@@ -163,6 +179,7 @@ class OpenStackServerTestCase(TestCase):
         self.assertEqual(server.update_status(), server.READY)
         self.assertEqual(server.status, server.READY)
 
+    @override_settings(SERVER_STATUS_RECONCILER=False)
     @patch('instance.models.server.OpenStackServer.update_status')
     @patch('instance.models.server.time.sleep')
     def test_sleep_until_status(self, mock_sleep, mock_update_status):
@@ -183,6 +200,7 @@ class OpenStackServerTestCase(TestCase):
         self.assertEqual(mock_sleep.call_count, 3)
         self.assertEqual(status_queue, [server.TERMINATED])
 
+    @override_settings(SERVER_STATUS_RECONCILER=False)
     @patch('instance.models.server.OpenStackServer.update_status')
     @patch('instance.models.server.time.sleep')
     def test_sleep_until_status_list(self, mock_sleep, mock_update_status):
@@ -201,6 +219,179 @@ class OpenStackServerTestCase(TestCase):
         self.assertEqual(server.sleep_until_status([server.TERMINATED, server.BOOTED]), server.BOOTED)
         self.assertEqual(server.status, server.BOOTED)
 
+    @override_settings(SERVER_STATUS_RECONCILER=False)
+    @patch('instance.models.server.OpenStackServer.update_status')
+    @patch('instance.models.server.time.sleep')
+    def test_sleep_until_status_backoff(self, mock_sleep, mock_update_status):
+        """
+        The delay between status checks increases exponentially, up to a maximum
+        """
+        server = StartedOpenStackServerFactory()
+        status_queue = [server.STARTED] * 6 + [server.ACTIVE]
+        status_queue.reverse() # To be able to use pop()
+
+        def update_status():
+            """ Simulate status progression successive runs """
+            server.status = status_queue.pop()
+        mock_update_status.side_effect = update_status
+
+        self.assertEqual(server.sleep_until_status(server.ACTIVE), server.ACTIVE)
+        self.assertEqual(mock_sleep.mock_calls,
+                         [call(1), call(1.5), call(2.25), call(3.375), call(5.0625), call(7.59375)])
+
+        mock_sleep.reset_mock()
+        status_queue = [server.STARTED] * 3 + [server.ACTIVE]
+        status_queue.reverse()
+        server.STATUS_POLL_INTERVAL_MAX = 2
+        server.sleep_until_status(server.ACTIVE)
+        self.assertEqual(mock_sleep.mock_calls, [call(1), call(1.5), call(2)])
+
+    @override_settings(SERVER_STATUS_RECONCILER=True)
+    @patch('instance.models.server.OpenStackServer.update_status')
+    @patch('instance.models.server.time.sleep')
+    def test_sleep_until_status_updated_in_db(self, mock_sleep, mock_update_status):
+        """
+        With the reconciler, the status saved by the periodic reconciliation is picked up while waiting,
+        without querying OpenStack
+        """
+        server = StartedOpenStackServerFactory()
+
+        def sleep(interval):
+            """ Simulate a status update made by another process while sleeping """
+            OpenStackServer.objects.filter(pk=server.pk).update(status=server.ACTIVE)
+        mock_sleep.side_effect = sleep
+
+        self.assertEqual(server.sleep_until_status(server.ACTIVE), server.ACTIVE)
+        self.assertEqual(mock_update_status.call_count, 0)
+        self.assertEqual(mock_sleep.call_count, 1)
+
+    @override_settings(SERVER_STATUS_RECONCILER=False)
+    @patch('instance.models.server.OpenStackServer.update_status')
+    @patch('instance.models.server.time.time')
+    @patch('instance.models.server.time.sleep')
+    def test_sleep_until_status_timeout(self, mock_sleep, mock_time, mock_update_status):
+        """
+        Waiting for a status which is never reached
+        """
+        server = StartedOpenStackServerFactory()
+        mock_time.return_value = 1000
+        mock_sleep.side_effect = lambda interval: setattr(mock_time, 'return_value', mock_time.return_value + 200)
+
+        with self.assertRaises(ServerStatusTimeout):
+            server.sleep_until_status(server.ACTIVE)
+        self.assertEqual(mock_sleep.call_count, 3) # Timeout for 'active' is 600s
+
+        mock_sleep.reset_mock()
+        with self.assertRaises(ServerStatusTimeout):
+            server.sleep_until_status(server.ACTIVE, timeout=10)
+        self.assertEqual(mock_sleep.call_count, 1)
+
+        mock_sleep.reset_mock()
+        with self.assertRaises(ServerStatusTimeout):
+            server.sleep_until_status(server.ACTIVE, deadline=mock_time.return_value + 300)
+        self.assertEqual(mock_sleep.call_count, 2)
+
+    @patch('instance.models.server.check_ports')
+    @patch('instance.models.server.openstack.get_nova_client')
+    def test_queryset_update_status(self, mock_get_nova_client, mock_check_ports):
+        """
+        Update the status of multiple servers with a single nova API call
+        """
+        mock_check_ports.side_effect = lambda address_list, **kwargs: {address: True for address in address_list}
+        os_server_active = add_fixture_to_object(Mock(), 'openstack/api_server_2_active.json')
+        os_server_building = add_fixture_to_object(Mock(), 'openstack/api_server_1_building.json')
+        os_server_active.id = 'server-active'
+        os_server_building.id = 'server-building'
+        os_server_unlisted = add_fixture_to_object(Mock(), 'openstack/api_server_2_active.json')
+        nova = mock_get_nova_client.return_value
+        nova.servers.list.side_effect = [[os_server_active], [os_server_building], []]
+
+        def servers_get(openstack_id):
+            """ Only the servers left out of the listing can be fetched individually """
+            if openstack_id == 'server-unlisted':
+                return os_server_unlisted
+            raise novaclient.exceptions.NotFound('not-found')
+        nova.servers.get.side_effect = servers_get
+
+        server_started = StartedOpenStackServerFactory(openstack_id='server-active')
+        server_building = StartedOpenStackServerFactory(openstack_id='server-building')
+        server_active = StartedOpenStackServerFactory(openstack_id='server-active', status=OpenStackServer.ACTIVE)
+        server_provisioned = StartedOpenStackServerFactory(openstack_id='server-active',
+                                                           status=OpenStackServer.PROVISIONED)
+        server_missing = StartedOpenStackServerFactory(openstack_id='server-missing')
+        server_unlisted = StartedOpenStackServerFactory(openstack_id='server-unlisted')
+
+        changed_server_list = OpenStackServer.objects.update_status()
+        self.assertEqual(nova.servers.list.mock_calls, [
+            call(detailed=True, marker=None, limit=500),
+            call(detailed=True, marker='server-active', limit=500),
+            call(detailed=True, marker='server-building', limit=500),
+        ])
+        self.assertEqual(sorted(nova.servers.get.mock_calls), [call('server-missing'), call('server-unlisted')])
+        mock_check_ports.assert_called_once_with({('192.168.100.200', 22)}, expected_banner=b'SSH-')
+        self.assertEqual(set(server.pk for server in changed_server_list),
+                         {server_started.pk, server_active.pk, server_missing.pk, server_unlisted.pk})
+
+        def get_status(server):
+            """ Status of the server in the database """
+            return OpenStackServer.objects.get(pk=server.pk).status
+        self.assertEqual(get_status(server_started), OpenStackServer.ACTIVE)
+        self.assertEqual(get_status(server_building), OpenStackServer.STARTED)
+        self.assertEqual(get_status(server_active), OpenStackServer.BOOTED)
+        self.assertEqual(get_status(server_provisioned), OpenStackServer.PROVISIONED)
+        self.assertEqual(get_status(server_missing), OpenStackServer.TERMINATED)
+        self.assertEqual(get_status(server_unlisted), OpenStackServer.ACTIVE)
+
+    @patch('instance.models.server.openstack.get_nova_client')
+    def test_queryset_update_status_unconfirmed(self, mock_get_nova_client):
+        """
+        Servers missing from the listing are left alone when nova can't confirm they were deleted
+        """
+        server = StartedOpenStackServerFactory(openstack_id='server-unconfirmed', status=OpenStackServer.READY)
+        nova = mock_get_nova_client.return_value
+        nova.servers.list.return_value = []
+        nova.servers.get.side_effect = novaclient.exceptions.ClientException(503)
+
+        self.assertEqual(OpenStackServer.objects.update_status(), [])
+        self.assertEqual(OpenStackServer.objects.get(pk=server.pk).status, OpenStackServer.READY)
+
+    @patch('instance.models.server.check_ports')
+    @patch('instance.models.server.openstack.get_nova_client')
+    def test_queryset_update_status_rebooting(self, mock_get_nova_client, mock_check_ports):
+        """
+        Rebooting servers are only considered ready once the reboot grace period is over
+        """
+        mock_check_ports.side_effect = lambda address_list, **kwargs: {address: True for address in address_list}
+        os_server = add_fixture_to_object(Mock(), 'openstack/api_server_2_active.json')
+        os_server.id = 'server-rebooting'
+        mock_get_nova_client.return_value.servers.list.return_value = [os_server]
+
+        with freeze_time('2015-10-01 10:00:00'):
+            server = StartedOpenStackServerFactory(openstack_id='server-rebooting', status=OpenStackServer.REBOOTING)
+        with freeze_time('2015-10-01 10:00:20'):
+            self.assertEqual(OpenStackServer.objects.update_status(), [])
+        self.assertEqual(OpenStackServer.objects.get(pk=server.pk).status, OpenStackServer.REBOOTING)
+        with freeze_time('2015-10-01 10:00:40'):
+            OpenStackServer.objects.update_status()
+        self.assertEqual(OpenStackServer.objects.get(pk=server.pk).status, OpenStackServer.READY)
+
+    @patch('instance.models.server.openstack.get_nova_client')
+    def test_queryset_update_status_changed_meanwhile(self, mock_get_nova_client):
+        """
+        Servers whose status changed since the nova API call are left alone
+        """
+        server = StartedOpenStackServerFactory(openstack_id='server-deleted')
+
+        def servers_list(**kwargs): #pylint: disable=unused-argument
+            """ Simulate a status change made by another process during the API call """
+            OpenStackServer.objects.filter(pk=server.pk).update(status=OpenStackServer.TERMINATED)
+            return []
+        mock_get_nova_client.return_value.servers.list.side_effect = servers_list
+        mock_get_nova_client.return_value.servers.get.side_effect = novaclient.exceptions.NotFound('not-found')
+
+        self.assertEqual(OpenStackServer.objects.update_status(), [])
+        self.assertFalse(server.logentry_set.filter(level='warn'))
+
     @patch('instance.models.server.time.sleep')
     def test_reboot_provisioned_server(self, mock_sleep):
         """
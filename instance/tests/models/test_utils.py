@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+#
+# OpenCraft -- tools to aid developing and hosting free software projects
+# Copyright (C) 2015 OpenCraft <xavier@opencraft.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Models utils - Tests
+"""
+
+# Imports #####################################################################
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from instance.models.instance import OpenEdXInstance
+from instance.tests.base import TestCase
+from instance.tests.models.factories.instance import OpenEdXInstanceFactory
+from instance.tests.models.factories.server import OpenStackServerFactory
+
+
+# Tests #######################################################################
+
+class ValidateModelMixinTestCase(TestCase):
+    """
+    Test cases for ValidateModelMixin
+    """
+    def count_queries(self, func, *args):
+        """
+        Number of database queries run by `func(*args)`
+        """
+        with CaptureQueriesContext(connection) as context:
+            func(*args)
+        return len(context)
+
+    def test_save_fields(self):
+        """
+        Only the listed fields & the modification time are written
+        """
+        instance = OpenEdXInstanceFactory(name='Original name')
+        modified = instance.modified
+        instance.name = 'Not saved'
+        instance.last_provisioning_started = timezone.now()
+        instance.save_fields('last_provisioning_started')
+
+        instance = OpenEdXInstance.objects.get(pk=instance.pk)
+        self.assertEqual(instance.name, 'Original name')
+        self.assertIsNotNone(instance.last_provisioning_started)
+        self.assertGreater(instance.modified, modified)
+
+    def test_save_fields_new_object(self):
+        """
+        Objects which haven't been saved yet are validated & fully saved
+        """
+        instance = OpenEdXInstance(sub_domain='new.save.fields', name='New', commit_id='1' * 40,
+                                   github_organization_name='org', github_repository_name='repo')
+        instance.save_fields('name')
+        self.assertEqual(OpenEdXInstance.objects.get(pk=instance.pk).sub_domain, 'new.save.fields')
+
+    def test_save_fields_queries(self):
+        """
+        Benchmark - the fast path skips the validation queries (unique constraints & foreign keys)
+        """
+        instance = OpenEdXInstanceFactory()
+        instance.last_provisioning_started = timezone.now()
+        save_query_count = self.count_queries(instance.save)
+        save_fields_query_count = self.count_queries(instance.save_fields, 'last_provisioning_started')
+        self.assertEqual(save_fields_query_count, 1)
+        self.assertLess(save_fields_query_count, save_query_count)
+
+    def test_hot_path_queries(self):
+        """
+        Benchmark - server status changes & log entries only run their write queries
+        """
+        server = OpenStackServerFactory()
+        # Status update & its log entry
+        self.assertEqual(self.count_queries(server._set_status, server.STARTED), 2) #pylint: disable=protected-access
+        self.assertEqual(self.count_queries(server.instance.log, 'info', 'Log entry'), 1)
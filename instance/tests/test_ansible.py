@@ -23,10 +23,16 @@ Ansible - Tests
 # Imports #####################################################################
 
 import os.path
+import shutil
+import signal
+import subprocess
 import yaml
 
+from tempfile import mkdtemp
 from unittest.mock import call, patch
 
+from django.core.cache import cache
+
 from instance import ansible
 from instance.tests.base import TestCase
 
@@ -38,6 +44,7 @@ class YAMLTestCase(TestCase):
     Test cases for YAML helper functions
     """
     def setUp(self):
+        super().setUp()
         self.yaml_dict1 = {
             'testa': 'firsta with unicode «ταБЬℓσ»',
             'testb': 'firstb',
@@ -108,27 +115,182 @@ class AnsibleTestCase(TestCase):
         self.assertFalse(os.path.isfile(file_path_copy))
 
     @patch('subprocess.Popen')
-    @patch('instance.ansible.mkdtemp')
     @patch('instance.ansible.string_to_file_path')
-    def test_run_playbook(self, mock_string_to_file_path, mock_mkdtemp, mock_popen):
+    def test_run_playbook(self, mock_string_to_file_path, mock_popen):
         """
         Run the ansible-playbook command
         """
         mock_string_to_file_path.return_value.__enter__.return_value = '/test/str2path'
-        mock_mkdtemp.return_value = '/test/mkdtemp'
 
-        with ansible.run_playbook('/requirements/path.txt',
+        with ansible.run_playbook('/test/venv',
                                   "INVENTORY: 'str'",
                                   "VARS: 'str2'",
                                   '/play/book',
                                   'playbook_name_str'):
             run_playbook_cmd = (
-                'virtualenv -p /usr/bin/python /test/mkdtemp && '
-                '/test/mkdtemp/bin/python -u /test/mkdtemp/bin/pip install -r /requirements/path.txt && '
-                '/test/mkdtemp/bin/python -u /test/mkdtemp/bin/ansible-playbook -i /test/str2path '
+                '/test/venv/bin/python -u /test/venv/bin/ansible-playbook -i /test/str2path '
                 '-e @/test/str2path -u root playbook_name_str'
             )
             self.assertEqual(
                 mock_popen.mock_calls,
-                [call(run_playbook_cmd, bufsize=1, stdout=-1, cwd='/play/book', shell=True)]
+                [call(run_playbook_cmd, bufsize=1, stdout=-1, cwd='/play/book', shell=True, start_new_session=True)]
             )
+
+
+    @patch('subprocess.Popen')
+    @patch('instance.ansible.string_to_file_path')
+    def test_run_playbook_tags(self, mock_string_to_file_path, mock_popen):
+        """
+        Only run the tasks of the playbook matching the tags
+        """
+        mock_string_to_file_path.return_value.__enter__.return_value = '/test/str2path'
+
+        with ansible.run_playbook('/test/venv', "INVENTORY: 'str'", "VARS: 'str2'", '/play/book',
+                                  'playbook_name_str', tags='install:code,migrate'):
+            run_playbook_cmd = (
+                '/test/venv/bin/python -u /test/venv/bin/ansible-playbook -i /test/str2path '
+                '-e @/test/str2path -u root playbook_name_str --tags install:code,migrate'
+            )
+            self.assertEqual(
+                mock_popen.mock_calls,
+                [call(run_playbook_cmd, bufsize=1, stdout=-1, cwd='/play/book', shell=True, start_new_session=True)]
+            )
+
+    @patch('subprocess.Popen')
+    @patch('instance.ansible.string_to_file_path')
+    def test_run_playbook_skip_tags(self, mock_string_to_file_path, mock_popen):
+        """
+        Skip the tasks of the playbook matching the tags
+        """
+        mock_string_to_file_path.return_value.__enter__.return_value = '/test/str2path'
+
+        with ansible.run_playbook('/test/venv', "INVENTORY: 'str'", "VARS: 'str2'", '/play/book',
+                                  'playbook_name_str', skip_tags='install:code,migrate'):
+            run_playbook_cmd = (
+                '/test/venv/bin/python -u /test/venv/bin/ansible-playbook -i /test/str2path '
+                '-e @/test/str2path -u root playbook_name_str --skip-tags install:code,migrate'
+            )
+            self.assertEqual(
+                mock_popen.mock_calls,
+                [call(run_playbook_cmd, bufsize=1, stdout=-1, cwd='/play/book', shell=True, start_new_session=True)]
+            )
+
+    @patch('instance.ansible.os.killpg')
+    @patch('subprocess.Popen')
+    @patch('instance.ansible.string_to_file_path')
+    def test_run_playbook_error(self, mock_string_to_file_path, mock_popen, mock_killpg):
+        """
+        The ansible-playbook process group is killed & waited for when an exception is raised
+        """
+        mock_string_to_file_path.return_value.__enter__.return_value = '/test/str2path'
+        mock_popen.return_value.pid = 1234
+
+        with self.assertRaises(ValueError):
+            with ansible.run_playbook('/test/venv', "INVENTORY: 'str'", "VARS: 'str2'", '/play/book',
+                                      'playbook_name_str'):
+                raise ValueError('Invalid output')
+        mock_killpg.assert_called_once_with(1234, signal.SIGKILL)
+        self.assertEqual(mock_popen.return_value.wait.call_count, 1)
+
+
+class VenvCacheTestCase(TestCase):
+    """
+    Test cases for the ansible venv cache
+    """
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        cache.delete_many([ansible.VENV_CACHE_HITS_KEY, ansible.VENV_CACHE_MISSES_KEY])
+
+        self.requirements_path = os.path.join(self.cache_dir, 'requirements.txt')
+        with open(self.requirements_path, 'w') as fp:
+            fp.write('ansible==1.9.3\n')
+
+    def test_get_venv_cache_key(self):
+        """
+        The key depends on the requirements contents and on the python interpreter
+        """
+        key = ansible.get_venv_cache_key(self.requirements_path)
+        self.assertEqual(key, ansible.get_venv_cache_key(self.requirements_path))
+        with self.settings(ANSIBLE_PYTHON_PATH='/usr/bin/python2.7'):
+            self.assertNotEqual(key, ansible.get_venv_cache_key(self.requirements_path))
+        with open(self.requirements_path, 'a') as fp:
+            fp.write('PyYAML==3.11\n')
+        self.assertNotEqual(key, ansible.get_venv_cache_key(self.requirements_path))
+
+    @patch('instance.ansible.create_venv')
+    def test_get_venv(self, mock_create_venv):
+        """
+        A venv is only created on the first request for a given set of requirements
+        """
+        with self.settings(ANSIBLE_VENV_CACHE_DIR=self.cache_dir):
+            with ansible.get_venv(self.requirements_path) as (venv_path, cache_hit):
+                self.assertFalse(cache_hit)
+                self.assertEqual(os.path.dirname(venv_path), self.cache_dir)
+                mock_create_venv.assert_called_once_with(venv_path, self.requirements_path)
+
+            with ansible.get_venv(self.requirements_path) as venv:
+                self.assertEqual(venv, (venv_path, True))
+            self.assertEqual(mock_create_venv.call_count, 1)
+            self.assertEqual(ansible.get_venv_cache_stats(), {'hits': 1, 'misses': 1})
+
+    @patch('instance.ansible.create_venv')
+    def test_get_venv_interrupted_build(self, mock_create_venv):
+        """
+        A venv whose creation didn't complete is rebuilt
+        """
+        with self.settings(ANSIBLE_VENV_CACHE_DIR=self.cache_dir):
+            mock_create_venv.side_effect = subprocess.CalledProcessError(1, 'pip')
+            with self.assertRaises(subprocess.CalledProcessError):
+                with ansible.get_venv(self.requirements_path):
+                    pass
+
+            mock_create_venv.side_effect = None
+            with ansible.get_venv(self.requirements_path) as (venv_path, cache_hit):
+                self.assertFalse(cache_hit)
+                self.assertTrue(os.path.exists(os.path.join(venv_path, ansible.VENV_READY_MARKER)))
+
+    @patch('instance.ansible.create_venv')
+    def test_get_venv_eviction(self, mock_create_venv):
+        """
+        The least recently used venvs are deleted when the cache is full
+        """
+        with self.settings(ANSIBLE_VENV_CACHE_DIR=self.cache_dir, ANSIBLE_VENV_CACHE_SIZE=2):
+            venv_path_list = []
+            for i in range(3):
+                with open(self.requirements_path, 'w') as fp:
+                    fp.write('ansible==1.9.{}\n'.format(i))
+                with ansible.get_venv(self.requirements_path) as (venv_path, _):
+                    venv_path_list.append(venv_path)
+                if i < 2:
+                    # Make the last use times of the first venvs distinct
+                    marker_path = os.path.join(venv_path_list[i], ansible.VENV_READY_MARKER)
+                    os.utime(marker_path, (1000 * (i + 1), 1000 * (i + 1)))
+
+            self.assertFalse(os.path.exists(venv_path_list[0]))
+            self.assertTrue(os.path.exists(venv_path_list[1]))
+            self.assertTrue(os.path.exists(venv_path_list[2]))
+
+    @patch('instance.ansible.create_venv')
+    def test_get_venv_eviction_in_use(self, mock_create_venv):
+        """
+        The venvs in use aren't evicted, until their use is over
+        """
+        def get_venv(version):
+            """
+            Get the venv of a version of the requirements
+            """
+            with open(self.requirements_path, 'w') as fp:
+                fp.write('ansible==1.9.{}\n'.format(version))
+            return ansible.get_venv(self.requirements_path)
+
+        with self.settings(ANSIBLE_VENV_CACHE_DIR=self.cache_dir, ANSIBLE_VENV_CACHE_SIZE=1):
+            with get_venv(0) as (used_venv_path, _):
+                with get_venv(1):
+                    pass
+                self.assertTrue(os.path.exists(used_venv_path))
+            with get_venv(2) as (venv_path, _):
+                pass
+            self.assertFalse(os.path.exists(used_venv_path))
+            self.assertTrue(os.path.exists(venv_path))
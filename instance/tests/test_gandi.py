@@ -22,8 +22,13 @@ Gandi - Tests
 
 # Imports #####################################################################
 
+import json
+
 from unittest.mock import call, patch
 
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
 from instance import gandi
 from instance.tests.base import TestCase
 
@@ -35,18 +40,53 @@ class GandiTestCase(TestCase):
     Test cases for Gandi API calls
     """
     def setUp(self):
+        super().setUp()
         with patch('xmlrpc.client.ServerProxy'):
             self.api = gandi.GandiAPI()
             self.api.client.domain.zone.version.new.return_value = 'new_zone_version'
+        self.redis = get_redis_connection('default')
+        self.redis.delete(gandi.PENDING_RECORDS_KEY)
+        cache.delete(gandi.ZONE_RECORDS_KEY)
+        self.api.client.domain.zone.record.list.return_value = []
 
     def test_set_dns_record(self):
         """
-        Set a DNS record value
+        Set a DNS record value - the added record is returned
+        """
+        self.api.client.domain.zone.record.add.return_value = {'id': 1, 'name': 'sub.domain'}
+        self.assertEqual(self.api.set_dns_record(type='A', name='sub.domain', value='192.168.99.99'),
+                         {'id': 1, 'name': 'sub.domain'})
+        self.assertEqual(
+            self.api.client.mock_calls,
+            [
+                call.domain.zone.record.list('TEST_GANDI_API_KEY', 9900, 0),
+                call.domain.zone.version.new('TEST_GANDI_API_KEY', 9900),
+                call.domain.zone.record.delete('TEST_GANDI_API_KEY', 9900, 'new_zone_version', {
+                    'type': ['A', 'CNAME'],
+                    'name': 'sub.domain',
+                }),
+                call.domain.zone.record.add('TEST_GANDI_API_KEY', 9900, 'new_zone_version', {
+                    'value': '192.168.99.99',
+                    'ttl': 1200,
+                    'type': 'A',
+                    'name': 'sub.domain',
+                }),
+                call.domain.zone.version.set('TEST_GANDI_API_KEY', 9900, 'new_zone_version')
+            ]
+        )
+
+    def test_set_dns_records(self):
+        """
+        Set multiple DNS records in a single zone version
         """
-        self.api.set_dns_record(type='A', name='sub.domain', value='192.168.99.99')
+        self.api.set_dns_records([
+            dict(type='A', name='sub.domain', value='192.168.99.99'),
+            dict(type='CNAME', name='studio.sub.domain', value='sub.domain', ttl=300),
+        ])
         self.assertEqual(
             self.api.client.mock_calls,
             [
+                call.domain.zone.record.list('TEST_GANDI_API_KEY', 9900, 0),
                 call.domain.zone.version.new('TEST_GANDI_API_KEY', 9900),
                 call.domain.zone.record.delete('TEST_GANDI_API_KEY', 9900, 'new_zone_version', {
                     'type': ['A', 'CNAME'],
@@ -58,6 +98,83 @@ class GandiTestCase(TestCase):
                     'type': 'A',
                     'name': 'sub.domain',
                 }),
+                call.domain.zone.record.delete('TEST_GANDI_API_KEY', 9900, 'new_zone_version', {
+                    'type': ['A', 'CNAME'],
+                    'name': 'studio.sub.domain',
+                }),
+                call.domain.zone.record.add('TEST_GANDI_API_KEY', 9900, 'new_zone_version', {
+                    'value': 'sub.domain',
+                    'ttl': 300,
+                    'type': 'CNAME',
+                    'name': 'studio.sub.domain',
+                }),
                 call.domain.zone.version.set('TEST_GANDI_API_KEY', 9900, 'new_zone_version')
             ]
         )
+
+    def test_set_dns_records_coalesced(self):
+        """
+        Changes queued by concurrent callers are applied in the same zone version
+        """
+        self.redis.rpush(gandi.PENDING_RECORDS_KEY, json.dumps({'token': 'other-caller', 'record_list': [
+            {'type': 'A', 'name': 'other.domain', 'value': '192.168.1.1', 'ttl': 1200},
+            {'type': 'A', 'name': 'sub.domain', 'value': '192.168.1.2', 'ttl': 1200},
+        ]}))
+        self.api.client.domain.zone.record.add.side_effect = lambda api_key, zone_id, version, record: record
+        self.assertEqual(self.api.set_dns_record(type='A', name='sub.domain', value='192.168.99.99'),
+                         {'type': 'A', 'name': 'sub.domain', 'value': '192.168.99.99', 'ttl': 1200})
+
+        self.assertEqual(self.api.client.domain.zone.version.new.call_count, 1)
+        self.assertEqual(self.api.client.domain.zone.record.add.mock_calls, [
+            call('TEST_GANDI_API_KEY', 9900, 'new_zone_version', {
+                'type': 'A', 'name': 'other.domain', 'value': '192.168.1.1', 'ttl': 1200}),
+            call('TEST_GANDI_API_KEY', 9900, 'new_zone_version', {
+                'type': 'A', 'name': 'sub.domain', 'value': '192.168.99.99', 'ttl': 1200}),
+        ])
+        # The other caller gets the records as set, including the later change of sub.domain
+        self.assertEqual(cache.get('gandi_applied_other-caller'), {
+            'other.domain': {'type': 'A', 'name': 'other.domain', 'value': '192.168.1.1', 'ttl': 1200},
+            'sub.domain': {'type': 'A', 'name': 'sub.domain', 'value': '192.168.99.99', 'ttl': 1200},
+        })
+        self.assertEqual(self.redis.llen(gandi.PENDING_RECORDS_KEY), 0)
+
+    @patch('uuid.uuid4')
+    def test_set_dns_records_already_applied(self, mock_uuid4):
+        """
+        Changes already applied by a concurrent caller aren't applied again
+        """
+        mock_uuid4.return_value.hex = 'applied-token'
+        cache.set('gandi_applied_applied-token', {'sub.domain': {'id': 1, 'name': 'sub.domain'}})
+        self.assertEqual(self.api.set_dns_record(type='A', name='sub.domain', value='192.168.99.99'),
+                         {'id': 1, 'name': 'sub.domain'})
+        self.assertFalse(self.api.client.domain.zone.version.new.called)
+        self.redis.delete(gandi.PENDING_RECORDS_KEY)
+        cache.delete('gandi_applied_applied-token')
+
+    def test_set_dns_record_unchanged(self):
+        """
+        Setting a record to its current value doesn't make any change to the zone
+        """
+        self.api.client.domain.zone.record.list.return_value = [
+            {'id': 1, 'type': 'A', 'name': 'sub.domain', 'value': '192.168.99.99', 'ttl': 1200},
+            {'id': 2, 'type': 'CNAME', 'name': 'other.domain', 'value': 'sub.domain', 'ttl': 1200},
+        ]
+        skipped_writes = cache.get(gandi.SKIPPED_WRITES_KEY, 0)
+        self.assertEqual(self.api.set_dns_records([
+            dict(type='A', name='sub.domain', value='192.168.99.99'),
+            dict(type='CNAME', name='other.domain', value='sub.domain'),
+        ]), self.api.client.domain.zone.record.list.return_value)
+        self.assertEqual(self.api.client.mock_calls, [call.domain.zone.record.list('TEST_GANDI_API_KEY', 9900, 0)])
+        self.assertEqual(cache.get(gandi.SKIPPED_WRITES_KEY), skipped_writes + 2)
+
+    def test_set_dns_record_changed(self):
+        """
+        Records with a different value are set, and the zone records are fetched again afterwards
+        """
+        self.api.client.domain.zone.record.list.return_value = [
+            {'id': 1, 'type': 'A', 'name': 'sub.domain', 'value': '192.168.99.99', 'ttl': 1200},
+        ]
+        self.api.set_dns_record(type='A', name='sub.domain', value='192.168.99.100')
+        self.assertEqual(self.api.client.domain.zone.version.set.call_count, 1)
+        self.api.get_zone_records()
+        self.assertEqual(self.api.client.domain.zone.record.list.call_count, 2)
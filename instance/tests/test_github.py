@@ -22,22 +22,69 @@ GitHub - Tests
 
 # Imports #####################################################################
 
+import hashlib
+import hmac
 import json
 import requests
 import responses
+import time
 
+from freezegun import freeze_time
 from mock import patch
 
+from django.core.cache import cache
+from django.test.utils import override_settings
+
 from instance import github
 from instance.tests.base import TestCase, get_raw_fixture
 
 
+# Classes #####################################################################
+
+class SynchronousThread:
+    """
+    Replacement for `threading.Thread`, running the target immediately
+    """
+    def __init__(self, target, args=(), daemon=None): #pylint: disable=unused-argument
+        self.target = target
+        self.args = args
+
+    def start(self):
+        """
+        Run the target in the current thread
+        """
+        self.target(*self.args)
+
+
 # Tests #######################################################################
 
 class GitHubTestCase(TestCase):
     """
     Test cases for GitHub helper functions & API calls
     """
+    def setUp(self):
+        super().setUp()
+        for cache_key in ('github_team_open-craft_Owners', 'github_team_open-craft_non-existent',
+                          'github_team_members_799617', 'github_rate_limit_core', 'github_rate_limit_search',
+                          github.GH_BLOCKED_UNTIL_KEY):
+            cache.delete(cache_key)
+            self.addCleanup(cache.delete, cache_key)
+
+    def add_team_responses(self):
+        """
+        Mock the API responses of the team & membership lookups
+        """
+        responses.add(
+            responses.GET, 'https://api.github.com/orgs/open-craft/teams',
+            body=get_raw_fixture('github/api_teams.json'),
+            content_type='application/json; charset=utf8',
+            status=200)
+        responses.add(
+            responses.GET, 'https://api.github.com/teams/799617/members',
+            body=get_raw_fixture('github/api_members.json'),
+            content_type='application/json; charset=utf8',
+            status=200)
+
     def test_fork_name2tuple(self):
         """
         Conversion of `fork_name` to `fork_tuple`
@@ -58,6 +105,43 @@ class GitHubTestCase(TestCase):
             github.get_commit_id_from_ref('edx/edx-platform', 'master'),
             'test-sha')
 
+    @responses.activate
+    def test_get_object_from_url_etag(self):
+        """
+        Responses with an ETag are cached, and returned when the next request for the URL is unchanged
+        """
+        url = 'https://api.github.com/repos/edx/edx-platform/git/refs/heads/etag'
+        cache_key = 'github_response_{}'.format(hashlib.sha1(url.encode('utf-8')).hexdigest())
+        cache.delete(cache_key)
+        self.addCleanup(cache.delete, cache_key)
+
+        responses.add(
+            responses.GET, url,
+            body=json.dumps({'object': {'sha': 'test-sha'}}),
+            content_type='application/json; charset=utf8',
+            adding_headers={'ETag': '"test-etag"'},
+            status=200)
+        self.assertEqual(github.get_object_from_url(url), {'object': {'sha': 'test-sha'}})
+        self.assertNotIn('If-None-Match', responses.calls[0].request.headers)
+        self.assertEqual(
+            cache.get(cache_key),
+            {'etag': '"test-etag"', 'data': {'object': {'sha': 'test-sha'}}, 'next_url': None})
+
+    @responses.activate
+    def test_get_object_from_url_not_modified(self):
+        """
+        Conditional request for a cached response which hasn't changed
+        """
+        url = 'https://api.github.com/repos/edx/edx-platform/git/refs/heads/not-modified'
+        cache_key = 'github_response_{}'.format(hashlib.sha1(url.encode('utf-8')).hexdigest())
+        cache.set(cache_key, {'etag': '"test-etag"', 'data': {'object': {'sha': 'cached-sha'}}, 'next_url': None})
+        self.addCleanup(cache.delete, cache_key)
+
+        responses.add(responses.GET, url, body='', status=304)
+        self.assertEqual(github.get_object_from_url(url), {'object': {'sha': 'cached-sha'}})
+        self.assertEqual(responses.calls[0].request.headers['If-None-Match'], '"test-etag"')
+        self.assertEqual(responses.calls[0].request.headers['Authorization'], 'token test-token')
+
     def test_get_settings_from_pr_body(self):
         """
         Extract settings from a string containing settings
@@ -114,47 +198,115 @@ class GitHubTestCase(TestCase):
         self.assertEqual(cm.exception.response.status_code, 404)
 
     @responses.activate
-    @patch('instance.github.get_pr_by_number')
-    def test_get_pr_list_from_username(self, mock_get_pr_by_number):
+    def test_get_object_list_from_url(self):
         """
-        Get list of open PR for user
+        Follow the pagination links until the last page
         """
+        url = 'https://api.github.com/repos/edx/edx-platform/pulls?state=open'
         responses.add(
-            responses.GET, 'https://api.github.com/search/issues?sort=created'
-                           '&q=is:open is:pr author:itsjeyd repo:edx/edx-platform',
+            responses.GET, url,
             match_querystring=True,
-            body=get_raw_fixture('github/api_search_open_prs_user.json'),
+            body=json.dumps([{'number': 1}, {'number': 2}]),
+            content_type='application/json; charset=utf8',
+            adding_headers={'Link': '<{}&page=2>; rel="next", <{}&page=2>; rel="last"'.format(url, url)},
+            status=200)
+        responses.add(
+            responses.GET, '{}&page=2'.format(url),
+            match_querystring=True,
+            body=json.dumps([{'number': 3}]),
             content_type='application/json; charset=utf8',
             status=200)
-
-        mock_get_pr_by_number.side_effect = lambda fork_name, pr_number: [fork_name, pr_number]
 
         self.assertEqual(
-            github.get_pr_list_from_username('itsjeyd', 'edx/edx-platform'),
-            [['edx/edx-platform', 9147], ['edx/edx-platform', 9146]]
-        )
+            github.get_object_list_from_url(url),
+            [{'number': 1}, {'number': 2}, {'number': 3}])
+        self.assertEqual(len(responses.calls), 2)
 
     @responses.activate
-    def test_get_username_list_from_team(self):
+    def test_get_pr_list_from_fork(self):
         """
-        Get list of members in a team
+        Get list of open PRs opened by team members on a fork
         """
         responses.add(
-            responses.GET, 'https://api.github.com/orgs/open-craft/teams',
-            body=get_raw_fixture('github/api_teams.json'),
-            content_type='application/json; charset=utf8',
-            status=200)
-        responses.add(
-            responses.GET, 'https://api.github.com/teams/799617/members',
-            body=get_raw_fixture('github/api_members.json'),
+            responses.GET, 'https://api.github.com/repos/edx/edx-platform/pulls?state=open&per_page=100',
+            match_querystring=True,
+            body=get_raw_fixture('github/api_pulls.json'),
             content_type='application/json; charset=utf8',
             status=200)
 
+        pr_list = github.get_pr_list_from_fork('edx/edx-platform', ['itsjeyd', 'smarnach'])
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual([pr.number for pr in pr_list], [9147, 8474])
+        self.assertEqual(pr_list[0].fork_name, 'open-craft/edx-platform')
+        self.assertEqual(pr_list[0].branch_name, 'itsjeyd/problem-responses')
+        self.assertEqual(pr_list[0].username, 'itsjeyd')
+        self.assertEqual(pr_list[0].head_sha, '00000000000000000000000000000000000023bb')
+        self.assertEqual(pr_list[0].extra_settings, 'EDXAPP_FEATURES:\r\n  ALLOW: true\r\n')
+        self.assertEqual(pr_list[1].branch_name, 'smarnach/hide-discussion-tab')
+        self.assertEqual(pr_list[1].extra_settings, '')
+
+    @responses.activate
+    def test_get_username_list_from_team(self):
+        """
+        Get list of members in a team
+        """
+        self.add_team_responses()
         self.assertEqual(
             github.get_username_list_from_team('open-craft'),
             ['antoviaque', 'bradenmacdonald', 'e-kolpakov', 'itsjeyd', 'Kelketek', 'mtyaka', 'smarnach']
         )
 
+    @responses.activate
+    def test_get_username_list_from_team_cached(self):
+        """
+        The team & its members are only retrieved once while the cached lookups are fresh
+        """
+        self.add_team_responses()
+        with freeze_time('2015-08-05 18:00:00'):
+            username_list = github.get_username_list_from_team('open-craft')
+        self.assertEqual(len(responses.calls), 2)
+
+        with freeze_time('2015-08-05 18:59:00'):
+            self.assertEqual(github.get_username_list_from_team('open-craft'), username_list)
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    @patch('instance.github.threading.Thread', SynchronousThread)
+    @patch('instance.github.fetch_username_list_from_team')
+    def test_get_username_list_from_team_stale(self, mock_fetch_username_list):
+        """
+        Stale cached lookups are returned immediately, and refreshed in the background
+        """
+        self.add_team_responses()
+        mock_fetch_username_list.return_value = ['itsjeyd']
+        with freeze_time('2015-08-05 18:00:00'):
+            self.assertEqual(github.get_username_list_from_team('open-craft'), ['itsjeyd'])
+
+        mock_fetch_username_list.return_value = ['itsjeyd', 'smarnach']
+        with freeze_time('2015-08-05 19:01:00'):
+            # The refresh runs synchronously here, but the stale value is still returned
+            self.assertEqual(github.get_username_list_from_team('open-craft'), ['itsjeyd'])
+            self.assertEqual(github.get_username_list_from_team('open-craft'), ['itsjeyd', 'smarnach'])
+        self.assertEqual(mock_fetch_username_list.call_count, 2)
+
+    @responses.activate
+    @patch('instance.github.threading.Thread', SynchronousThread)
+    @patch('instance.github.fetch_username_list_from_team')
+    def test_get_username_list_from_team_refresh_error(self, mock_fetch_username_list):
+        """
+        The stale cached lookup is kept when it can't be refreshed
+        """
+        self.add_team_responses()
+        mock_fetch_username_list.return_value = ['itsjeyd']
+        with freeze_time('2015-08-05 18:00:00'):
+            github.get_username_list_from_team('open-craft')
+
+        mock_fetch_username_list.side_effect = requests.exceptions.HTTPError('API rate limit exceeded')
+        with freeze_time('2015-08-05 19:01:00'):
+            self.assertEqual(github.get_username_list_from_team('open-craft'), ['itsjeyd'])
+            self.assertEqual(github.get_username_list_from_team('open-craft'), ['itsjeyd'])
+        self.assertEqual(mock_fetch_username_list.call_count, 3)
+
     @responses.activate
     def test_get_username_list_from_team_404(self):
         """
@@ -168,3 +320,118 @@ class GitHubTestCase(TestCase):
 
         with self.assertRaises(KeyError, msg='non-existent'):
             github.get_username_list_from_team('open-craft', team_name='non-existent')
+
+    @override_settings(GITHUB_WEBHOOK_SECRET='test-secret')
+    def test_is_valid_webhook_signature(self):
+        """
+        Check the signature of webhook payloads
+        """
+        payload = b'{"zen": "Keep it logically awesome."}'
+        sha1_digest = hmac.new(b'test-secret', payload, hashlib.sha1).hexdigest()
+        sha256_digest = hmac.new(b'test-secret', payload, hashlib.sha256).hexdigest()
+        self.assertTrue(github.is_valid_webhook_signature(payload, 'sha1={}'.format(sha1_digest)))
+        self.assertTrue(github.is_valid_webhook_signature(payload, 'sha256={}'.format(sha256_digest)))
+        self.assertFalse(github.is_valid_webhook_signature(payload + b' ', 'sha1={}'.format(sha1_digest)))
+        self.assertFalse(github.is_valid_webhook_signature(payload, 'md5={}'.format(sha1_digest)))
+        self.assertFalse(github.is_valid_webhook_signature(payload, None))
+        with self.settings(GITHUB_WEBHOOK_SECRET=''):
+            self.assertFalse(github.is_valid_webhook_signature(payload, 'sha1={}'.format(sha1_digest)))
+
+
+@freeze_time('2015-08-05 18:00:00')
+class GitHubRateLimitTestCase(TestCase):
+    """
+    Test cases for the rate limit budget accounting
+    """
+    url = 'https://api.github.com/repos/edx/edx-platform/git/refs/heads/rate-limit'
+
+    def setUp(self):
+        super().setUp()
+        self.now = int(time.time())
+        for cache_key in ('github_rate_limit_core', 'github_rate_limit_search', github.GH_BLOCKED_UNTIL_KEY,
+                          'github_response_{}'.format(hashlib.sha1(self.url.encode('utf-8')).hexdigest())):
+            cache.delete(cache_key)
+            self.addCleanup(cache.delete, cache_key)
+
+    def add_response(self, remaining, status=200, **headers):
+        """
+        Mock an API response reporting `remaining` requests left in the budget
+        """
+        headers.update({
+            'X-RateLimit-Limit': '5000',
+            'X-RateLimit-Remaining': str(remaining),
+            'X-RateLimit-Reset': str(self.now + 1800),
+        })
+        responses.add(
+            responses.GET, self.url,
+            body=json.dumps({'object': {'sha': 'test-sha'}}),
+            content_type='application/json; charset=utf8',
+            adding_headers=headers,
+            status=status)
+
+    @responses.activate
+    def test_budget(self):
+        """
+        The budget reported by the API is recorded for each resource
+        """
+        requests_count = github.get_rate_limit_stats()['requests']
+        self.add_response(remaining=4999)
+        github.get_object_from_url(self.url)
+
+        stats = github.get_rate_limit_stats()
+        self.assertEqual(stats['core'], {'limit': 5000, 'remaining': 4999, 'reset': self.now + 1800})
+        self.assertEqual(stats['requests'], requests_count + 1)
+
+    @responses.activate
+    def test_background_reserve(self):
+        """
+        Background requests are deferred once the budget gets into the reserve of interactive requests,
+        which are still sent
+        """
+        deferred_count = github.get_rate_limit_stats()['deferred']
+        self.add_response(remaining=1000)
+        github.get_object_from_url(self.url)
+
+        with github.background_priority():
+            with self.assertRaises(github.RateLimitExceeded) as cm:
+                github.get_object_from_url(self.url)
+        self.assertEqual(cm.exception.reset_time, self.now + 1800)
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(github.get_rate_limit_stats()['deferred'], deferred_count + 1)
+
+        self.assertEqual(github.get_object_from_url(self.url), {'object': {'sha': 'test-sha'}})
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_exhausted(self):
+        """
+        No request is sent once the budget is exhausted, until it is reset
+        """
+        self.add_response(remaining=0, status=403)
+        with self.assertRaises(github.RateLimitExceeded):
+            github.get_object_from_url(self.url)
+        with self.assertRaises(github.RateLimitExceeded):
+            github.get_object_from_url(self.url)
+        self.assertEqual(len(responses.calls), 1)
+
+        responses.reset()
+        self.add_response(remaining=4999)
+        with freeze_time('2015-08-05 18:30:01'):
+            self.assertEqual(github.get_object_from_url(self.url), {'object': {'sha': 'test-sha'}})
+
+    @responses.activate
+    @patch('instance.github.time.sleep')
+    def test_retry_after(self, mock_sleep):
+        """
+        Interactive requests wait for short temporary blocks to end, background requests are deferred
+        """
+        self.add_response(remaining=4000, status=429, **{'Retry-After': '5'})
+        with self.assertRaises(github.RateLimitExceeded):
+            github.get_object_from_url(self.url)
+        self.assertEqual(len(responses.calls), 2)
+        mock_sleep.assert_called_once_with(5)
+
+        with github.background_priority():
+            with self.assertRaises(github.RateLimitExceeded):
+                github.get_object_from_url(self.url)
+        self.assertEqual(len(responses.calls), 2)
@@ -23,10 +23,14 @@ OpenStack - Tests
 # Imports #####################################################################
 
 import requests
+import threading
 
 from collections import namedtuple
 from unittest.mock import Mock, call, patch
 
+from django.core.cache import cache
+from novaclient.exceptions import BadRequest, NotFound
+
 from instance import openstack
 from instance.tests.base import TestCase
 
@@ -38,21 +42,90 @@ class OpenStackTestCase(TestCase):
     Test cases for OpenStack helper functions
     """
     def setUp(self):
+        super().setUp()
         self.nova = Mock()
+        self.flavor_selector = {"ram": 4096, "disk": 40}
+        self.image_selector = {"name": "Ubuntu 12.04"}
+        cache.delete_many([
+            openstack.get_catalog_cache_key('flavor', self.flavor_selector),
+            openstack.get_catalog_cache_key('image', self.image_selector),
+        ])
 
     def test_create_server(self):
         """
         Create a VM via nova
         """
-        self.nova.flavors.find.return_value = 'test-flavor'
-        self.nova.images.find.return_value = 'test-image'
-        openstack.create_server(self.nova, 'test-vm', {"ram": 4096, "disk": 40}, {"name": "Ubuntu 12.04"})
+        self.nova.flavors.find.return_value.id = 'test-flavor'
+        self.nova.images.find.return_value.id = 'test-image'
+        openstack.create_server(self.nova, 'test-vm', self.flavor_selector, self.image_selector)
         self.assertEqual(self.nova.mock_calls, [
             call.flavors.find(disk=40, ram=4096),
             call.images.find(name='Ubuntu 12.04'),
             call.servers.create('test-vm', 'test-image', 'test-flavor', key_name=None)
         ])
 
+    def test_create_server_cached_catalog(self):
+        """
+        The flavor & image are only looked up in the catalog once
+        """
+        self.nova.flavors.find.return_value.id = 'test-flavor'
+        self.nova.images.find.return_value.id = 'test-image'
+        openstack.create_server(self.nova, 'test-vm', self.flavor_selector, self.image_selector)
+        openstack.create_server(self.nova, 'test-vm2', {"disk": 40, "ram": 4096}, self.image_selector)
+        self.assertEqual(self.nova.flavors.find.call_count, 1)
+        self.assertEqual(self.nova.images.find.call_count, 1)
+        self.assertEqual(self.nova.servers.create.mock_calls, [
+            call('test-vm', 'test-image', 'test-flavor', key_name=None),
+            call('test-vm2', 'test-image', 'test-flavor', key_name=None),
+        ])
+
+    def test_create_server_stale_catalog(self):
+        """
+        The cached flavor & image are looked up again when the server creation can't find them
+        """
+        cache.set(openstack.get_catalog_cache_key('flavor', self.flavor_selector), 'old-flavor')
+        cache.set(openstack.get_catalog_cache_key('image', self.image_selector), 'old-image')
+        self.nova.flavors.find.return_value.id = 'test-flavor'
+        self.nova.images.find.return_value.id = 'test-image'
+        self.nova.servers.create.side_effect = [NotFound(404), Mock()]
+
+        openstack.create_server(self.nova, 'test-vm', self.flavor_selector, self.image_selector)
+        self.assertEqual(self.nova.servers.create.mock_calls, [
+            call('test-vm', 'old-image', 'old-flavor', key_name=None),
+            call('test-vm', 'test-image', 'test-flavor', key_name=None),
+        ])
+        self.assertEqual(cache.get(openstack.get_catalog_cache_key('image', self.image_selector)), 'test-image')
+
+    def test_create_server_not_found(self):
+        """
+        The error is raised when the server creation fails with up-to-date flavor & image
+        """
+        self.nova.flavors.find.return_value.id = 'test-flavor'
+        self.nova.images.find.return_value.id = 'test-image'
+        self.nova.servers.create.side_effect = BadRequest(400)
+
+        with self.assertRaises(BadRequest):
+            openstack.create_server(self.nova, 'test-vm', self.flavor_selector, self.image_selector)
+        self.assertEqual(self.nova.servers.create.call_count, 1)
+
+    def test_list_servers(self):
+        """
+        List all servers, page by page
+        """
+        server_class = namedtuple('server_class', 'id')
+        self.nova.servers.list.side_effect = [
+            [server_class(id='server-1'), server_class(id='server-2')],
+            [server_class(id='server-3')],
+            [],
+        ]
+        self.assertEqual(openstack.list_servers(self.nova, page_size=2),
+                         [server_class(id='server-1'), server_class(id='server-2'), server_class(id='server-3')])
+        self.assertEqual(self.nova.mock_calls, [
+            call.servers.list(detailed=True, marker=None, limit=2),
+            call.servers.list(detailed=True, marker='server-2', limit=2),
+            call.servers.list(detailed=True, marker='server-3', limit=2),
+        ])
+
     def test_delete_servers_by_name(self):
         """
         Delete all servers with a given name
@@ -70,6 +143,75 @@ class OpenStackTestCase(TestCase):
             call.servers.delete(server_class(name='server-a', pk=2)),
         ])
 
+    def test_get_image_status(self):
+        """
+        Status of an image, None once it is deleted
+        """
+        self.nova.images.get.return_value.status = 'SAVING'
+        self.assertEqual(openstack.get_image_status(self.nova, 'test-image-id'), 'SAVING')
+        self.nova.images.get.side_effect = NotFound(404)
+        self.assertIsNone(openstack.get_image_status(self.nova, 'test-image-id'))
+
+    def test_delete_image_not_found(self):
+        """
+        Deleting an image which doesn't exist anymore
+        """
+        self.nova.images.delete.side_effect = NotFound(404)
+        openstack.delete_image(self.nova, 'test-image-id')
+        self.nova.images.delete.assert_called_once_with('test-image-id')
+
+    def test_get_available_capacity(self):
+        """
+        Remaining capacity of the tenant quota
+        """
+        limit_class = namedtuple('limit_class', 'name value')
+        self.nova.limits.get.return_value.absolute = [
+            limit_class(name='maxTotalInstances', value=10),
+            limit_class(name='totalInstancesUsed', value=4),
+            limit_class(name='maxTotalCores', value=-1),
+            limit_class(name='totalCoresUsed', value=8),
+            limit_class(name='maxTotalRAMSize', value=51200),
+            limit_class(name='totalRAMUsed', value=16384),
+        ]
+        self.assertEqual(openstack.get_available_capacity(self.nova), {
+            'instances': 6,
+            'cores': None,
+            'ram': 34816,
+        })
+
+    def test_get_flavor_requirements(self):
+        """
+        Quota resources used by a server of the sandbox flavor
+        """
+        self.nova.flavors.find.return_value.id = 'test-flavor'
+        self.nova.flavors.get.return_value.vcpus = 2
+        self.nova.flavors.get.return_value.ram = 4096
+        self.assertEqual(openstack.get_flavor_requirements(self.nova, self.flavor_selector), {
+            'instances': 1,
+            'cores': 2,
+            'ram': 4096,
+        })
+        self.nova.flavors.get.assert_called_once_with('test-flavor')
+
+    @patch('instance.openstack.create_nova_client')
+    def test_get_nova_client(self, mock_create_nova_client):
+        """
+        The nova client is created once per thread, and then reused
+        """
+        mock_create_nova_client.side_effect = lambda: Mock()
+        openstack._nova_client_local.nova = None #pylint: disable=protected-access
+        nova = openstack.get_nova_client()
+        self.assertIs(openstack.get_nova_client(), nova)
+        self.assertEqual(mock_create_nova_client.call_count, 1)
+
+        thread_nova_list = []
+        thread = threading.Thread(target=lambda: thread_nova_list.append(openstack.get_nova_client()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(thread_nova_list[0], nova)
+        self.assertEqual(mock_create_nova_client.call_count, 2)
+        openstack._nova_client_local.nova = None #pylint: disable=protected-access
+
     def test_get_server_public_address_none(self):
         """
         No public IP when none has been assigned yet
@@ -90,7 +232,7 @@ class OpenStackTestCase(TestCase):
             """ Invoked by the nova client when making a HTTP request (via requests/urllib3) """
             raise ConnectionResetError('[Errno 104] Connection reset by peer')
         mock_getresponse.side_effect = getresponse_call
-        nova = openstack.get_nova_client()
+        nova = openstack.create_nova_client()
         with self.assertRaises(requests.exceptions.ConnectionError):
             nova.servers.get('test-id')
         self.assertEqual(mock_getresponse.call_count, 11)
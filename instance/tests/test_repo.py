@@ -23,7 +23,9 @@ Git repository - Tests
 # Imports #####################################################################
 
 import os.path
+import shutil
 
+from tempfile import mkdtemp
 from unittest.mock import call, patch
 
 from instance import repo
@@ -36,16 +38,74 @@ class RepoTestCase(TestCase):
     """
     Test cases for Git repository helper functions
     """
+    def setUp(self):
+        super().setUp()
+        self.mirror_dir = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.mirror_dir)
+
+    def test_get_mirror_path(self):
+        """
+        Each repository URL gets its own mirror
+        """
+        with self.settings(REPO_MIRROR_DIR='/mirrors'):
+            mirror_path = repo.get_mirror_path('http://example.com/repo.git')
+            self.assertEqual(os.path.dirname(mirror_path), '/mirrors')
+            self.assertEqual(mirror_path, repo.get_mirror_path('http://example.com/repo.git'))
+            self.assertNotEqual(mirror_path, repo.get_mirror_path('http://example.com/repo2.git'))
+
+    @patch('git.Git')
+    @patch('git.repo.base.Repo.clone_from')
+    def test_update_mirror_new(self, mock_clone_from, mock_git_class):
+        """
+        Create the mirror of a repository which hasn't been cloned yet
+        """
+        with self.settings(REPO_MIRROR_DIR=self.mirror_dir):
+            mirror_path = repo.update_mirror('http://example.com/repo.git')
+        mock_clone_from.assert_called_once_with('http://example.com/repo.git', mirror_path, mirror=True)
+        self.assertEqual(mock_git_class.mock_calls, [call(mirror_path), call().config('gc.auto', '0')])
+
+    @patch('git.Git')
+    @patch('git.repo.base.Repo.clone_from')
+    def test_update_mirror_existing(self, mock_clone_from, mock_git_class):
+        """
+        Fetch the changes in an existing mirror
+        """
+        with self.settings(REPO_MIRROR_DIR=self.mirror_dir):
+            mirror_path = repo.get_mirror_path('http://example.com/repo.git')
+            os.makedirs(mirror_path)
+            open(os.path.join(mirror_path, 'HEAD'), 'w').close()
+
+            self.assertEqual(repo.update_mirror('http://example.com/repo.git'), mirror_path)
+        self.assertFalse(mock_clone_from.called)
+        self.assertEqual(mock_git_class.mock_calls, [call(mirror_path), call().fetch('--prune', 'origin')])
+
     @patch('git.Git')
     @patch('git.repo.base.Repo.clone_from')
-    def test_open_repository(self, mock_clone_from, mock_git_class):
+    @patch('instance.repo.update_mirror')
+    def test_open_repository(self, mock_update_mirror, mock_clone_from, mock_git_class):
         """
-        Get a repo object on a temporary directory
+        Get a repo object on a temporary directory, cloned from the mirror
         """
+        mock_update_mirror.return_value = '/mirror/path'
         tmp_dir_path = None
         with repo.open_repository('http://example.com/repo.git', ref='test-branch') as mock_repo:
+            mock_update_mirror.assert_called_once_with('http://example.com/repo.git')
             tmp_dir_path = mock_clone_from.mock_calls[0][1][1]
-            mock_clone_from.assert_called_once_with('http://example.com/repo.git', tmp_dir_path)
+            mock_clone_from.assert_called_once_with('/mirror/path', tmp_dir_path, shared=True, no_checkout=True)
             self.assertTrue(os.path.isdir(tmp_dir_path))
             self.assertEqual(mock_repo.mock_calls, [call.checkout('test-branch')])
         self.assertFalse(os.path.isdir(tmp_dir_path))
+
+    @patch('git.Git')
+    @patch('git.repo.base.Repo.clone_from')
+    @patch('instance.repo.update_mirror')
+    def test_open_repository_exception(self, mock_update_mirror, mock_clone_from, mock_git_class):
+        """
+        The temporary directory is removed when an exception is raised while the repository is open
+        """
+        tmp_dir_path = None
+        with self.assertRaises(RuntimeError):
+            with repo.open_repository('http://example.com/repo.git'):
+                tmp_dir_path = mock_clone_from.mock_calls[0][1][1]
+                raise RuntimeError('Playbook failure')
+        self.assertFalse(os.path.isdir(tmp_dir_path))
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+#
+# OpenCraft -- tools to aid developing and hosting free software projects
+# Copyright (C) 2015 OpenCraft <xavier@opencraft.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Provisioning scheduler - Tests
+"""
+
+# Imports #####################################################################
+
+import time
+
+from freezegun import freeze_time
+from mock import Mock, patch
+
+from django.core.cache import cache
+from django.test.utils import override_settings
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from instance import scheduler
+from instance.tests.base import TestCase
+from instance.tests.models.factories.instance import OpenEdXInstanceFactory
+from instance.tests.models.factories.server import ReadyOpenStackServerFactory, StartedOpenStackServerFactory
+
+
+# Tests #######################################################################
+
+class SchedulerTestCase(TestCase):
+    """
+    Test cases for the provisioning scheduler
+    """
+    def setUp(self):
+        super().setUp()
+        redis = get_redis_connection('default')
+        for key in (scheduler.QUEUE_KEY, scheduler.ADMITTED_KEY):
+            redis.delete(key)
+            self.addCleanup(redis.delete, key)
+        cache.delete(scheduler.DURATION_KEY)
+        self.addCleanup(cache.delete, scheduler.DURATION_KEY)
+
+        self.requirements = {'instances': 1, 'cores': 2, 'ram': 4096}
+        patcher = patch('instance.scheduler.openstack.get_flavor_requirements', return_value=self.requirements)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_enqueue_order(self):
+        """
+        Instances are queued by priority, then by time of request
+        """
+        with freeze_time('2015-08-05 18:00:00'):
+            self.assertTrue(scheduler.enqueue(1, scheduler.PRIORITY_REFRESH))
+        with freeze_time('2015-08-05 18:01:00'):
+            self.assertTrue(scheduler.enqueue(2, scheduler.PRIORITY_NEW))
+        with freeze_time('2015-08-05 18:02:00'):
+            self.assertTrue(scheduler.enqueue(3, scheduler.PRIORITY_NEW))
+        with freeze_time('2015-08-05 18:03:00'):
+            self.assertTrue(scheduler.enqueue(4, scheduler.PRIORITY_MANUAL))
+        self.assertEqual(scheduler.get_queue(), [4, 2, 3, 1])
+        self.assertEqual(scheduler.get_queue_position(3), 2)
+        self.assertIsNone(scheduler.get_queue_position(5))
+
+    def test_enqueue_already_queued(self):
+        """
+        Queued instances keep their place, unless requested again with a higher priority
+        """
+        with freeze_time('2015-08-05 18:00:00'):
+            scheduler.enqueue(1, scheduler.PRIORITY_NEW)
+            scheduler.enqueue(2, scheduler.PRIORITY_NEW)
+            scheduler.enqueue(3, scheduler.PRIORITY_REFRESH)
+        with freeze_time('2015-08-05 18:01:00'):
+            self.assertFalse(scheduler.enqueue(1, scheduler.PRIORITY_REFRESH))
+            self.assertFalse(scheduler.enqueue(3, scheduler.PRIORITY_MANUAL))
+        self.assertEqual(scheduler.get_queue(), [3, 1, 2])
+
+    @patch('instance.scheduler.openstack.get_available_capacity')
+    def test_admit(self, mock_get_available_capacity):
+        """
+        Only the instances at the head of the queue which fit in the quota are admitted
+        """
+        mock_get_available_capacity.return_value = {'instances': 5, 'cores': None, 'ram': 9000}
+        scheduler.enqueue(1, scheduler.PRIORITY_MANUAL)
+        for instance_pk in (2, 3):
+            scheduler.enqueue(instance_pk)
+
+        admission_list = scheduler.admit(Mock())
+        self.assertEqual([(admission.instance_pk, admission.priority) for admission in admission_list],
+                         [(1, scheduler.PRIORITY_MANUAL), (2, scheduler.PRIORITY_REFRESH)])
+        self.assertEqual(scheduler.get_queue(), [3])
+
+        # The admitted instances haven't created their servers yet, so their capacity stays reserved
+        mock_get_available_capacity.return_value = {'instances': 5, 'cores': None, 'ram': 9000}
+        self.assertEqual(scheduler.admit(Mock()), [])
+
+        scheduler.release(admission_list[0].token)
+        self.assertEqual([admission.instance_pk for admission in scheduler.admit(Mock())], [3])
+        self.assertEqual(scheduler.get_queue(), [])
+
+    @patch('instance.scheduler.openstack.get_available_capacity')
+    def test_admit_same_instance_again(self, mock_get_available_capacity):
+        """
+        Each admission of an instance keeps its own reservation, released with its token
+        """
+        mock_get_available_capacity.return_value = {'instances': 5, 'cores': None, 'ram': None}
+        scheduler.enqueue(1)
+        first_admission, = scheduler.admit(Mock())
+        scheduler.enqueue(1)
+        second_admission, = scheduler.admit(Mock())
+        self.assertNotEqual(first_admission.token, second_admission.token)
+        self.assertEqual(scheduler.get_reserved_count(), 2)
+
+        scheduler.release(first_admission.token)
+        self.assertEqual(scheduler.get_reserved_count(), 1)
+        scheduler.release(second_admission.token)
+        self.assertEqual(scheduler.get_reserved_count(), 0)
+
+    @patch('instance.scheduler.openstack.get_available_capacity')
+    def test_admit_server_created(self, mock_get_available_capacity):
+        """
+        The capacity of admitted instances stops being reserved once their server is created, as it is
+        then counted in the quota usage
+        """
+        instance = OpenEdXInstanceFactory()
+        mock_get_available_capacity.return_value = {'instances': 1, 'cores': None, 'ram': None}
+        scheduler.enqueue(instance.pk)
+        self.assertEqual([admission.instance_pk for admission in scheduler.admit(Mock())], [instance.pk])
+        self.assertEqual(scheduler.get_reserved_count(), 1)
+
+        StartedOpenStackServerFactory(instance=instance)
+        self.assertEqual(scheduler.get_reserved_count(), 0)
+
+    @override_settings(BLUE_GREEN_PROVISIONING=False)
+    @patch('instance.scheduler.openstack.get_available_capacity')
+    def test_admit_quota_full(self, mock_get_available_capacity):
+        """
+        When the quota is full, the instances with a started server are still admitted without blue/green
+        provisioning, as their server is terminated before the new one is created
+        """
+        instance = OpenEdXInstanceFactory()
+        ReadyOpenStackServerFactory(instance=instance)
+        new_instance = OpenEdXInstanceFactory()
+        mock_get_available_capacity.return_value = {'instances': 0, 'cores': 0, 'ram': 0}
+        scheduler.enqueue(instance.pk)
+        scheduler.enqueue(new_instance.pk)
+
+        self.assertEqual([admission.instance_pk for admission in scheduler.admit(Mock())], [instance.pk])
+        self.assertEqual(scheduler.get_queue(), [new_instance.pk])
+        self.assertEqual(scheduler.get_reserved_count(), 0)
+
+        # With blue/green provisioning, the new server is created alongside the current one
+        scheduler.enqueue(instance.pk, scheduler.PRIORITY_MANUAL)
+        with override_settings(BLUE_GREEN_PROVISIONING=True):
+            self.assertEqual(scheduler.admit(Mock()), [])
+        self.assertEqual(scheduler.get_queue(), [instance.pk, new_instance.pk])
+
+    def test_admitted_timeout(self):
+        """
+        Admitted provisionings which never finished are eventually released
+        """
+        with freeze_time('2015-08-05 12:00:00'):
+            get_redis_connection('default').hset(scheduler.ADMITTED_KEY, 'token-1', '1:{}:1'.format(time.time()))
+            self.assertEqual(scheduler.get_reserved_count(), 1)
+        with freeze_time('2015-08-05 16:00:01'):
+            self.assertEqual(scheduler.get_reserved_count(), 0)
+
+    @freeze_time('2015-08-05 18:00:00')
+    def test_queue_eta(self):
+        """
+        Estimated start time of the queued provisionings
+        """
+        for instance_pk in (1, 2, 3):
+            scheduler.enqueue(instance_pk)
+        get_redis_connection('default').hset(scheduler.ADMITTED_KEY, 'token-4', '4:0:1')
+        get_redis_connection('default').hset(scheduler.ADMITTED_KEY, 'token-5', '5:0:1')
+        scheduler.release('token-5', duration=1800)
+
+        # Average duration: 0.7 * 3600 + 0.3 * 1800 = 3060s, one provisioning at a time
+        self.assertAlmostEqual((scheduler.get_queue_eta(1) - timezone.now()).total_seconds(), 3060)
+        self.assertAlmostEqual((scheduler.get_queue_eta(3) - timezone.now()).total_seconds(), 3 * 3060)
+        self.assertIsNone(scheduler.get_queue_eta(6))
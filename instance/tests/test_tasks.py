@@ -22,12 +22,19 @@ Worker tasks - Tests
 
 # Imports #####################################################################
 
-from mock import patch
+from mock import PropertyMock, call, patch
 
-from instance import github, tasks
+from django.conf import settings
+from django.core.cache import cache
+from django.test.utils import override_settings
+
+from instance import github, scheduler, tasks
+from instance.models.image import ServerImage
 from instance.models.instance import OpenEdXInstance
 from instance.tests.base import TestCase
+from instance.tests.models.factories.image import ServerImageFactory
 from instance.tests.models.factories.instance import OpenEdXInstanceFactory
+from instance.tests.models.factories.server import ReadyOpenStackServerFactory, StartedOpenStackServerFactory
 
 
 # Tests #######################################################################
@@ -40,20 +47,148 @@ class TasksTestCase(TestCase):
     Test cases for worker tasks
     """
     @patch('instance.models.instance.OpenEdXInstance.provision', autospec=True)
-    def test_provision_sandbox_instance(self, mock_instance_provision):
+    @patch('instance.tasks.scheduler.release')
+    def test_provision_sandbox_instance(self, mock_release, mock_instance_provision):
         """
         Create sandbox instance
         """
         instance = OpenEdXInstanceFactory()
-        tasks.provision_instance(instance.pk)
+        tasks.provision_instance_task(instance.pk, 'admission-token')
         self.assertEqual(mock_instance_provision.call_count, 1)
         self.assertEqual(mock_instance_provision.mock_calls[0][1][0].pk, instance.pk)
+        self.assertEqual(mock_release.call_count, 1)
+        self.assertEqual(mock_release.mock_calls[0][1][0], 'admission-token')
+
+    @patch('instance.models.instance.OpenEdXInstance.provision', autospec=True)
+    @patch('instance.tasks.scheduler.release')
+    def test_provision_sandbox_instance_error(self, mock_release, mock_instance_provision):
+        """
+        The scheduler is notified when the provisioning fails
+        """
+        instance = OpenEdXInstanceFactory()
+        mock_instance_provision.side_effect = Exception('Provisioning failed')
+        with self.assertRaises(Exception):
+            tasks.provision_instance_task(instance.pk, 'admission-token')
+        mock_release.assert_called_once_with('admission-token', None)
+
+    @patch('instance.tasks.provision_instance')
+    @patch('instance.models.instance.OpenEdXInstance.redeploy', autospec=True)
+    def test_redeploy_instance(self, mock_instance_redeploy, mock_provision_instance):
+        """
+        Instances with a ready server are redeployed, while holding the instance mutex
+        """
+        instance = OpenEdXInstanceFactory()
+        ReadyOpenStackServerFactory(instance=instance)
+        lock_key = tasks.PROVISION_LOCK_KEY.format(instance.pk)
+
+        def check_lock(instance):
+            """
+            The mutex of the instance is held during the redeployment
+            """
+            self.assertFalse(cache.lock(lock_key).acquire(blocking=False))
+        mock_instance_redeploy.side_effect = check_lock
+
+        tasks.redeploy_instance_task(instance.pk)
+        self.assertEqual(mock_instance_redeploy.call_count, 1)
+        self.assertEqual(mock_instance_redeploy.mock_calls[0][1][0].pk, instance.pk)
+        self.assertEqual(mock_provision_instance.call_count, 0)
+
+    @patch('instance.tasks.redeploy_instance_task.schedule')
+    @patch('instance.models.instance.OpenEdXInstance.redeploy', autospec=True)
+    def test_redeploy_instance_locked(self, mock_instance_redeploy, mock_schedule):
+        """
+        A redeployment doesn't wait while the instance is being provisioned, it is retried later
+        """
+        instance = OpenEdXInstanceFactory()
+        ReadyOpenStackServerFactory(instance=instance)
+        lock = cache.lock(tasks.PROVISION_LOCK_KEY.format(instance.pk))
+        self.assertTrue(lock.acquire(blocking=False))
+        self.addCleanup(lock.release)
+
+        tasks.redeploy_instance_task(instance.pk)
+        self.assertEqual(mock_instance_redeploy.call_count, 0)
+        mock_schedule.assert_called_once_with(args=(instance.pk,), delay=tasks.REDEPLOY_RETRY_DELAY)
+
+    @patch('instance.tasks.provision_instance')
+    @patch('instance.models.instance.OpenEdXInstance.redeploy', autospec=True)
+    def test_redeploy_instance_not_ready(self, mock_instance_redeploy, mock_provision_instance):
+        """
+        Instances without a ready server are provisioned instead of being redeployed
+        """
+        instance = OpenEdXInstanceFactory()
+        StartedOpenStackServerFactory(instance=instance)
+        tasks.redeploy_instance_task(instance.pk)
+        self.assertEqual(mock_instance_redeploy.call_count, 0)
+        mock_provision_instance.assert_called_once_with(instance.pk)
+
+    @patch('instance.tasks.provision_instance_task')
+    @patch('instance.tasks.get_nova_client')
+    @patch('instance.tasks.scheduler.admit')
+    @patch('instance.tasks.scheduler.enqueue')
+    def test_provision_instance(self, mock_enqueue, mock_admit, mock_get_nova_client,
+                                mock_provision_instance_task):
+        """
+        Instances are added to the waiting list, and the admitted ones are provisioned
+        """
+        mock_admit.return_value = [
+            scheduler.Admission(12, 'token-12', scheduler.PRIORITY_MANUAL),
+            scheduler.Admission(34, 'token-34', scheduler.PRIORITY_REFRESH),
+        ]
+        tasks.provision_instance(12, priority=scheduler.PRIORITY_MANUAL)
+        mock_enqueue.assert_called_once_with(12, scheduler.PRIORITY_MANUAL)
+        mock_admit.assert_called_once_with(mock_get_nova_client.return_value)
+        self.assertEqual(mock_provision_instance_task.mock_calls, [
+            call(12, 'token-12', scheduler.PRIORITY_MANUAL),
+            call(34, 'token-34', scheduler.PRIORITY_REFRESH),
+        ])
+
+    @patch('instance.models.instance.OpenEdXInstance.provision', autospec=True)
+    def test_provision_instance_lock(self, mock_instance_provision):
+        """
+        The instance mutex is held during the provisioning
+        """
+        instance = OpenEdXInstanceFactory()
+        lock_key = tasks.PROVISION_LOCK_KEY.format(instance.pk)
+        other_lock_key = tasks.PROVISION_LOCK_KEY.format(instance.pk + 1)
+
+        def check_lock(instance):
+            """
+            Only the mutex of the instance being provisioned is held
+            """
+            self.assertFalse(cache.lock(lock_key).acquire(blocking=False))
+            other_lock = cache.lock(other_lock_key)
+            self.assertTrue(other_lock.acquire(blocking=False))
+            other_lock.release()
+        mock_instance_provision.side_effect = check_lock
+
+        tasks.provision_instance_task(instance.pk, 'admission-token')
+        self.assertEqual(mock_instance_provision.call_count, 1)
+        lock = cache.lock(lock_key)
+        self.assertTrue(lock.acquire(blocking=False))
+        lock.release()
+
+    @patch('instance.tasks.scheduler.enqueue')
+    @patch('instance.tasks.scheduler.release')
+    @patch('instance.models.instance.OpenEdXInstance.provision', autospec=True)
+    def test_provision_instance_locked(self, mock_instance_provision, mock_release, mock_enqueue):
+        """
+        An instance admitted while it is already being provisioned is queued again, without waiting
+        """
+        instance = OpenEdXInstanceFactory()
+        lock = cache.lock(tasks.PROVISION_LOCK_KEY.format(instance.pk))
+        self.assertTrue(lock.acquire(blocking=False))
+        self.addCleanup(lock.release)
+
+        tasks.provision_instance_task(instance.pk, 'admission-token', scheduler.PRIORITY_MANUAL)
+        self.assertEqual(mock_instance_provision.call_count, 0)
+        mock_release.assert_called_once_with('admission-token')
+        mock_enqueue.assert_called_once_with(instance.pk, scheduler.PRIORITY_MANUAL)
 
     @patch('instance.models.instance.github.get_commit_id_from_ref')
     @patch('instance.tasks.provision_instance')
-    @patch('instance.tasks.get_pr_list_from_username')
+    @patch('instance.tasks.get_pr_list_from_fork')
     @patch('instance.tasks.get_username_list_from_team')
-    def test_watch_pr_new(self, mock_get_username_list, mock_get_pr_list_from_username,
+    def test_watch_pr_new(self, mock_get_username_list, mock_get_pr_list_from_fork,
                           mock_provision_instance, mock_get_commit_id_from_ref):
         """
         New PR created on the watched repo
@@ -67,7 +202,7 @@ class TasksTestCase(TestCase):
             username='bradenmacdonald',
             body='Hello watcher!\n- - -\r\n**Settings**\r\n```\r\nWATCH: true\r\n```\r\nMore...',
         )
-        mock_get_pr_list_from_username.return_value = [pr]
+        mock_get_pr_list_from_fork.return_value = [pr]
         mock_get_commit_id_from_ref.return_value = '7' * 40
 
         tasks.watch_pr()
@@ -81,3 +216,207 @@ class TasksTestCase(TestCase):
         self.assertEqual(
             instance.name,
             'PR#234: Watched PR title which ... (bradenmacdonald) - watched/watch-branch (7777777)')
+
+    @patch('instance.tasks.provision_instance')
+    @patch('instance.tasks.get_pr_list_from_fork')
+    @patch('instance.tasks.get_username_list_from_team')
+    def test_watch_pr_unchanged(self, mock_get_username_list, mock_get_pr_list_from_fork, mock_provision_instance):
+        """
+        Instances of PRs which didn't change aren't saved again
+        """
+        mock_get_username_list.return_value = ['itsjeyd']
+        mock_get_pr_list_from_fork.return_value = [github.PR(
+            number=234,
+            fork_name='watched/fork',
+            branch_name='watch-branch',
+            title='Watched PR',
+            username='itsjeyd',
+            head_sha='7' * 40,
+        )]
+        tasks.watch_pr()
+        self.assertEqual(mock_provision_instance.call_count, 1)
+        instance = OpenEdXInstance.objects.get()
+        self.assertEqual(instance.commit_id, '7' * 40)
+
+        with patch('instance.models.instance.OpenEdXInstance.save') as mock_save:
+            tasks.watch_pr()
+        self.assertEqual(mock_save.call_count, 0)
+        self.assertEqual(mock_provision_instance.call_count, 1)
+        self.assertEqual(OpenEdXInstance.objects.get().modified, instance.modified)
+
+    @patch('instance.tasks.provision_instance')
+    @patch('instance.tasks.get_pr_list_from_fork')
+    @patch('instance.tasks.get_username_list_from_team')
+    def test_watch_pr_new_commit(self, mock_get_username_list, mock_get_pr_list_from_fork, mock_provision_instance):
+        """
+        Instances of PRs are reprovisioned when the head commit of the PR changes
+        """
+        mock_get_username_list.return_value = ['itsjeyd']
+        pr = github.PR(
+            number=234,
+            fork_name='watched/fork',
+            branch_name='watch-branch',
+            title='Watched PR',
+            username='itsjeyd',
+            head_sha='7' * 40,
+        )
+        mock_get_pr_list_from_fork.return_value = [pr]
+        tasks.watch_pr()
+        self.assertEqual(mock_provision_instance.call_count, 1)
+
+        # Title change only
+        pr.title = 'Renamed PR'
+        tasks.watch_pr()
+        self.assertEqual(mock_provision_instance.call_count, 1)
+        self.assertIn('Renamed PR', OpenEdXInstance.objects.get().name)
+
+        pr.head_sha = '8' * 40
+        tasks.watch_pr()
+        self.assertEqual(mock_provision_instance.call_count, 2)
+        instance = OpenEdXInstance.objects.get()
+        self.assertEqual(instance.commit_id, '8' * 40)
+        self.assertEqual(
+            instance.name,
+            'PR#234: Renamed PR (itsjeyd) - watched/watch-branch (8888888)')
+
+    @patch('instance.tasks.provision_instance')
+    @patch('instance.tasks.get_pr_list_from_fork')
+    @patch('instance.tasks.get_username_list_from_team')
+    def test_watch_pr_rate_limit_exceeded(self, mock_get_username_list, mock_get_pr_list_from_fork,
+                                          mock_provision_instance):
+        """
+        The PR check is skipped when the GitHub API budget of background requests is exhausted
+        """
+        mock_get_username_list.return_value = ['itsjeyd']
+        mock_get_pr_list_from_fork.side_effect = github.RateLimitExceeded('Budget exhausted', 1438800000)
+        tasks.watch_pr()
+        self.assertEqual(mock_provision_instance.call_count, 0)
+        self.assertEqual(OpenEdXInstance.objects.count(), 0)
+
+    @patch('instance.models.server.OpenStackServerQuerySet.update_status')
+    def test_update_server_status(self, mock_update_status):
+        """
+        Reconcile the status of the servers
+        """
+        mock_update_status.return_value = []
+        with override_settings(SERVER_STATUS_RECONCILER=True):
+            tasks.update_server_status()
+        self.assertEqual(mock_update_status.call_count, 1)
+
+        with override_settings(SERVER_STATUS_RECONCILER=False):
+            tasks.update_server_status()
+        self.assertEqual(mock_update_status.call_count, 1)
+
+    @override_settings(OPENSTACK_SANDBOX_SNAPSHOT_COUNT=3)
+    @patch('instance.tasks.get_nova_client')
+    @patch('instance.models.image.ServerImageQuerySet.delete_unused')
+    @patch('instance.models.image.ServerImage.update_status')
+    def test_update_server_images(self, mock_update_status, mock_delete_unused, mock_get_nova_client):
+        """
+        Refresh the status of the images being saved, and delete the least recently used ones
+        """
+        ServerImageFactory(status=ServerImage.SAVING)
+        ServerImageFactory(status=ServerImage.AVAILABLE)
+        tasks.update_server_images()
+        mock_update_status.assert_called_once_with(mock_get_nova_client.return_value)
+        mock_delete_unused.assert_called_once_with(mock_get_nova_client.return_value, 3)
+
+    @patch('instance.models.instance.github.get_commit_id_from_ref')
+    @patch('instance.tasks.provision_instance')
+    @patch('instance.tasks.get_pr_list_from_fork')
+    @patch('instance.tasks.get_username_list_from_team')
+    def test_watch_pr_single_listing(self, mock_get_username_list, mock_get_pr_list_from_fork,
+                                     mock_provision_instance, mock_get_commit_id_from_ref):
+        """
+        The PRs of all the team members are fetched with a single listing of the watched fork
+        """
+        mock_get_username_list.return_value = ['user1', 'user2', 'user3']
+        mock_get_pr_list_from_fork.return_value = [github.PR(
+            number=number,
+            fork_name='watched/fork',
+            branch_name='user{}-branch'.format(number),
+            title='PR from user{}'.format(number),
+            username='user{}'.format(number),
+        ) for number in (1, 3)]
+        mock_get_commit_id_from_ref.return_value = '7' * 40
+
+        tasks.watch_pr()
+        mock_get_pr_list_from_fork.assert_called_once_with(settings.WATCH_FORK, ['user1', 'user2', 'user3'])
+        self.assertEqual(mock_provision_instance.call_count, 2)
+        self.assertEqual(
+            sorted(OpenEdXInstance.objects.values_list('sub_domain', flat=True)),
+            ['pr1.sandbox', 'pr3.sandbox'])
+
+    @patch('instance.tasks.update_pr_instance')
+    @patch('instance.tasks.get_username_list_from_team')
+    def test_handle_pr_event(self, mock_get_username_list, mock_update_pr_instance):
+        """
+        PR event from a webhook - only the PRs of the members of the watched organization get a sandbox
+        """
+        mock_get_username_list.return_value = ['itsjeyd']
+        pr_list = [
+            github.PR(number=number, fork_name='watched/fork', branch_name='branch', title='Title', username=username)
+            for number, username in ((1, 'itsjeyd'), (2, 'outsider'))
+        ]
+        for pr in pr_list:
+            tasks.handle_pr_event(pr)
+        mock_update_pr_instance.assert_called_once_with(pr_list[0])
+
+    @patch('instance.tasks.provision_instance')
+    @patch('instance.tasks.redeploy_instance_task')
+    @patch('instance.models.instance.OpenEdXInstance.status', new_callable=PropertyMock)
+    def test_handle_push_event(self, mock_status, mock_redeploy_instance_task, mock_provision_instance):
+        """
+        Push event from a webhook - instances following the branch are updated & redeployed
+        """
+        mock_status.return_value = OpenEdXInstance.READY
+        instance = OpenEdXInstanceFactory(
+            github_organization_name='watched',
+            github_repository_name='fork',
+            branch_name='watch-branch',
+            commit_id='1' * 40,
+        )
+        other_instance = OpenEdXInstanceFactory(branch_name='watch-branch', commit_id='1' * 40)
+
+        tasks.handle_push_event('watched/fork', 'watch-branch', '2' * 40)
+        mock_redeploy_instance_task.assert_called_once_with(instance.pk)
+        self.assertEqual(mock_provision_instance.call_count, 0)
+        instance.refresh_from_db()
+        other_instance.refresh_from_db()
+        self.assertEqual(instance.commit_id, '2' * 40)
+        self.assertEqual(other_instance.commit_id, '1' * 40)
+
+        # Same commit pushed again
+        tasks.handle_push_event('watched/fork', 'watch-branch', '2' * 40)
+        self.assertEqual(mock_redeploy_instance_task.call_count, 1)
+
+    @patch('instance.tasks.provision_instance')
+    @patch('instance.tasks.redeploy_instance_task')
+    @patch('instance.models.instance.OpenEdXInstance.status', new_callable=PropertyMock)
+    def test_handle_push_event_provisioning(self, mock_status, mock_redeploy_instance_task, mock_provision_instance):
+        """
+        Push event from a webhook - instances being provisioned are redeployed afterwards, as their
+        provisioning uses the previous commit
+        """
+        mock_status.return_value = OpenEdXInstance.BOOTED
+        instance = OpenEdXInstanceFactory(github_organization_name='watched', github_repository_name='fork',
+                                          branch_name='watch-branch', commit_id='1' * 40)
+        tasks.handle_push_event('watched/fork', 'watch-branch', '2' * 40)
+        mock_redeploy_instance_task.assert_called_once_with(instance.pk)
+        self.assertEqual(mock_provision_instance.call_count, 0)
+        instance.refresh_from_db()
+        self.assertEqual(instance.commit_id, '2' * 40)
+
+    @patch('instance.tasks.provision_instance')
+    @patch('instance.tasks.redeploy_instance_task')
+    @patch('instance.models.instance.OpenEdXInstance.status', new_callable=PropertyMock)
+    def test_handle_push_event_empty(self, mock_status, mock_redeploy_instance_task, mock_provision_instance):
+        """
+        Push event from a webhook - instances without a server are provisioned
+        """
+        mock_status.return_value = OpenEdXInstance.EMPTY
+        instance = OpenEdXInstanceFactory(github_organization_name='watched', github_repository_name='fork',
+                                          branch_name='watch-branch', commit_id='1' * 40)
+        tasks.handle_push_event('watched/fork', 'watch-branch', '2' * 40)
+        mock_provision_instance.assert_called_once_with(instance.pk)
+        self.assertEqual(mock_redeploy_instance_task.call_count, 0)
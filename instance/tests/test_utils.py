@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+# OpenCraft -- tools to aid developing and hosting free software projects
+# Copyright (C) 2015 OpenCraft <xavier@opencraft.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Utils - Tests
+"""
+
+# Imports #####################################################################
+
+import os
+import socket
+import threading
+
+from datetime import datetime, timedelta
+
+from mock import patch
+
+from instance import utils
+from instance.tests.base import TestCase
+
+
+# Tests #######################################################################
+
+class PortCheckTestCase(TestCase):
+    """
+    Test cases for the port availability checks
+    """
+    def get_listening_socket(self, banner=None):
+        """
+        Open a socket listening on a local port, optionally sending `banner` to the clients
+        Returns the `(ip, port)` address of the socket
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(5)
+        self.addCleanup(sock.close)
+
+        def send_banner():
+            """ Send the banner to the first client """
+            conn, _ = sock.accept()
+            conn.sendall(banner)
+            conn.close()
+
+        if banner is not None:
+            threading.Thread(target=send_banner, daemon=True).start()
+        return sock.getsockname()
+
+    @staticmethod
+    def get_closed_port_address():
+        """
+        Returns the `(ip, port)` address of a local port which isn't listening
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        address = sock.getsockname()
+        sock.close()
+        return address
+
+    def test_is_port_open(self):
+        """
+        Check a single port
+        """
+        self.assertTrue(utils.is_port_open(*self.get_listening_socket()))
+        self.assertFalse(utils.is_port_open(*self.get_closed_port_address()))
+        self.assertFalse(utils.is_port_open(None, 22))
+
+    def test_check_ports(self):
+        """
+        Check multiple ports at once
+        """
+        open_address = self.get_listening_socket()
+        closed_address = self.get_closed_port_address()
+        self.assertEqual(utils.check_ports([open_address, closed_address], timeout=1), {
+            open_address: True,
+            closed_address: False,
+        })
+
+    def test_check_ports_banner(self):
+        """
+        With an expected banner, ports are only open once the server answers with the banner
+        """
+        ssh_address = self.get_listening_socket(banner=b'SSH-2.0-OpenSSH_6.6.1p1\r\n')
+        other_address = self.get_listening_socket(banner=b'HTTP/1.1 400 Bad Request\r\n')
+        silent_address = self.get_listening_socket()
+        self.assertEqual(
+            utils.check_ports([ssh_address, other_address, silent_address], timeout=1,
+                              expected_banner=utils.SSH_BANNER),
+            {
+                ssh_address: True,
+                other_address: False,
+                silent_address: False,
+            })
+
+    def test_check_ports_unresolved(self):
+        """
+        Hostnames which can't be resolved are reported as closed, without failing the other checks
+        """
+        open_address = self.get_listening_socket()
+        unresolved_address = ('unresolved.invalid', 22)
+        original_connect_ex = socket.socket.connect_ex
+
+        def connect_ex(sock, address):
+            """ Fail to resolve the unresolved hostname """
+            if address == unresolved_address:
+                raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+            return original_connect_ex(sock, address)
+
+        with patch.object(socket.socket, 'connect_ex', autospec=True, side_effect=connect_ex):
+            self.assertEqual(utils.check_ports([open_address, unresolved_address], timeout=1), {
+                open_address: True,
+                unresolved_address: False,
+            })
+
+
+class ReadLinesTestCase(TestCase):
+    """
+    Test cases for the stream reader
+    """
+    def test_read_lines(self):
+        """
+        Lines are yielded as they are received, and None while the stream is idle
+        """
+        read_fd, write_fd = os.pipe()
+        with open(read_fd, 'rb') as read_stream, open(write_fd, 'wb', buffering=0) as write_stream:
+            line_iterator = utils.read_lines(read_stream, timeout=0.2)
+            write_stream.write(b'line 1\n')
+            self.assertEqual(next(line_iterator), b'line 1\n')
+            self.assertIsNone(next(line_iterator))
+            write_stream.write(b'line 2\nline 3\n')
+            self.assertEqual(next(line_iterator), b'line 2\n')
+            self.assertEqual(next(line_iterator), b'line 3\n')
+            write_stream.close()
+            self.assertEqual(list(line_iterator), [])
+
+    def test_read_lines_closed(self):
+        """
+        The reader thread is joined when the caller stops early, once the stream is ended
+        """
+        thread_count = threading.active_count()
+        read_fd, write_fd = os.pipe()
+        with open(read_fd, 'rb') as read_stream, open(write_fd, 'wb', buffering=0) as write_stream:
+            line_iterator = utils.read_lines(read_stream, timeout=0.2)
+            write_stream.write(b'line 1\n')
+            self.assertEqual(next(line_iterator), b'line 1\n')
+            self.assertEqual(threading.active_count(), thread_count + 1)
+            write_stream.close()
+            line_iterator.close()
+            self.assertEqual(threading.active_count(), thread_count)
+
+
+class MinuteIntervalTestCase(TestCase):
+    """
+    Test cases for the periodic task schedule
+    """
+    def test_minute_interval(self):
+        """
+        The task runs every `interval` minutes, including for intervals longer than an hour
+        """
+        start = datetime(2015, 8, 5, 18, 0)
+        for interval in (1, 7, 15, 90, 24 * 60):
+            validate_datetime = utils.minute_interval(interval)
+            due_list = [minute for minute in range(3 * 24 * 60)
+                        if validate_datetime(start + timedelta(minutes=minute))]
+            self.assertLess(due_list[0], interval)
+            self.assertEqual({due - previous_due for previous_due, due in zip(due_list, due_list[1:])}, {interval})
+
+    def test_minute_interval_invalid(self):
+        """
+        Intervals which aren't a positive number of minutes are rejected
+        """
+        with self.assertRaises(ValueError):
+            utils.minute_interval(0)
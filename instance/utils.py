@@ -22,21 +22,167 @@ Instance app - Util functions
 
 # Imports #####################################################################
 
+import calendar
+import errno
 import json
+import queue
 import requests
+import selectors
 import socket
+import threading
+import time
 
 from mock import Mock
 
+from django.core.cache import cache
+
+
+# Constants ###################################################################
+
+# Start of the identification string sent by SSH servers upon connection
+SSH_BANNER = b'SSH-'
+
 
 # Functions ###################################################################
 
-def is_port_open(ip, port):
+def _open_connection(address):
     """
-    Check if the port is open on the provided ip
+    Start a non-blocking connection to an `(ip, port)` address
+
+    Returns the socket, or None when the connection failed right away
     """
+    if address[0] is None:
+        return None
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    return sock.connect_ex((ip, port)) == 0
+    sock.setblocking(False)
+    try:
+        error = sock.connect_ex(address)
+    except OSError: # Includes `socket.gaierror`, when the hostname can't be resolved
+        error = None
+    if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+        sock.close()
+        return None
+    return sock
+
+
+def _check_banner(sock, address, expected_banner, received_dict):
+    """
+    Read the data sent by the server on a connected socket, until the length of the expected banner
+
+    Returns whether the banner matches once enough data is received, None while more data is expected
+    """
+    try:
+        data = sock.recv(len(expected_banner) - len(received_dict[address]))
+    except OSError:
+        data = b''
+    received_dict[address] += data
+    if data and len(received_dict[address]) < len(expected_banner):
+        return None
+    return received_dict[address] == expected_banner
+
+
+def _check_ready_socket(selector, key, events, expected_banner, received_dict):
+    """
+    Continue the check of a socket reported as ready by the selector
+
+    Returns whether the port is open once the check is over, None while it is pending
+    """
+    sock, address = key.fileobj, key.data
+    if not events & selectors.EVENT_WRITE:
+        return _check_banner(sock, address, expected_banner, received_dict)
+    if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+        return False
+    if expected_banner is None:
+        return True
+    received_dict[address] = b''
+    selector.modify(sock, selectors.EVENT_READ, address)
+    return None
+
+
+def check_ports(address_list, timeout=5, expected_banner=None):
+    """
+    Check concurrently if the ports are open, for a list of `(ip, port)` tuples
+
+    When `expected_banner` is set, the port is only considered open once the server has
+    sent data starting with it (eg. `SSH_BANNER` to check that the SSH server is answering).
+    Each check is considered failed when it doesn't succeed within `timeout` seconds.
+
+    Returns a dict `{(ip, port): is_open}`
+    """
+    result = {address: False for address in address_list}
+    selector = selectors.DefaultSelector()
+    received_dict = {}
+    try:
+        for address in result:
+            sock = _open_connection(address)
+            if sock is not None:
+                selector.register(sock, selectors.EVENT_WRITE, address)
+
+        deadline = time.time() + timeout
+        while selector.get_map() and time.time() < deadline:
+            for key, events in selector.select(deadline - time.time()):
+                is_open = _check_ready_socket(selector, key, events, expected_banner, received_dict)
+                if is_open is not None:
+                    result[key.data] = is_open
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+    finally:
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
+    return result
+
+
+def is_port_open(ip, port, timeout=5, expected_banner=None):
+    """
+    Check if the port is open on the provided ip - see `check_ports()`
+    """
+    return check_ports([(ip, port)], timeout=timeout, expected_banner=expected_banner)[(ip, port)]
+
+
+def read_lines(stream, timeout):
+    """
+    Iterate over the lines of `stream`, which are read in a separate thread - yields None each time
+    no line has been received for `timeout` seconds, to let the caller act while the stream is idle
+
+    The reader thread is joined when the iteration ends or when the generator is closed - when the caller
+    stops early, the stream must be ended first (eg. by killing the process writing to it)
+    """
+    line_queue = queue.Queue()
+    end_of_stream = object()
+
+    def read_stream():
+        """
+        Forward the lines of the stream to the queue
+        """
+        try:
+            for line in stream:
+                line_queue.put(line)
+        finally:
+            line_queue.put(end_of_stream)
+
+    reader_thread = threading.Thread(target=read_stream, daemon=True)
+    reader_thread.start()
+    try:
+        while True:
+            try:
+                line = line_queue.get(timeout=timeout)
+            except queue.Empty:
+                yield None
+                continue
+            if line is end_of_stream:
+                return
+            yield line
+    finally:
+        reader_thread.join()
+
+
+def increment_counter(key):
+    """
+    Atomically increment a counter stored in the cache, shared by all processes
+    """
+    cache.add(key, 0, timeout=None)
+    return cache.incr(key)
 
 
 def to_json(obj):
@@ -70,3 +216,21 @@ def get_requests_retry(total=10, connect=10, read=10, redirect=10, backoff_facto
         redirect=redirect,
         backoff_factor=backoff_factor
     )
+
+
+def minute_interval(interval):
+    """
+    Periodic task schedule running every `interval` minutes, for `huey.djhuey.periodic_task()` - unlike
+    `crontab(minute='*/<interval>')`, it supports intervals longer than an hour, or which don't divide an hour
+
+    Raises `ValueError` when the interval isn't a positive number of minutes
+    """
+    if interval < 1:
+        raise ValueError('Invalid periodic task interval: {} minute(s)'.format(interval))
+
+    def validate_datetime(dt):
+        """
+        Check if the task is due at the `dt` minute - counted from the epoch, so the pace is regular
+        """
+        return (calendar.timegm(dt.timetuple()) // 60) % interval == 0
+    return validate_datetime
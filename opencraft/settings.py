@@ -199,7 +199,9 @@ HUEY = {
     'always_eager': env.bool('HUEY_ALWAYS_EAGER', default=False),
 
     # Options to pass into the consumer when running ``manage.py run_huey``
-    'consumer_options': {'workers': 1, 'loglevel': logging.DEBUG},
+    # Each worker is a thread - provisionings mostly wait on OpenStack, ansible & SSH, so many of them
+    # can run in parallel in a single consumer process
+    'consumer_options': {'workers': env.int('HUEY_WORKERS', default=8), 'loglevel': logging.DEBUG},
 }
 
 
@@ -225,6 +227,28 @@ OPENSTACK_SANDBOX_BASE_IMAGE = env.json('OPENSTACK_SANDBOX_BASE_IMAGE', default=
 OPENSTACK_SANDBOX_SSH_KEYNAME = env('OPENSTACK_SANDBOX_SSH_KEYNAME', default='opencraft')
 OPENSTACK_SANDBOX_SSH_USERNAME = env('OPENSTACK_SANDBOX_SSH_USERNAME', default='ubuntu')
 
+# Time during which the flavor & image IDs matching the selectors above are cached, in seconds
+OPENSTACK_CATALOG_CACHE_TIMEOUT = env.int('OPENSTACK_CATALOG_CACHE_TIMEOUT', default=3600)
+
+# Reconcile the status of all the servers with OpenStack from the periodic `update_server_status` task, using
+# a few API calls per minute - servers waiting for a status then only reload it from the database. When disabled,
+# each waiting server queries OpenStack itself at every check. Only enable it when the periodic huey process runs.
+SERVER_STATUS_RECONCILER = env.bool('SERVER_STATUS_RECONCILER', default=False)
+
+# Keep the current server of an instance live while its new server is provisioned, and only switch the
+# DNS records & terminate it once the new server is ready - requires room for a second server in the quota,
+# so it is off by default
+BLUE_GREEN_PROVISIONING = env.bool('BLUE_GREEN_PROVISIONING', default=False)
+
+# Snapshot the server of the first instance provisioned with each set of configuration & service versions,
+# once the base stage of the playbook has run with generic vars only - all the tasks but the ones tagged with
+# ANSIBLE_SNAPSHOT_DEPLOY_TAGS (see the Ansible section), which then apply the instance vars. The servers of
+# the next instances are booted from the best-matching snapshot, and only run the deployment tasks.
+OPENSTACK_SANDBOX_SNAPSHOTS = env.bool('OPENSTACK_SANDBOX_SNAPSHOTS', default=False)
+
+# Maximum number of snapshots kept - the least recently used ones are deleted first
+OPENSTACK_SANDBOX_SNAPSHOT_COUNT = env.int('OPENSTACK_SANDBOX_SNAPSHOT_COUNT', default=5)
+
 
 # DNS (Gandi) #################################################################
 
@@ -260,14 +284,46 @@ WATCH_FORK = env('WATCH_FORK', default=DEFAULT_FORK)
 # Github organization to watch
 WATCH_ORGANIZATION = env('WATCH_ORGANIZATION')
 
+# Secret shared with the GitHub webhooks, used to check the signature of the events they send
+# The webhooks are disabled when it is empty
+GITHUB_WEBHOOK_SECRET = env('GITHUB_WEBHOOK_SECRET', default='')
+
+# Interval between two checks of the PRs of the watched fork, in minutes (at least 1, can be longer than an
+# hour) - when the webhooks are enabled, this is only a fallback for missed events, so it can run less often
+WATCH_PR_INTERVAL = env.int('WATCH_PR_INTERVAL', default=15 if GITHUB_WEBHOOK_SECRET else 1)
+
 # Default admin organization for instances (gets shell access)
 DEFAULT_ADMIN_ORGANIZATION = env('DEFAULT_ADMIN_ORGANIZATION', default='')
 
+# Git repositories ############################################################
+
+# Directory containing the local bare mirrors of the cloned repositories (eg. the ansible configuration)
+REPO_MIRROR_DIR = env('REPO_MIRROR_DIR',
+                      default=os.path.join(os.path.expanduser('~'), '.cache', 'opencraft', 'repo_mirrors'))
+
+
 # Ansible #####################################################################
 
 # Ansible requires a Python 2 interpreter
 ANSIBLE_PYTHON_PATH = env('ANSIBLE_PYTHON_PATH', default='/usr/bin/python')
 
+# Directory where the ansible virtualenvs are kept between runs, one per set of requirements
+ANSIBLE_VENV_CACHE_DIR = env('ANSIBLE_VENV_CACHE_DIR',
+                             default=os.path.join(os.path.expanduser('~'), '.cache', 'opencraft', 'ansible_venvs'))
+
+# Maximum number of cached ansible virtualenvs - the least recently used ones are deleted first
+ANSIBLE_VENV_CACHE_SIZE = env.int('ANSIBLE_VENV_CACHE_SIZE', default=5)
+
+# Tags of the playbook tasks run on servers booted from a snapshot (see OPENSTACK_SANDBOX_SNAPSHOTS) - they
+# must cover all the tasks using the settings & secrets of the instance, which are kept out of the snapshots,
+# and deploy the code at the instance versions
+ANSIBLE_SNAPSHOT_DEPLOY_TAGS = env('ANSIBLE_SNAPSHOT_DEPLOY_TAGS',
+                                   default='install:configuration,install:code,install:app-requirements,migrate,assets')
+
+# Tags of the playbook tasks run to redeploy the current server of an instance after its commit changed, without
+# recreating the server - they must update the edx-platform code, its requirements, migrations & assets
+ANSIBLE_REDEPLOY_TAGS = env('ANSIBLE_REDEPLOY_TAGS', default='install:code,install:app-requirements,migrate,assets')
+
 
 # Emails ######################################################################
 